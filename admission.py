@@ -0,0 +1,202 @@
+# Admission control: 每個 model 的併發上限 + token bucket 速率限制 + 有上限的等待佇列
+#
+# 流量突然變大時，若每個 request 都直接打 OpenAI，會一起吃到 429，所有串流同時卡住。
+# 這裡在 request 進來時先拿 slot:
+#   - 有空位且速率允許: 立刻執行
+#   - 沒空位: 排隊等待，最多 ADMISSION_QUEUE_TIMEOUT 秒
+#   - 佇列已滿或等太久: 丟出 AdmissionRejected，endpoint 回 503 + Retry-After，而不是讓串流卡住
+#
+# 設定都來自環境變數，例如 gpt-5-mini:
+#   ADMISSION_GPT_5_MINI_CONCURRENCY=30   同時最多幾個 run
+#   ADMISSION_GPT_5_MINI_RPS=10           每秒最多開始幾個 run
+#   ADMISSION_GPT_5_MINI_BURST=20         token bucket 容量
+#   ADMISSION_GPT_5_MINI_QUEUE_SIZE=100   最多幾個 request 排隊
+
+import asyncio
+import math
+import os
+import re
+import time
+
+# model: (concurrency, rps, burst)
+DEFAULT_MODEL_LIMITS = {
+    "gpt-4.1-mini": (50, 20, 40),
+    "gpt-5-mini": (30, 10, 20),
+    "gpt-5-nano": (50, 20, 40),  # model_router.py 分流過來的簡單問題
+    "gpt-5.1": (20, 5, 10),
+}
+DEFAULT_LIMITS = (20, 5, 10)  # 其他沒列出來的 model
+
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))  # 秒
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "2"))  # 秒
+
+
+def _env_key(model: str, name: str) -> str:
+    return f"ADMISSION_{re.sub(r'[^0-9A-Za-z]+', '_', model).upper()}_{name}"
+
+
+def _env_number(key: str, default: float) -> float:
+    value = os.environ.get(key)
+    return float(value) if value else default
+
+
+class AdmissionRejected(Exception):
+    """The request could not get a slot in time; the client should retry later."""
+
+    def __init__(self, model: str, reason: str, retry_after: int = ADMISSION_RETRY_AFTER):
+        super().__init__(f"{model}: {reason}")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket; rate <= 0 means unlimited."""
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self) -> float:
+        """Take one token and return how many seconds the caller must wait before using it."""
+        if self.rate <= 0:
+            return 0
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        if self.rate > 0:
+            self.tokens += 1
+
+
+class Slot:
+    """A granted admission; release it when the run finishes (idempotent)."""
+
+    def __init__(self, limiter: "ModelLimiter"):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.active -= 1
+            self.limiter.semaphore.release()
+
+    async def guard(self, generator):
+        """Wrap a streaming generator so the slot is held until the stream ends.
+
+        The release runs in the generator's finally, so only if the stream is actually iterated; when it may never
+        start (a StreamingResponse body, a background task), also release from the owner (see main.py).
+        """
+        try:
+            async for chunk in generator:
+                yield chunk
+        finally:
+            self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class ModelLimiter:
+    def __init__(self, model: str, concurrency: int, rps: float, burst: float,
+                 queue_size: int = ADMISSION_QUEUE_SIZE, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.model = model
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rps, burst)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _reject(self, reason: str, retry_after: float = ADMISSION_RETRY_AFTER):
+        self.rejected += 1
+        raise AdmissionRejected(self.model, reason, max(1, math.ceil(retry_after)))
+
+    async def admit(self) -> Slot:
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            self._reject("queue full")
+
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject("timed out waiting for a concurrency slot")
+
+            delay = self.bucket.reserve()
+            remaining = self.queue_timeout - (time.monotonic() - start)
+            if delay > remaining:
+                self.bucket.cancel()
+                self.semaphore.release()
+                self._reject("rate limited", retry_after=delay)
+            if delay > 0:
+                try:
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - start
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        self.admitted += 1
+        self.active += 1
+        return Slot(self)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "rps": self.bucket.rate,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds_avg": self.wait_seconds_total / self.admitted if self.admitted else 0.0,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+class AdmissionController:
+    """Per-model limiters, created on first use from DEFAULT_MODEL_LIMITS and the environment."""
+
+    def __init__(self):
+        self.limiters: dict[str, ModelLimiter] = {}
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            concurrency, rps, burst = DEFAULT_MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+            limiter = ModelLimiter(
+                model,
+                concurrency=int(_env_number(_env_key(model, "CONCURRENCY"), concurrency)),
+                rps=_env_number(_env_key(model, "RPS"), rps),
+                burst=_env_number(_env_key(model, "BURST"), burst),
+                queue_size=int(_env_number(_env_key(model, "QUEUE_SIZE"), ADMISSION_QUEUE_SIZE)),
+            )
+            self.limiters[model] = limiter
+        return limiter
+
+    async def admit(self, model: str) -> Slot:
+        return await self.limiter(model).admit()
+
+    def stats(self) -> dict:
+        return {model: limiter.stats() for model, limiter in self.limiters.items()}
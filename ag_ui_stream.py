@@ -0,0 +1,86 @@
+# StreamFrame -> AG-UI 事件
+#
+# ag_ui 的 pydantic models import 很慢，由背景 warm-up 載入 (見 warmup.py)，不在 import main 時載入。
+
+import uuid
+
+from ag_ui.core import (
+    RunAgentInput,
+    EventType,
+    RunStartedEvent,
+    RunFinishedEvent,
+    RunErrorEvent,
+    TextMessageStartEvent,
+    TextMessageContentEvent,
+    TextMessageEndEvent,
+    ToolCallStartEvent,
+    ToolCallArgsEvent,
+    ToolCallEndEvent,
+    StepStartedEvent,
+    StepFinishedEvent,
+)
+from ag_ui.encoder import EventEncoder
+
+from stream_pipeline import (
+    StreamFrame,
+    FRAME_TEXT,
+    FRAME_THINK_START,
+    FRAME_THINK_TEXT,
+    FRAME_TOOL_CALL,
+    FRAME_DONE,
+)
+from structured_logging import get_logger
+
+logger = get_logger("ag_ui_stream")
+
+__all__ = ["AGUIFrameEncoder", "EventEncoder", "EventType", "RunAgentInput", "RunErrorEvent", "RunStartedEvent"]
+
+
+class AGUIFrameEncoder:
+    """把 StreamFrame 轉成 AG-UI 事件"""
+
+    def __init__(self, encoder: EventEncoder, thread_id: str, run_id: str):
+        self.encoder = encoder
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.message_id = str(uuid.uuid4())
+        self.text_started = False
+        self.reasoning_started = False
+
+    def encode(self, frame: StreamFrame) -> str:
+        events = []
+
+        if frame.kind == FRAME_THINK_START:
+            self.reasoning_started = True
+            events.append(StepStartedEvent(type=EventType.STEP_STARTED, step_name="Thinking"))
+
+        elif frame.kind == FRAME_THINK_TEXT:
+            if self.reasoning_started:
+                events.append(StepFinishedEvent(type=EventType.STEP_FINISHED, step_name="Thinking"))
+                self.reasoning_started = False
+
+        elif frame.kind == FRAME_TEXT:
+            # Send TEXT_MESSAGE_START on first text delta
+            if not self.text_started:
+                events.append(TextMessageStartEvent(type=EventType.TEXT_MESSAGE_START, message_id=self.message_id, role="assistant"))
+                self.text_started = True
+            events.append(TextMessageContentEvent(type=EventType.TEXT_MESSAGE_CONTENT, message_id=self.message_id, delta=frame.data["content"]))
+
+        elif frame.kind == FRAME_TOOL_CALL:
+            tool_call_id = f"tc_{uuid.uuid4()}"
+            events.append(ToolCallStartEvent(type=EventType.TOOL_CALL_START, tool_call_id=tool_call_id, tool_call_name=frame.data["tool_name"]))
+            events.append(ToolCallArgsEvent(type=EventType.TOOL_CALL_ARGS, tool_call_id=tool_call_id, delta=frame.data["arguments"]))
+            events.append(ToolCallEndEvent(type=EventType.TOOL_CALL_END, tool_call_id=tool_call_id))
+
+        elif frame.kind == FRAME_DONE:
+            # Send TEXT_MESSAGE_END if text was started
+            if self.text_started:
+                events.append(TextMessageEndEvent(type=EventType.TEXT_MESSAGE_END, message_id=self.message_id))
+
+            # Use last_response_id as the run_id for RUN_FINISHED
+            # This allows the frontend to use it as parent_run_id in the next request
+            final_run_id = frame.data["last_response_id"] or self.run_id
+            logger.info("[AG-UI] RUN_FINISHED with run_id: %s", final_run_id)
+            events.append(RunFinishedEvent(type=EventType.RUN_FINISHED, thread_id=self.thread_id, run_id=final_run_id))
+
+        return "".join(self.encoder.encode(event) for event in events)
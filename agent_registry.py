@@ -0,0 +1,50 @@
+# Agent registry: 每種 agent 只在啟動時建立一次，之後每個 request 共用
+#
+# 原本每個 request 都 new 一個 Agent(...)，SDK 每次 run 都要重新從 output_type 產生 output schema (pydantic TypeAdapter + JSON schema)。
+# 這裡把 output_type 先包成 AgentOutputSchema，SDK 看到已經是 AgentOutputSchemaBase 就會直接使用，不會重算。
+# function_tool 的參數 schema 在 decorator 時就已經算好，所以 agent 共用後 tools 也不會重算。
+#
+# 每個 request 不同的資料 (thread id) 用 context 傳入，今天日期接在 model input 的最後面 (見 prompt_cache.py)，不寫死在 agent 裡。
+#
+# agents 只在建立 agent 時才 import，import 這個模組本身很快 (見 warmup.py)。
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from agents import Agent, AgentOutputSchema
+
+
+def output_schema(output_type: type) -> AgentOutputSchema:
+    """Build the output schema once so the SDK does not rebuild it on every run."""
+    from agents import AgentOutputSchema
+
+    return AgentOutputSchema(output_type)
+
+
+class AgentRegistry:
+    """Builds each registered agent variant once and hands out the shared instance."""
+
+    def __init__(self):
+        self._factories: dict[str, Callable[[], Agent]] = {}
+        self._agents: dict[str, Agent] = {}
+
+    def register(self, name: str, factory: Callable[[], Agent]):
+        self._factories[name] = factory
+        self._agents.pop(name, None)
+
+    def get(self, name: str) -> Agent:
+        agent = self._agents.get(name)
+        if agent is None:
+            agent = self._factories[name]()
+            self._agents[name] = agent
+        return agent
+
+    def warm_up(self):
+        """Build every registered agent (called at startup)."""
+        for name in self._factories:
+            self.get(name)
+
+    def names(self) -> list[str]:
+        return list(self._factories)
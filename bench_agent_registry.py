@@ -0,0 +1,80 @@
+# Benchmark: 每個 request 的 agent 準備成本，per-request Agent(...) vs AgentRegistry
+#
+# 模擬 Runner 在開始 run 之前會做的事: 建立 agent、解析 output schema、取得 tools、產生 system prompt。
+# 不會呼叫 OpenAI API。
+#
+# 用法: python bench_agent_registry.py [次數]
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("TAVILY_API_KEY", "bench")
+
+from agents import Agent, AgentOutputSchema, AgentOutputSchemaBase, ModelSettings, RunContextWrapper
+
+from qa_agents import QueryResult, agent_registry, web_search
+
+
+def per_request_agent() -> Agent:
+    """原本 generate_agent_stream 的寫法"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    return Agent(
+        name="QA Agent",
+        instructions=f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. Today's date is {today}.""",
+        tools=[web_search],
+        model="gpt-5-mini",
+        output_type=QueryResult,
+        model_settings=ModelSettings(
+            reasoning={
+                "effort": "low",
+                "summary": "auto"
+            }
+        )
+    )
+
+
+def registry_agent() -> Agent:
+    return agent_registry.get("qa_stream")
+
+
+async def prepare(make_agent) -> None:
+    agent = make_agent()
+    ctx = RunContextWrapper(context=None)
+
+    # Runner 每次 run 都會做的事
+    if isinstance(agent.output_type, AgentOutputSchemaBase):
+        schema = agent.output_type
+    else:
+        schema = AgentOutputSchema(agent.output_type)
+    schema.json_schema()
+    await agent.get_all_tools(ctx)
+    await agent.get_system_prompt(ctx)
+
+
+async def bench(make_agent, n: int) -> float:
+    await prepare(make_agent)  # warm up
+    start = time.perf_counter()
+    for _ in range(n):
+        await prepare(make_agent)
+    return (time.perf_counter() - start) / n
+
+
+async def main(n: int):
+    agent_registry.warm_up()
+
+    old = await bench(per_request_agent, n)
+    new = await bench(registry_agent, n)
+
+    print(f"requests: {n}")
+    print(f"per-request Agent(...): {old * 1e6:8.1f} µs/request")
+    print(f"AgentRegistry         : {new * 1e6:8.1f} µs/request")
+    print(f"speedup               : {old / new:8.1f}x")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    asyncio.run(main(n))
@@ -0,0 +1,159 @@
+# Benchmark: structured output 串流送到前端的 bytes
+#
+#   snapshot  每個 delta 送目前 parse 出來的整個物件 (最早的寫法)
+#   fields    字串欄位只送新增的字，陣列欄位每完成一個元素就送一次完整的陣列 (上一版的格式)
+#   patch     JSONPatchEncoder: RFC 6902 風格的 add / append，每個字只送一次 (目前的格式)
+#
+# snapshot / fields 用之前 encode_sse 的 json.dumps (ensure_ascii、有空白)，patch 用目前的 (UTF-8、不加空白)。
+#
+# 分別模擬每個 delta 一個 SSE 事件，以及 coalesce() 合併後 (每 8 個 delta 一個事件) 的情況，
+# 並確認套用 patch 之後還原的物件和完整的 JSON 一樣。
+#
+# 用法: python bench_delta_protocol.py
+
+import json
+import random
+
+import jiter
+
+from stream_pipeline import StreamFrame, _merge
+from streaming_json import JSONPatchEncoder, StreamingJSONParser
+
+CHARS_PER_TOKEN = 4
+COALESCE_DELTAS = 8  # 約 30ms 的 flush interval、每秒 250 tokens
+
+
+def words(n: int) -> str:
+    vocab = ["台積電", "營收", "AI", "晶片", "需求", "成長", "the", "model", "context", "window", "，", "。"]
+    return "".join(random.choice(vocab) for _ in range(n))
+
+
+def query_result() -> dict:
+    return {"content": words(600), "following_questions": [words(8) + "?" for _ in range(3)]}
+
+
+def research_report() -> dict:
+    # 陣列很多的 schema: 20 個 findings，每個都有自己的 sources 陣列
+    return {
+        "summary": words(120),
+        "findings": [
+            {"title": words(5), "detail": words(60), "confidence": round(random.random(), 2),
+             "sources": [f"https://example.com/{random.randint(1000, 9999)}" for _ in range(3)]}
+            for _ in range(20)
+        ],
+        "following_questions": [words(8) + "?" for _ in range(10)],
+    }
+
+
+def split_deltas(doc: dict) -> list[str]:
+    text = json.dumps(doc, ensure_ascii=False)
+    deltas, i = [], 0
+    while i < len(text):
+        size = random.randint(1, CHARS_PER_TOKEN * 2)
+        deltas.append(text[i:i + size])
+        i += size
+    return deltas
+
+
+## 三種格式: 每個 delta 產生一個 frame data (沒有變動就是 None)
+def snapshot_frames(deltas):
+    json_str = ""
+    for delta in deltas:
+        json_str += delta
+        try:
+            yield {"snapshot": jiter.from_json(json_str.encode(), partial_mode="trailing-strings")}
+        except ValueError:
+            yield None
+
+
+def fields_frames(deltas):
+    parser = StreamingJSONParser()
+    for delta in deltas:
+        update = {}
+        for kind, path, value in parser.feed(delta):
+            if kind == "append" and len(path) == 1:
+                update[path[0]] = update.get(path[0], "") + value
+            elif kind == "done" and len(path) == 2 and isinstance(parser.root.get(path[0]), list):
+                update[path[0]] = json.loads(json.dumps(parser.root[path[0]]))
+        yield update or None
+
+
+def patch_frames(deltas):
+    patches = JSONPatchEncoder()
+    for delta in deltas:
+        ops = patches.feed(delta)
+        yield {"patch": ops} if ops else None
+
+
+def sse(data: dict) -> bytes:
+    """和 stream_pipeline.encode_sse 相同的格式"""
+    return f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n".encode()
+
+
+def sse_before(data: dict) -> bytes:
+    """之前的 encode_sse: 預設的 json.dumps (中文變成 \\uXXXX、有空白)"""
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+def wire_bytes(frames, coalesce_every: int = 1, sse=sse) -> tuple[int, int, list]:
+    total = events = 0
+    sent = []
+    pending = None
+    for i, data in enumerate(frames, 1):
+        if data is not None:
+            if pending is None:
+                pending = StreamFrame("output", {k: list(v) if isinstance(v, list) else v for k, v in data.items()})
+            else:
+                _merge(pending, StreamFrame("output", data))
+        if pending is not None and i % coalesce_every == 0:
+            total += len(sse(pending.data))
+            events += 1
+            sent.append(pending.data)
+            pending = None
+    if pending is not None:
+        total += len(sse(pending.data))
+        events += 1
+        sent.append(pending.data)
+    return total, events, sent
+
+
+def apply_patch(doc: dict, ops: list[dict]):
+    """Python 版的 static/json_patch.js applyPatch()"""
+    for op in ops:
+        keys = [key.replace("~1", "/").replace("~0", "~") for key in op["path"].split("/")[1:]]
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        last = keys[-1]
+        if op["op"] == "append":
+            parent[int(last) if isinstance(parent, list) else last] += op["value"]
+        elif isinstance(parent, list):
+            parent.insert(len(parent) if last == "-" else int(last), op["value"])
+        else:
+            parent[last] = op["value"]
+
+
+def main():
+    random.seed(42)
+    for name, doc in [("QueryResult", query_result()), ("research report (list-heavy)", research_report())]:
+        deltas = split_deltas(doc)
+        payload = len(json.dumps(doc).encode())
+        print(f"\n== {name}: {len(deltas)} deltas, final JSON {payload / 1024:.1f} KB")
+        print(f"   {'format':<10}{'per delta':>22}{f'coalesced x{COALESCE_DELTAS}':>24}")
+        for label, make, encode in [("snapshot", snapshot_frames, sse_before), ("fields", fields_frames, sse_before),
+                                    ("patch", patch_frames, sse)]:
+            row = []
+            for every in (1, COALESCE_DELTAS):
+                total, events, sent = wire_bytes(make(deltas), every, encode)
+                row.append(f"{total / 1024:8.1f} KB {events:5d} ev")
+                if label == "patch":
+                    rebuilt = {}
+                    for data in sent:
+                        apply_patch(rebuilt, data["patch"])
+                    assert rebuilt == doc, "patch did not rebuild the document"
+            print(f"   {label:<10}{row[0]:>22}{row[1]:>24}")
+        print("   (patch 套用後還原的物件和原始 JSON 相同)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# Benchmark: 每個 request 開新的連線 vs http_clients.py 共用的連線池
+#
+# 在本機起一個 HTTPS server (用 openssl 產生自簽憑證，沒有 openssl 就退回 HTTP)，比較:
+#   - aiohttp: 每次 fetch 開一個新的 ClientSession (研究腳本原本抓 Jina 的寫法) vs 共用的 jina_session()
+#   - httpx:   每次 request 開一個新的 AsyncClient vs 共用的連線池 (openai_client / tavily_client 用的設定)
+# 並統計 server 端實際收到幾條新連線。本機沒有網路延遲，真實環境每條新連線還要多付 1~3 個 RTT。
+#
+# 用法: python bench_http_clients.py [次數] [併發數]
+
+import asyncio
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import httpx
+from aiohttp import web
+
+import http_clients
+
+
+def make_ssl_context(workdir: str):
+    if shutil.which("openssl") is None:
+        return None, None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+         "-days", "1", "-subj", "/CN=127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    server_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_ctx.load_cert_chain(cert, key)
+    client_ctx = ssl.create_default_context(cafile=cert)
+    client_ctx.check_hostname = False
+    return server_ctx, client_ctx
+
+
+async def start_server(server_ctx) -> tuple[web.AppRunner, str, set]:
+    connections = set()
+    body = "x" * 2048
+
+    async def page(request):
+        connections.add(request.transport)  # 保留物件本身，避免 id 被重複使用
+        return web.Response(text=body)
+
+    app = web.Application()
+    app.router.add_get("/page", page)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ctx)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    scheme = "https" if server_ctx else "http"
+    return runner, f"{scheme}://127.0.0.1:{port}/page", connections
+
+
+async def run(label, fetch, url, n, concurrency, connections):
+    connections.clear()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await fetch(url)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(n)))
+    total = time.perf_counter() - start
+    latencies.sort()
+    print(f"{label:<38} {total / n * 1000:7.2f} ms/req   p50 {latencies[n // 2] * 1000:6.2f} ms   "
+          f"p99 {latencies[int(n * 0.99)] * 1000:6.2f} ms   new connections: {len(connections)}")
+    return total / n
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server_ctx, client_ctx = make_ssl_context(workdir)
+        runner, url, connections = await start_server(server_ctx)
+        print(f"{n} requests, concurrency {concurrency}, {'HTTPS' if server_ctx else 'HTTP'} {url}, "
+              f"HTTP/2: {http_clients.http2_enabled()}\n")
+
+        ## aiohttp (Jina)
+        async def aiohttp_new_session(url):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url, ssl=client_ctx) as resp:
+                    await resp.text()
+
+        async def aiohttp_shared_session(url):
+            async with http_clients.jina_session().get(url, ssl=client_ctx) as resp:
+                await resp.text()
+
+        ## httpx (OpenAI / Tavily)
+        verify = client_ctx if client_ctx else True
+
+        async def httpx_new_client(url):
+            async with httpx.AsyncClient(verify=verify) as client:
+                (await client.get(url)).text
+
+        shared = httpx.AsyncClient(verify=verify, **http_clients.httpx_options())
+
+        async def httpx_shared_client(url):
+            (await shared.get(url)).text
+
+        results = {}
+        for label, fetch in [
+            ("aiohttp: new ClientSession per fetch", aiohttp_new_session),
+            ("aiohttp: shared jina_session()", aiohttp_shared_session),
+            ("httpx: new AsyncClient per request", httpx_new_client),
+            ("httpx: shared pooled client", httpx_shared_client),
+        ]:
+            await fetch(url)  # warm-up (import、DNS、第一次 handshake)
+            results[label] = await run(label, fetch, url, n, concurrency, connections)
+
+        print(f"\naiohttp speedup: {results['aiohttp: new ClientSession per fetch'] / results['aiohttp: shared jina_session()']:.1f}x")
+        print(f"httpx speedup:   {results['httpx: new AsyncClient per request'] / results['httpx: shared pooled client']:.1f}x")
+
+        await shared.aclose()
+        await http_clients.close_http_clients()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
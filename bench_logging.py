@@ -0,0 +1,54 @@
+# Benchmark: 每秒可處理的 stream event 數，logging 關閉 / 取樣 / 全部記錄 vs 原本的 print(event)
+#
+# 用法: python bench_logging.py
+
+import asyncio
+import io
+import os
+import time
+
+from agents.stream_events import RawResponsesStreamEvent
+from openai.types.responses import ResponseTextDeltaEvent
+
+from stream_pipeline import agent_frames
+from structured_logging import dropped_records, event_logger, setup_logging
+
+N = 20000
+
+class FakeResult:
+    last_response_id = None
+    context_wrapper = None
+
+    async def stream_events(self):
+        for i in range(N):
+            yield RawResponsesStreamEvent(data=ResponseTextDeltaEvent(
+                type="response.output_text.delta", delta="字", item_id="msg_1", output_index=0,
+                content_index=0, sequence_number=i, logprobs=[],
+            ))
+
+async def run(on_event) -> float:
+    start = time.perf_counter()
+    async for _ in agent_frames(FakeResult(), on_event=on_event):
+        pass
+    return N / (time.perf_counter() - start)
+
+def print_to(sink):
+    return lambda event: print(event, file=sink)
+
+async def main():
+    sink = open(os.devnull, "w")
+    setup_logging(level="DEBUG", stream=sink)
+
+    results = [
+        ("logging disabled", await run(None)),
+        ("sampled 1%", await run(event_logger("/bench", rate=0.01))),
+        ("sampled 100% (queue)", await run(event_logger("/bench", rate=1))),
+        ("print(event) to /dev/null", await run(print_to(sink))),
+        ("print(event) to StringIO", await run(print_to(io.StringIO()))),
+    ]
+    for name, rate in results:
+        print(f"{name:28} {rate:12,.0f} events/sec")
+    print(f"dropped log records: {dropped_records[0]}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
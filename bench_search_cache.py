@@ -0,0 +1,112 @@
+# Benchmark: 熱門問題的流量高峰，每次都打 Tavily vs search_cache.py 的 SearchCache (TTL/LRU + single-flight)
+#
+# 用本地的 fake Tavily client (固定延遲)，不會呼叫真的 API。一批 user 同時查詢，query 集中在少數熱門題目上。
+# 開始前先跑一次 SearchCache 的行為檢查 (合併、正規化、過期、LRU、全部取消時 upstream 也取消)，不符合就停下來。
+#
+# 用法: python bench_search_cache.py [同時的 user 數，預設 200]
+
+import asyncio
+import random
+import sys
+import time
+
+from search_cache import SearchCache
+
+LATENCY = 0.3  # 秒，fake Tavily 每次查詢的延遲
+TOPICS = 20
+
+
+class FakeTavilyClient:
+    def __init__(self, latency: float = LATENCY):
+        self.latency = latency
+        self.calls = 0
+        self.cancelled = 0
+
+    async def search(self, query: str, **kwargs) -> dict:
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return {"query": query, "results": [{"title": query, "url": "https://example.com", "content": f"about {query}", "score": 0.9}]}
+
+
+async def check():
+    now = [0.0]
+    client = FakeTavilyClient(0.05)
+    cache = SearchCache(client, ttl=60, max_size=2, clock=lambda: now[0])
+
+    # 10 個同時進行的相同查詢只會打 1 次 upstream
+    results = await asyncio.gather(*[cache.search("  台積電 財報 ") for _ in range(10)])
+    assert client.calls == 1 and cache.coalesced == 9
+    assert all(r is results[0] for r in results)
+
+    # 正規化後相同的 query 命中快取
+    await cache.search("台積電   財報")
+    assert client.calls == 1 and cache.hits == 1
+
+    # 過期後重新查詢
+    now[0] += 61
+    await cache.search("台積電 財報")
+    assert client.calls == 2
+
+    # LRU: 超過 max_size 時淘汰最久沒用的
+    await cache.search("a")
+    await cache.search("b")
+    await cache.search("台積電 財報")
+    assert client.calls == 5
+
+    # 只取消其中一個呼叫的人，其他人照樣拿到結果；全部取消時 upstream 呼叫也取消
+    callers = [asyncio.ensure_future(cache.search("cancel me")) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    callers[0].cancel()
+    assert (await asyncio.gather(*callers[1:]))[0]["query"] == "cancel me"
+    callers = [asyncio.ensure_future(cache.search("cancel all")) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    for caller in callers:
+        caller.cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert client.cancelled == 1 and cache.stats()["in_flight"] == 0
+
+
+async def burst(search, users: int, seed: int = 1) -> tuple[float, float]:
+    """`users` concurrent searches over a few popular topics; returns (mean, max) latency in seconds."""
+    rng = random.Random(seed)
+    # 前幾個題目佔大部分的流量
+    queries = [f"熱門題目 {min(int(rng.paretovariate(1.2)), TOPICS)}" for _ in range(users)]
+
+    async def one(query):
+        start = time.perf_counter()
+        await search(query)
+        return time.perf_counter() - start
+
+    latencies = await asyncio.gather(*(one(q) for q in queries))
+    return sum(latencies) / len(latencies), max(latencies)
+
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    await check()
+    print("SearchCache behavior checks passed")
+
+    direct = FakeTavilyClient()
+    mean, worst = await burst(direct.search, users)
+    print(f"\n== {users} concurrent searches over {TOPICS} topics (upstream latency {LATENCY * 1000:.0f} ms)")
+    print(f"   no cache        {direct.calls:>5} upstream calls   mean {mean * 1000:6.0f} ms   max {worst * 1000:6.0f} ms")
+
+    cached = FakeTavilyClient()
+    cache = SearchCache(cached)
+    mean, worst = await burst(cache.search, users)
+    print(f"   SearchCache     {cached.calls:>5} upstream calls   mean {mean * 1000:6.0f} ms   max {worst * 1000:6.0f} ms"
+          f"   (coalesced {cache.coalesced})")
+
+    # 同一批 query 幾分鐘後再來一次: 全部命中快取
+    mean, worst = await burst(cache.search, users)
+    print(f"   second burst    {cached.calls:>5} upstream calls   mean {mean * 1000:6.2f} ms   max {worst * 1000:6.2f} ms"
+          f"   (hits {cache.hits})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+# Benchmark: 一個多次搜尋的 run 為了 search_source 佔用的記憶體，整包 Tavily response vs SourceStore
+#
+# 重播一個 run 裡的搜尋 (每次: parse Tavily 的 JSON -> 壓縮成 tool output -> 存進 context.search_source)，
+# 用 tracemalloc 量這個 run 的記憶體峰值，以及 run 結束時 search_source 還佔著的記憶體。
+# 不會呼叫 Tavily / OpenAI。
+#
+# 用法:
+#   python bench_source_store.py                      用產生的 Tavily response (一般的 / include_raw_content)
+#   python bench_source_store.py --recording run.json 重播錄下來的 run: [{"query": ..., "response": {...}}, ...]
+
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from source_store import SourceStore
+from tool_compaction import compact_search_output
+
+WORDS = ("台積電", "財報", "營收", "半導體", "semiconductor", "revenue", "quarter", "growth", "market", "analysis",
+         "the", "of", "and", "先進製程", "毛利率")
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def synthetic_run(searches: int = 8, results: int = 5, content_chars: int = 1500, raw_content_chars: int = 0,
+                  seed: int = 1) -> list[dict]:
+    """A multi-search run shaped like Tavily responses; some results repeat across queries like real searches do."""
+    rng = random.Random(seed)
+    pages = [{"title": f"Page {i}", "url": f"https://example.com/article/{i}", "content": _text(rng, content_chars),
+              "raw_content": _text(rng, raw_content_chars) if raw_content_chars else None}
+             for i in range(searches * results)]
+    run = []
+    for i in range(searches):
+        query = f"台積電 財報 問題 {i}"
+        picked = rng.sample(pages, results)
+        response = {
+            "query": query, "answer": None, "images": [], "follow_up_questions": None, "response_time": 1.2,
+            "results": [{**page, "score": round(rng.random(), 3)} for page in picked],
+        }
+        run.append({"query": query, "response": response})
+    return run
+
+
+def replay(run: list[dict], compact_store: bool) -> tuple[int, int]:
+    """(peak bytes during the run, bytes still held by search_source at the end)."""
+    payloads = [(item["query"], json.dumps(item["response"], ensure_ascii=False).encode()) for item in run]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        search_source = SourceStore() if compact_store else {}
+        outputs = []  # 給 model 的 tool outputs 兩邊一樣
+        for query, payload in payloads:
+            response = json.loads(payload)  # tavily client parse
+            outputs.append(compact_search_output("web_search", response["results"], "").text)
+            if compact_store:
+                search_source.add(query, response)
+            else:
+                search_source[query] = response
+            del response
+        gc.collect()
+        before_drop, peak = tracemalloc.get_traced_memory()
+        del search_source
+        gc.collect()
+        after_drop, _ = tracemalloc.get_traced_memory()
+        return peak, before_drop - after_drop
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recording", help="JSON list of {query, response} from a real run")
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, encoding="utf-8") as f:
+            scenarios = {args.recording: json.load(f)}
+    else:
+        scenarios = {
+            "8 searches x 5 results (default Tavily)": synthetic_run(),
+            "8 searches x 5 results (include_raw_content, ~30 KB/page)": synthetic_run(raw_content_chars=30_000),
+        }
+
+    compact_search_output("web_search", [], "")  # 先載入 tokenizer，不算進第一次重播
+
+    for name, run in scenarios.items():
+        raw_size = sum(len(json.dumps(item["response"], ensure_ascii=False).encode()) for item in run)
+        print(f"\n== {name}: {len(run)} searches, {raw_size / 1024:.0f} KB of Tavily JSON")
+        print(f"   {'':<22}{'peak KB':>10}{'held KB':>10}")
+        for label, compact in (("dict of responses", False), ("SourceStore", True)):
+            peak, held = replay(run, compact)
+            print(f"   {label:<22}{peak / 1024:>10.0f}{held / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Benchmark: 冷啟動時間
+#
+#   1. python -X importtime -c "import main": import main 的總時間，以及累計最久的模組 (跑幾次取中位數)
+#   2. 啟動 uvicorn main:app: 從 spawn 到第一個 HTTP 回應 (開始接連線)，以及到 /readyz 回 200 (背景 warm-up 完成)
+#
+# 用法: python bench_startup.py [次數] [--top N]
+
+import argparse
+import asyncio
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile() -> tuple[float, dict[str, float]]:
+    """One `import main` in a fresh interpreter: (total seconds, {top-level package: cumulative seconds})."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=HERE, capture_output=True, text=True, env={**os.environ, "LOG_LEVEL": "WARNING"})
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    # importtime 先印子模組再印父模組: " main" 之前、上一個最外層模組之後，縮排一層的就是 main 直接 import 的
+    total = 0.0
+    packages: dict[str, float] = {}
+    children: dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_us, depth, module = int(match.group(2)), (len(match.group(3)) - 1) // 2, match.group(4)
+        if depth == 1:
+            children[module] = children.get(module, 0) + cumulative_us / 1e6
+        elif depth == 0:
+            if module == "main":
+                total, packages = cumulative_us / 1e6, children
+            children = {}
+    return total, packages
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def server_startup(timeout: float = 60) -> tuple[float, float | None]:
+    """Spawn uvicorn: (seconds to first response, seconds to /readyz 200)."""
+    port = free_port()
+    env = {**os.environ, "LOG_LEVEL": "WARNING", "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "bench"),
+           "TAVILY_API_KEY": os.environ.get("TAVILY_API_KEY", "bench"), "OPENAI_AGENTS_DISABLE_TRACING": "1"}
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=HERE, env=env)
+    first_response = ready = None
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            while time.perf_counter() - start < timeout and server.poll() is None:
+                try:
+                    response = await client.get("/readyz", timeout=1)
+                    first_response = first_response or time.perf_counter() - start
+                    if response.status_code == 200:
+                        ready = time.perf_counter() - start
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.02)
+    finally:
+        server.terminate()
+        server.wait()
+    if first_response is None:
+        raise RuntimeError("server did not start")
+    return first_response, ready
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("runs", type=int, nargs="?", default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    totals, per_package = [], {}
+    for _ in range(args.runs):
+        total, packages = import_profile()
+        totals.append(total)
+        for name, seconds in packages.items():
+            per_package.setdefault(name, []).append(seconds)
+
+    print(f"import main: median {statistics.median(totals) * 1000:.0f} ms  (min {min(totals) * 1000:.0f}, max {max(totals) * 1000:.0f}, {args.runs} runs)")
+    print(f"\ntop {args.top} imports (cumulative, median):")
+    top = sorted(((statistics.median(v), k) for k, v in per_package.items()), reverse=True)[:args.top]
+    for seconds, name in top:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    loaded = subprocess.run([sys.executable, "-c", "import main, sys; print(' '.join(m for m in "
+                             "('agents', 'openai', 'ag_ui', 'tavily', 'aiohttp', 'tiktoken') if m in sys.modules))"],
+                            cwd=HERE, capture_output=True, text=True, env={**os.environ, "LOG_LEVEL": "WARNING"}).stdout.strip()
+    print(f"\nheavy packages loaded by `import main`: {loaded or '(none)'}")
+
+    results = [asyncio.run(server_startup()) for _ in range(args.runs)]
+    first = statistics.median(r[0] for r in results)
+    ready = [r[1] for r in results if r[1] is not None]
+    print(f"\nuvicorn main:app  spawn -> first response: {first * 1000:.0f} ms", end="")
+    print(f"   spawn -> /readyz 200: {statistics.median(ready) * 1000:.0f} ms" if ready else "   /readyz never returned 200")
+
+
+if __name__ == "__main__":
+    main()
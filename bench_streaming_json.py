@@ -0,0 +1,95 @@
+# Microbenchmark: 每個 delta 重新 parse 整個 json_str (jiter) vs 增量 parser (StreamingJSONParser)
+#
+# 用法: python bench_streaming_json.py [token 數量 ...]
+# 預設比較 2k / 10k / 50k tokens 的 QueryResult 輸出
+
+import json
+import random
+import sys
+import time
+
+import jiter
+
+from streaming_json import StreamingJSONParser
+
+CHARS_PER_TOKEN = 4  # 粗略估計，模擬 output_text.delta 的大小
+
+
+def make_deltas(num_tokens: int) -> list[str]:
+    random.seed(num_tokens)
+    words = ["台積電", "營收", "AI", "晶片", "需求", "成長", "the", "model", "context", "window", "，", "。", "\n"]
+    content = ""
+    while len(content) < num_tokens * CHARS_PER_TOKEN:
+        content += random.choice(words)
+    doc = json.dumps({
+        "content": content,
+        "following_questions": ["問題一是什麼?", "問題二是什麼?", "問題三是什麼?"],
+    }, ensure_ascii=False)
+
+    deltas = []
+    i = 0
+    while i < len(doc):
+        size = random.randint(1, CHARS_PER_TOKEN * 2)
+        deltas.append(doc[i:i + size])
+        i += size
+    return deltas
+
+
+def reparse_per_delta(deltas: list[str]) -> int:
+    """原本 main.py 的寫法"""
+    json_str = ''
+    previous_content = ''
+    frames = 0
+    for delta in deltas:
+        json_str += delta
+        try:
+            result = jiter.from_json(json_str.encode('utf-8'), partial_mode="trailing-strings")
+            if "content" in result:
+                current_content = result["content"]
+                if current_content != previous_content:
+                    result["content"] = current_content[len(previous_content):]
+                    previous_content = current_content
+                else:
+                    result["content"] = ''
+            json.dumps(result)
+            frames += 1
+        except ValueError:
+            pass
+    return frames
+
+
+def incremental(deltas: list[str]) -> int:
+    """增量 parser，只輸出有變動的欄位 (不 import main 以免載入 FastAPI app)"""
+    parser = StreamingJSONParser()
+    frames = 0
+    for delta in deltas:
+        update = {}
+        for kind, path, value in parser.feed(delta):
+            if kind == "append" and path == ("content",):
+                update["content"] = update.get("content", "") + value
+            elif kind == "done" and len(path) == 2 and path[0] == "following_questions":
+                update["following_questions"] = list(parser.root["following_questions"])
+        if update:
+            json.dumps(update)
+            frames += 1
+    return frames
+
+
+def bench(fn, deltas, repeat=3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(deltas)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [2_000, 10_000, 50_000]
+
+    print(f"{'tokens':>8} {'deltas':>8} {'reparse (s)':>12} {'incremental (s)':>16} {'speedup':>8}")
+    for num_tokens in sizes:
+        deltas = make_deltas(num_tokens)
+        old = bench(reparse_per_delta, deltas, repeat=1 if num_tokens >= 50_000 else 3)
+        new = bench(incremental, deltas)
+        print(f"{num_tokens:>8} {len(deltas):>8} {old:>12.4f} {new:>16.4f} {old / new:>7.1f}x")
@@ -0,0 +1,121 @@
+# Benchmark: CustomSQLiteSession.get_items 每一輪算 session tokens 的成本，每次重新 encode vs utils.py 的 token cache
+#
+# 模擬一段越來越長的對話 (user / reasoning 摘要 / function_call / function_call_output / assistant)，
+# 每一輪和 get_items 一樣對整個 history 呼叫 num_tokens_for_tools(tools, items)。不會呼叫 OpenAI API。
+#
+# 用法: python bench_token_counting.py [history 的 items 數，預設 500]
+#
+# 需要 tiktoken 的 encoding (離線請先放進 TIKTOKEN_CACHE_DIR)；載入不了時改用本地建的 byte-level BPE，
+# 絕對時間會比 o200k_base 快，但 cache 省下的比例一樣有參考價值。
+
+import random
+import sys
+import time
+
+import tiktoken
+
+import utils
+
+WORDS = ("台積電", "財報", "營收", "半導體", "先進製程", "毛利率", "semiconductor", "revenue", "quarter", "growth",
+         "market", "analysis", "the", "of", "and", "to", "in", "is", "that", "for")
+
+TOOLS = [{
+    "type": "function", "name": "web_search", "description": "Call this tool to search the web",
+    "parameters": {"type": "object", "properties": {"query": {"type": "string", "description": "search query"}},
+                   "required": ["query"]},
+}]
+
+
+def local_encoding() -> tiktoken.Encoding:
+    """Byte-level BPE with the bench words as merges, for when the real encoding can't be downloaded."""
+    ranks = {bytes([i]): i for i in range(256)}
+    for word in WORDS:
+        for text in (word, " " + word):
+            data = text.encode()
+            for end in range(2, len(data) + 1):
+                ranks.setdefault(data[:end], len(ranks))
+    pat_str = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+    return tiktoken.Encoding("bench_bpe", pat_str=pat_str, mergeable_ranks=ranks, special_tokens={})
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def synthetic_history(items: int, seed: int = 1) -> list[dict]:
+    """Session items shaped like agents SDK input items; a tool-using turn is 5 items."""
+    rng = random.Random(seed)
+    history = []
+    turn = 0
+    while len(history) < items:
+        call_id = f"call_{turn}"
+        history += [
+            {"role": "user", "content": _text(rng, 30)},
+            {"type": "reasoning", "id": f"rs_{turn}", "summary": [{"type": "summary_text", "text": _text(rng, 60)}]},
+            {"type": "function_call", "call_id": call_id, "name": "web_search", "arguments": f'{{"query": "{_text(rng, 4)}"}}'},
+            {"type": "function_call_output", "call_id": call_id, "output": _text(rng, 400)},
+            {"role": "assistant", "type": "message", "id": f"msg_{turn}", "status": "completed",
+             "content": [{"type": "output_text", "text": _text(rng, 200), "annotations": []}]},
+        ]
+        turn += 1
+    return history[:items]
+
+
+def timed(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    try:
+        encoding = utils.get_encoding("gpt-5")
+    except Exception as e:
+        print(f"tiktoken encoding unavailable ({type(e).__name__}), using a local byte-level BPE")
+        encoding = local_encoding()
+        utils.get_encoding = lambda model="gpt-5": encoding
+    history = synthetic_history(items)
+    print(f"encoding {encoding.name}, history of {items} items")
+
+    # 一次 get_items: 冷的 cache vs 上一輪算過、只多了新的一輪 (5 items)
+    uncached = timed(lambda: utils.num_tokens_for_tools(TOOLS, history, cache=None))
+    utils.token_cache.clear()
+    cold = timed(lambda: (utils.token_cache.clear(), utils.num_tokens_for_tools(TOOLS, history)), repeat=1)
+    utils.num_tokens_for_tools(TOOLS, history[:-5])
+    warm = timed(lambda: utils.num_tokens_for_tools(TOOLS, history))
+    assert utils.num_tokens_for_tools(TOOLS, history) == utils.num_tokens_for_tools(TOOLS, history, cache=None)
+
+    print(f"\n== one get_items over {items} items")
+    print(f"   re-encode everything          {uncached * 1000:>9.2f} ms")
+    print(f"   cache, cold                   {cold * 1000:>9.2f} ms")
+    print(f"   cache, previous turn counted  {warm * 1000:>9.2f} ms   ({uncached / warm:.0f}x)")
+
+    # 整段對話: 每一輪加 5 個 items，每一輪都對整個 history 算一次
+    def conversation(cache):
+        for end in range(5, items + 1, 5):
+            utils.num_tokens_for_tools(TOOLS, history[:end], cache=cache)
+
+    utils.token_cache.clear()
+    old = timed(lambda: conversation(None), repeat=1)
+    new = timed(lambda: (utils.token_cache.clear(), conversation(utils.token_cache)), repeat=1)
+    print(f"\n== a conversation growing to {items} items ({items // 5} turns, counted every turn)")
+    print(f"   re-encode everything          {old * 1000:>9.1f} ms")
+    print(f"   token cache                   {new * 1000:>9.1f} ms   ({old / new:.0f}x)")
+
+    # encoding_for_model() 每次呼叫的成本 (原本每個 function 每次都呼叫一次)
+    try:
+        tiktoken.encoding_for_model("gpt-5")
+    except Exception:
+        print("\n== encoding_for_model() per call: n/a (encoding can't be loaded here)")
+    else:
+        lookup = timed(lambda: [tiktoken.encoding_for_model("gpt-5") for _ in range(1000)]) / 1000
+        memoized = timed(lambda: [utils.get_encoding("gpt-5") for _ in range(1000)]) / 1000
+        print(f"\n== encoding lookup per call: encoding_for_model() {lookup * 1e6:.1f} us, get_encoding() {memoized * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# v2 的對話狀態 (hybrid): 接著 OpenAI 存的 response (previous_response_id)，本地 session 當作完整的紀錄
+#
+# 原本 /api/v2/agent_stream 每一輪都從 CustomSQLiteSession 讀出整個對話、用 tiktoken 算 tokens (必要時 trim)，
+# 再把全部 items 重新上傳給 OpenAI，對話越長每一輪上傳的 bytes 和本地 tokenize 的時間就越多。
+# V2_CONVERSATION_STATE=hybrid (預設) 時每一輪先決定怎麼帶前文:
+#
+#   chained  chain 還有效: 只送這一輪的問題 + previous_response_id (和 v1 一樣)，不讀 session、不 tokenize
+#   replay   原本的做法: session 的 items (trim 過，見 custom_sqlite_session.py) + 這一輪的問題，跑完從這一輪的 response 開始新的 chain
+#
+# 改用 replay 的原因 (/metrics 的 conversation_turns_total{reason}):
+#   no_chain    thread 還沒有 chain (新的對話，或是之前用 session 模式)
+#   reset       上一輪寫入 session 之後沒辦法更新 chain，不確定兩邊是否一致
+#   max_turns   chain 已經接了 V2_CHAIN_MAX_TURNS 輪 (OpenAI 那邊的 context 沒有經過我們的 trim)
+#   max_tokens  上一輪的 input tokens 超過 V2_CHAIN_MAX_INPUT_TOKENS，交給 session 的 trim 處理
+#   expired     上一個 response 超過 V2_CHAIN_MAX_AGE_SECONDS (OpenAI 的 response 只保存一段時間)
+#   rejected    OpenAI 說 previous_response_id 找不到 / 不能用 (還沒送出任何 frame，直接改用 replay 重跑)
+#
+# 不管哪一種，跑完之後這一輪的 items 都由這裡寫進 session (Runner 不再拿 session)，session 永遠是完整的紀錄；
+# 被取消或失敗的一輪不寫 session 也不動 chain，下一輪還是接著上一個完成的 response。
+# V2_CONVERSATION_STATE=session 每一輪都 replay (原本的行為)。chain 存在 CONVERSATIONS_DB 的 response_chains table。
+# GET /api/conversation_state/stats 是 chained / replay 的輪數、原因，以及上傳的 input bytes。
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+from stream_metrics import metrics
+from structured_logging import get_logger
+
+logger = get_logger("conversation_state")
+
+V2_CONVERSATION_STATE = os.environ.get("V2_CONVERSATION_STATE", "hybrid").lower()  # hybrid / session
+V2_CHAIN_MAX_TURNS = int(os.environ.get("V2_CHAIN_MAX_TURNS", "20"))
+V2_CHAIN_MAX_INPUT_TOKENS = int(os.environ.get("V2_CHAIN_MAX_INPUT_TOKENS", "100000"))
+V2_CHAIN_MAX_AGE_SECONDS = float(os.environ.get("V2_CHAIN_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+CHAINED, REPLAY = "chained", "replay"
+
+conversation_turns = metrics.counter("conversation_turns_total", "v2 turns by how the history was sent.", ("mode", "reason"))
+conversation_input_bytes = metrics.counter("conversation_input_bytes_total", "JSON bytes of the run input sent for v2 turns.", ("mode",))
+
+
+@dataclass(frozen=True)
+class TurnPlan:
+    mode: str
+    reason: str
+    previous_response_id: str | None = None
+    chain_turns: int = 0  # 這一輪之前 chain 已經接了幾輪
+
+
+class ChainStore:
+    """thread_id -> the last completed response of its chain (sync; ConversationState calls it in a thread)."""
+
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS response_chains (
+                thread_id TEXT PRIMARY KEY, response_id TEXT, turns INTEGER NOT NULL, input_tokens INTEGER NOT NULL,
+                updated_at REAL NOT NULL)""")
+
+    def get(self, thread_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM response_chains WHERE thread_id = ?", (thread_id,)).fetchone()
+        return dict(row) if row else None
+
+    def set(self, thread_id: str, response_id: str | None, turns: int, input_tokens: int):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO response_chains VALUES (?, ?, ?, ?, ?)",
+                               (thread_id, response_id, turns, input_tokens, time.time()))
+
+
+def user_message(query: str) -> dict:
+    return {"role": "user", "content": query}
+
+
+def chain_rejected(error: Exception) -> bool:
+    """OpenAI refused the previous_response_id (expired, deleted, from another project / store=false)."""
+    import openai
+
+    return (isinstance(error, openai.APIStatusError) and error.status_code in (400, 404)
+            and "previous" in str(error).lower())
+
+
+class ConversationState:
+    def __init__(self, db_path: str, mode: str = V2_CONVERSATION_STATE):
+        self.db_path = db_path
+        self.mode = mode
+        self._store: ChainStore | None = None
+
+    @property
+    def store(self) -> ChainStore:
+        if self._store is None:
+            self._store = ChainStore(self.db_path)
+        return self._store
+
+    async def plan(self, thread_id: str) -> TurnPlan:
+        """Chain on the thread's last response when it is still usable, otherwise replay the local session."""
+        if self.mode != "hybrid":
+            return TurnPlan(REPLAY, "session_mode")
+        chain = await asyncio.to_thread(self.store.get, thread_id)
+        if chain is None:
+            return TurnPlan(REPLAY, "no_chain")
+        if chain["response_id"] is None:
+            return TurnPlan(REPLAY, "reset")
+        if chain["turns"] >= V2_CHAIN_MAX_TURNS:
+            return TurnPlan(REPLAY, "max_turns")
+        if chain["input_tokens"] > V2_CHAIN_MAX_INPUT_TOKENS:
+            return TurnPlan(REPLAY, "max_tokens")
+        if time.time() - chain["updated_at"] > V2_CHAIN_MAX_AGE_SECONDS:
+            return TurnPlan(REPLAY, "expired")
+        return TurnPlan(CHAINED, "chain", chain["response_id"], chain["turns"])
+
+    def started(self, thread_id: str, turn: TurnPlan, run_input: str | list):
+        size = len(json.dumps(run_input, ensure_ascii=False, default=str).encode())
+        conversation_turns.inc((turn.mode, turn.reason))
+        conversation_input_bytes.inc((turn.mode,), size)
+        logger.info("conversation turn", extra={"thread_id": thread_id, "mode": turn.mode, "reason": turn.reason,
+                                                "chain_turns": turn.chain_turns, "input_bytes": size})
+
+    async def commit(self, session, thread_id: str, turn: TurnPlan, query: str, result):
+        """Append the finished turn to the session, then move the chain to this turn's response."""
+        items = [user_message(query)] + [item.to_input_item() for item in result.new_items]
+        await session.add_items(items)
+        if self.mode != "hybrid":
+            return
+        # 一輪有 tool call 時是好幾次 model 呼叫的加總，寧可早一點改回 replay
+        input_tokens = result.context_wrapper.usage.input_tokens or 0
+        turns = turn.chain_turns + 1 if turn.mode == CHAINED else 1
+        try:
+            await asyncio.to_thread(self.store.set, thread_id, result.last_response_id, turns, input_tokens)
+        except Exception:
+            logger.exception("could not update the response chain", extra={"thread_id": thread_id})
+            await asyncio.to_thread(self.store.set, thread_id, None, 0, 0)
+
+
+def conversation_state_stats() -> dict:
+    stats = {"mode": V2_CONVERSATION_STATE, "turns": {}, "input_bytes": {}}
+    for (mode, reason), count in conversation_turns.items():
+        stats["turns"].setdefault(mode, {})[reason] = int(count)
+    for (mode,), size in conversation_input_bytes.items():
+        turns = sum(stats["turns"].get(mode, {}).values())
+        stats["input_bytes"][mode] = {"total": int(size), "per_turn": round(size / turns) if turns else 0}
+    return stats
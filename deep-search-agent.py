@@ -1,15 +1,15 @@
 import os
 import json
-import aiohttp
 from pydantic import BaseModel, Field
 
-from agents import Agent, Runner, function_tool
+from agents import Agent, Runner, function_tool, set_default_openai_client
 
-from tavily import AsyncTavilyClient
+from http_clients import openai_client, tavily_client as pooled_tavily_client, jina_session, close_http_clients
 
 TAVILY_API_KEY = os.environ.get("TAVILY_API_KEY")
 JINA_API_KEY = os.environ.get("JINA_API_KEY")
-tavily_client = AsyncTavilyClient(api_key=TAVILY_API_KEY)
+tavily_client = pooled_tavily_client(api_key=TAVILY_API_KEY)
+set_default_openai_client(openai_client())
 
 @function_tool
 async def perform_web_search(query: str):
@@ -31,14 +31,13 @@ async def fetch_webpage_text(url: str):
         "Authorization": f"Bearer {JINA_API_KEY}"
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(full_url, headers=headers) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    text = await resp.text()
-                    print(f"Jina fetch error for {url}: {resp.status} - {text}")
-                    return ""
+        async with jina_session().get(full_url, headers=headers) as resp:
+            if resp.status == 200:
+                return await resp.text()
+            else:
+                text = await resp.text()
+                print(f"Jina fetch error for {url}: {resp.status} - {text}")
+                return ""
     except Exception as e:
         print(f"從 Jina 獲取網頁內容時發生錯誤：{e}")
         return "fetch error, please ignore this reference"
@@ -124,7 +123,14 @@ if __name__ == "__main__":
         
     user_query = " ".join(sys.argv[1:])
 
-    result = asyncio.run(run_deep_search(user_query))
+    async def main():
+        # 共用的連線池是整個 process 的 (http_clients.py)，只在 process 結束前關閉
+        try:
+            return await run_deep_search(user_query)
+        finally:
+            await close_http_clients()
+
+    result = asyncio.run(main())
 
     print("------- 主要參考網址 -------")
     print(result.references)
@@ -0,0 +1,151 @@
+# 共用的 HTTP client: OpenAI、Tavily、Jina 在整個 process 裡各用一個有 keep-alive 連線池的 client
+#
+# 原本研究腳本每抓一個 Jina 網頁就開一個新的 aiohttp.ClientSession()，每次都要重新 DNS + TCP + TLS handshake；
+# main.py 的 AsyncOpenAI() / AsyncTavilyClient() 也各自用預設的連線上限。這裡集中設定:
+#   - keep-alive 連線池大小與閒置多久關閉
+#   - 每個 host 的連線上限 (httpx 的 client 本來就只連一個 host，aiohttp 用 limit_per_host)
+#   - connect / read timeout
+#   - 有安裝 h2 時 OpenAI、Tavily 走 HTTP/2 (同一條連線多工，少開連線)
+#
+#   openai = openai_client()                  AsyncOpenAI，也可以 set_default_openai_client() 給 Agents SDK 用
+#   openai = default_openai_client()          整個 process 共用的那一個 AsyncOpenAI (第一次呼叫時建立)
+#   tavily = tavily_client()                  AsyncTavilyClient
+#   session = jina_session()                  共用的 aiohttp.ClientSession (要在 event loop 裡呼叫)
+#   await preconnect()                        先和每個 host 建好連線 (啟動 warm-up 用)
+#   await close_http_clients()                程式結束前關閉
+#
+# openai / tavily / aiohttp 都在第一次用到時才 import，import 這個模組本身很快 (見 warmup.py)。
+
+import asyncio
+import importlib.util
+import os
+
+import httpx
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))  # 每個 client (= 每個 host) 的連線上限
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "50"))  # 閒置時保留幾條連線
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))  # 閒置連線保留幾秒
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "600"))  # 串流時是兩個 chunk 之間最多等多久
+HTTP2 = os.environ.get("HTTP2", "auto")  # auto: 有安裝 h2 就用，1: 一定要用，0: 不用
+
+JINA_TIMEOUT = float(os.environ.get("JINA_TIMEOUT", "60"))
+
+
+def http2_enabled() -> bool:
+    if HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return HTTP2 == "1"
+
+
+def httpx_options(limits_type=httpx.Limits, timeout_type=httpx.Timeout) -> dict:
+    """Keyword arguments for an httpx.AsyncClient with the shared pool settings."""
+    return {
+        "limits": limits_type(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": timeout_type(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "http2": http2_enabled(),
+    }
+
+
+_httpx_clients: list[tuple] = []  # (client, base url)
+_default_openai = None
+_jina_session = None
+_jina_loop = None
+
+
+def openai_client(**kwargs):
+    import openai
+
+    # 用 openai 自己的 Limits / Timeout 型別 (openai 內建的 httpx 版本不一定和這裡 import 的相同)
+    http_client = openai.DefaultAsyncHttpxClient(**httpx_options(type(openai.DEFAULT_CONNECTION_LIMITS), openai.Timeout))
+    client = openai.AsyncOpenAI(http_client=http_client, **kwargs)
+    _httpx_clients.append((http_client, str(client.base_url)))
+    return client
+
+
+def default_openai_client():
+    """The process-wide AsyncOpenAI, created on first use."""
+    global _default_openai
+    if _default_openai is None:
+        _default_openai = openai_client()
+    return _default_openai
+
+
+def tavily_client(api_key: str | None = None, **kwargs):
+    from tavily import AsyncTavilyClient
+
+    # TAVILY_API_BASE_URL 可以指向 mock_upstream.py 做壓測
+    base_url = kwargs.pop("api_base_url", None) or os.environ.get("TAVILY_API_BASE_URL") or "https://api.tavily.com"
+    http_client = httpx.AsyncClient(base_url=base_url, **httpx_options())
+    _httpx_clients.append((http_client, base_url))
+    return AsyncTavilyClient(api_key=api_key, api_base_url=base_url, client=http_client, **kwargs)
+
+
+def jina_session():
+    """Shared aiohttp.ClientSession for Jina Reader fetches (created on first use in the running loop)."""
+    import aiohttp
+
+    global _jina_session, _jina_loop
+    loop = asyncio.get_running_loop()
+    if _jina_session is None or _jina_session.closed or _jina_loop is not loop:
+        _release_jina_session()
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_KEEPALIVE,
+            keepalive_timeout=HTTP_KEEPALIVE_EXPIRY,
+            ttl_dns_cache=300,
+        )
+        _jina_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=JINA_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        _jina_loop = loop
+    return _jina_session
+
+
+def _release_jina_session():
+    """Close the session that belongs to another event loop (e.g. a previous asyncio.run()) before replacing it."""
+    if _jina_session is None or _jina_session.closed:
+        return
+    if _jina_loop.is_closed():
+        # 舊的 loop 已經關了，沒辦法再 await close()，只把 session 標成已關閉
+        _jina_session.detach()
+    else:
+        # 連線屬於舊的 loop，要在那個 loop 裡關
+        asyncio.run_coroutine_threadsafe(_jina_session.close(), _jina_loop)
+
+
+def pooled_clients() -> list[tuple]:
+    """(httpx client, base url) for every pooled client created so far, e.g. to pre-connect at startup."""
+    return list(_httpx_clients)
+
+
+async def preconnect(timeout: float = 5):
+    """Open one keep-alive connection (TLS handshake included) to every pooled client's host; any HTTP status is fine."""
+    async def one(client, url):
+        try:
+            await client.head(url, timeout=timeout)
+        except Exception as e:
+            return f"{url}: {e!r}"
+
+    errors = [e for e in await asyncio.gather(*(one(c, url) for c, url in _httpx_clients)) if e]
+    if errors:
+        raise ConnectionError("; ".join(errors))
+
+
+async def close_http_clients():
+    global _jina_session, _default_openai
+    for client, _ in _httpx_clients:
+        await client.aclose()
+    _httpx_clients.clear()
+    _default_openai = None
+    if _jina_session is not None:
+        if _jina_loop is asyncio.get_running_loop():
+            await _jina_session.close()
+        else:
+            _release_jina_session()
+        _jina_session = None
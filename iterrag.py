@@ -27,12 +27,14 @@ def perform_tavily_search(query):
   return contexts
 
 def format_prompt(query: str, documents: List[str], conversation_history: List[Dict] = None) -> str:
-    # 添加當前問題及上下文
-    prompt = "## Context:\n"
+    # 每一輪的 prompt 只在後面多出新的內容 (prompt cache 才會命中前面的部分，見 prompt_cache.py):
+    # 不變的問題放最前面，再來是只會往後加的文件，最後是對話歷史
+    prompt = f"User Question: {query}\n\n"
+
+    prompt += "## Context:\n"
     for i, doc in enumerate(documents):
         prompt += f"<chunk>{doc}</chunk>\n"
-    
-    prompt += f"\nUser Question: {query}\n\n"
+    prompt += "\n"
 
     # 如果有對話歷史，添加到提示詞中
     if conversation_history and len(conversation_history) > 0:
@@ -124,7 +126,7 @@ def iterative_rag(query: str, max_iterations: int, num_documents: int) -> Dict:
             # 檢索子問題的文檔
             sub_documents = perform_tavily_search(sub_query)[:num_documents]
             documents.extend(sub_documents)
-            documents = list(set(documents))
+            documents = list(dict.fromkeys(documents))  # 去重但保留順序 (set 每次順序不同，prompt 前綴就對不上)
             result["documents"] = documents
             
         elif parsed_response.type == "intermediate_answer":
@@ -0,0 +1,312 @@
+# 背景 job: 很久的 agent run (研究型的問題) 不綁在一條 HTTP 連線上
+#
+# /api/v2/agent_stream 遇到要查很多資料的問題可能跑好幾分鐘，常常被 proxy 的 timeout 切斷。改成:
+#
+#   POST /api/jobs                   {"query": ..., "thread_id": ...} -> 202 {"job_id": ...}，放進佇列
+#   GET  /api/jobs/{id}              狀態 (queued / running / succeeded / failed / cancelled)、結果、錯誤
+#   GET  /api/jobs/{id}/stream       SSE: 先補送已經產生的事件，還在跑就接著收即時的 (支援 Last-Event-ID)
+#   POST /api/jobs/{id}/cancel       取消 (排隊中直接取消，跑到一半會停掉 agent run)
+#
+# job 由 server 裡固定數量的 worker (JOB_WORKERS) 執行，同時最多只有這麼多個 job 在跑，
+# 佇列滿了 (JOB_QUEUE_SIZE) 回 503，重的 job 不會和互動的聊天搶 upstream 的額度。
+#
+# 狀態和送出的事件存在 SQLite (JOBS_DB)，事件每 JOB_EVENT_FLUSH_SECONDS 批次寫入一次。
+# 跑的過程中事件也放在 ResumableRun (見 resumable_stream.py) 即時廣播，job 跑完或 server 重啟後從 SQLite 重播。
+# server 重啟時還在排隊的 job 會重新排隊，跑到一半的標成 failed (agent run 無法接續)。
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable
+
+from admission import AdmissionRejected
+from resumable_stream import ResumableRunRegistry, format_event_id, with_event_id
+from structured_logging import get_logger
+
+logger = get_logger("jobs")
+
+JOBS_DB = os.environ.get("JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))  # 同時最多跑幾個 job
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "100"))  # 最多幾個 job 排隊
+JOB_EVENT_FLUSH_SECONDS = float(os.environ.get("JOB_EVENT_FLUSH_SECONDS", "0.5"))
+JOB_RETRY_AFTER = int(os.environ.get("JOB_RETRY_AFTER", "30"))  # 秒
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobStore:
+    """SQLite persistence for job state and emitted SSE events (sync; JobManager calls it in a thread)."""
+
+    def __init__(self, db_path: str = JOBS_DB):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL,
+                result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS job_events (
+                job_id TEXT NOT NULL, seq INTEGER NOT NULL, chunk TEXT NOT NULL, PRIMARY KEY (job_id, seq))""")
+
+    def create(self, job_id: str, kind: str, params: dict):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs (id, kind, params, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (job_id, kind, json.dumps(params, ensure_ascii=False), QUEUED, time.time()))
+
+    def update(self, job_id: str, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def transition(self, job_id: str, from_status: str, **fields) -> bool:
+        """Update the job only if it is still in `from_status`; False when someone else changed it first."""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ? AND status = ?",
+                                        (*fields.values(), job_id, from_status))
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            events = self._conn.execute("SELECT COUNT(*) FROM job_events WHERE job_id = ?", (job_id,)).fetchone()[0]
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["events"] = events
+        return job
+
+    def append_events(self, job_id: str, events: list[tuple[int, str]]):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO job_events (job_id, seq, chunk) VALUES (?, ?, ?)",
+                                   [(job_id, seq, chunk) for seq, chunk in events])
+
+    def events(self, job_id: str, after: int = -1) -> list[tuple[int, str]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, chunk FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                                      (job_id, after)).fetchall()
+        return [(row["seq"], row["chunk"]) for row in rows]
+
+    def recover(self) -> list[str]:
+        """After a restart: fail jobs that were running, return the ids still queued (oldest first)."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status = ?",
+                               (FAILED, "server restarted while the job was running", time.time(), RUNNING))
+            rows = self._conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)).fetchall()
+        return [row["id"] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class Job:
+    """What a job handler gets: its params, and a place to put the final result."""
+    job_id: str
+    kind: str
+    params: dict
+    result: dict | None = None
+    cancel_requested: bool = False
+    run: object = field(default=None, repr=False)  # 跑的過程中的 ResumableRun
+
+
+# handler(job) -> SSE chunks；結束前把最後的結果放進 job.result
+JobHandler = Callable[[Job], AsyncIterator[str]]
+
+
+class JobManager:
+    """Bounded worker pool running persisted background jobs whose events can be streamed later."""
+
+    def __init__(self, db_path: str = JOBS_DB, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE):
+        self.db_path = db_path
+        self.workers = workers
+        self.queue_size = queue_size
+        self.store: JobStore | None = None
+        self.handlers: dict[str, JobHandler] = {}
+        self.runs = ResumableRunRegistry()
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._running: dict[str, Job] = {}  # worker 拿到的 job (包括正要從 queued 改成 running 的)
+        self._started: dict[str, asyncio.Event] = {}  # 等排隊中的 job 開始跑的 stream
+        self.submitted = 0
+        self.rejected = 0
+
+    def register(self, kind: str, handler: JobHandler):
+        self.handlers[kind] = handler
+
+    async def start(self):
+        self.store = await asyncio.to_thread(JobStore, self.db_path)
+        queued = await asyncio.to_thread(self.store.recover)
+        self._queue = asyncio.Queue(max(self.queue_size, len(queued)))
+        for job_id in queued:
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        if queued:
+            logger.info("re-queued jobs after restart", extra={"jobs": len(queued)})
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.store is not None:
+            await asyncio.to_thread(self.store.close)
+            self.store = None
+
+    async def submit(self, kind: str, params: dict) -> str:
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        if self._queue.full():
+            self.rejected += 1
+            raise AdmissionRejected("jobs", "job queue full", retry_after=JOB_RETRY_AFTER)
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.create, job_id, kind, params)
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:  # 寫入 SQLite 的時候被其他 request 塞滿了
+            self.rejected += 1
+            await asyncio.to_thread(self.store.update, job_id, status=FAILED, error="job queue full", finished_at=time.time())
+            raise AdmissionRejected("jobs", "job queue full", retry_after=JOB_RETRY_AFTER)
+        self.submitted += 1
+        logger.info("job submitted", extra={"job_id": job_id, "kind": kind})
+        return job_id
+
+    async def get(self, job_id: str) -> dict | None:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def cancel(self, job_id: str) -> dict | None:
+        job = await self.get(job_id)
+        if job is None or job["status"] in FINISHED:
+            return job
+        # 還在排隊: 只有狀態還是 queued 才改成 cancelled，worker 之後也不會再把它改成 running
+        if job_id not in self._running and await asyncio.to_thread(
+                self.store.transition, job_id, QUEUED, status=CANCELLED, finished_at=time.time()):
+            self._wake(job_id)
+        else:
+            # worker 已經拿到這個 job (_run 在改狀態之前就先登記在 _running)
+            running = self._running.get(job_id)
+            if running is not None:
+                running.cancel_requested = True
+                if running.run is not None:
+                    running.run.task.cancel()  # 關掉 agent run 的 generator，cancel_when_closed 會停止 upstream
+        logger.info("job cancel requested", extra={"job_id": job_id, "status": job["status"]})
+        return await self.get(job_id)
+
+    async def events(self, job_id: str, after: int = -1) -> AsyncIterator[str]:
+        """SSE chunks (with `<job_id>:<seq>` ids) after seq `after`: stored events first, then live ones."""
+        run = self.runs.get(job_id)
+        while run is None:
+            # 還在排隊: 等 worker 開始跑 (或被取消)
+            status = (await self.get(job_id) or {}).get("status")
+            run = self.runs.get(job_id)
+            if run is not None or status not in (QUEUED, RUNNING):
+                break
+            await self._started.setdefault(job_id, asyncio.Event()).wait()
+            run = self.runs.get(job_id)
+        if run is None or not run.can_resume(after):
+            for seq, chunk in await asyncio.to_thread(self.store.events, job_id, after):
+                yield with_event_id(chunk, format_event_id(job_id, seq))
+                after = seq
+            run = self.runs.get(job_id)
+        if run is not None and run.can_resume(after):
+            async for chunk in run.subscribe(after):
+                yield chunk
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("job worker failed", extra={"job_id": job_id, "worker": index})
+            finally:
+                self._wake(job_id)
+
+    async def _run(self, job_id: str):
+        row = await self.get(job_id)
+        if row is None or row["status"] != QUEUED:
+            return
+        job = Job(job_id, row["kind"], row["params"])
+        error = None
+
+        async def persisted(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+            nonlocal error
+            pending, seq, flushed_at = [], 0, time.monotonic()
+            try:
+                async for chunk in chunks:
+                    pending.append((seq, chunk))
+                    seq += 1
+                    yield chunk
+                    if time.monotonic() - flushed_at >= JOB_EVENT_FLUSH_SECONDS:
+                        await asyncio.to_thread(self.store.append_events, job_id, pending)
+                        pending, flushed_at = [], time.monotonic()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                if pending:
+                    await asyncio.to_thread(self.store.append_events, job_id, pending)
+
+        # 先登記再改狀態: 這中間進來的 cancel 會看到 _running，設定 cancel_requested 而不是直接改 SQLite
+        self._running[job_id] = job
+        try:
+            started = await asyncio.to_thread(self.store.transition, job_id, QUEUED, status=RUNNING, started_at=time.time())
+        except BaseException:
+            del self._running[job_id]
+            raise
+        if not started:
+            del self._running[job_id]  # 排隊時已經被取消
+            return
+        logger.info("job started", extra={"job_id": job_id, "kind": job.kind})
+        try:
+            # 沒有 client 在看也要跑完 (不像互動的串流會在斷線後取消)
+            job.run = self.runs.start(persisted(self.handlers[job.kind](job)), job_id, cancel_when_idle=False)
+            if job.cancel_requested:
+                job.run.task.cancel()
+            self._wake(job_id)
+            await asyncio.shield(job.run.task)
+        except asyncio.CancelledError:
+            if job.run is not None:
+                job.run.task.cancel()  # server 關閉
+            error = "server shut down while the job was running"
+            raise
+        finally:
+            del self._running[job_id]
+            if job.cancel_requested:
+                status = CANCELLED
+            elif error is not None or job.result is None:
+                status = FAILED
+                error = error or "job finished without a result"
+            else:
+                status = SUCCEEDED
+            await asyncio.to_thread(self.store.update, job_id, status=status, result=job.result, error=error,
+                                    finished_at=time.time())
+            logger.info("job finished", extra={"job_id": job_id, "status": status})
+
+    def _wake(self, job_id: str):
+        event = self._started.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": len(self._running),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+        }
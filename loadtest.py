@@ -0,0 +1,430 @@
+# 離線壓測: 啟動 mock_upstream.py (假的 OpenAI / Tavily) 和 main.py，對各串流 endpoint 併發送 request
+#
+#   python loadtest.py --concurrency 20 --requests 100
+#   python loadtest.py --endpoints agent_stream,ag_ui --tokens-per-sec 100 --error-rate 0.05
+#   python loadtest.py --base-url http://127.0.0.1:8000 --server-pid 1234   壓已經在跑的 server
+#   python loadtest.py --endpoints agent_stream --router on   簡單的問題分到小 model (和 --router off 比較)
+#   python loadtest.py --endpoints agent_stream --queries unique --tool-call-tail-ms 300 --speculative   tool 提前執行 (和不加 --speculative 比較)
+#   python loadtest.py --endpoints agent_stream,agent_ws --turns 5   每個對話問 5 題: SSE 每題一個 request，WebSocket 一條連線 (ws_transport.py)
+#
+# 每個 endpoint 報告 (串流要收到最後的 DONE / [DONE] / RUN_FINISHED 才算成功，錯誤 frame 或中途斷掉都算錯誤):
+#   - TTFB: 送出 request 到收到第一個 byte
+#   - TTFT: 送出 request 到收到第一段內容 (文字 / structured output / TEXT_MESSAGE_CONTENT)
+#   - total: 整個串流結束
+#   - server 每個 stream 用掉的 CPU ms，以及 RSS 峰值 / 增量 (讀 /proc，只支援 Linux)
+#   - prompt cache 命中率: 這段期間的 input tokens 有多少是 cached_tokens (/api/prompt_cache/stats)
+#
+# 加上 --json 會輸出機器可讀的結果，方便在 CI 裡和上一次的數字比較。
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+QUERIES = ("What is the capital of France?", "Explain how SSE streaming works", "台灣最高的山是哪一座?",
+           "Compare Python and Go for web servers", "What is retrieval augmented generation?")
+
+
+def _ag_ui_body(query: str) -> dict:
+    return {
+        "threadId": str(uuid.uuid4()), "runId": str(uuid.uuid4()),
+        "messages": [{"id": str(uuid.uuid4()), "role": "user", "content": query}],
+        "state": {}, "tools": [], "context": [], "forwardedProps": {},
+    }
+
+
+# name: (method, path, build request kwargs from (query, conversation id), marker of the first content chunk,
+#        marker of the terminal success frame)
+ENDPOINTS = {
+    "completion_stream": ("GET", "/api/v1/completion_stream",
+                          lambda q, c: {"params": {"query": q, "cache": "false"}}, b"data: ", b"data: [DONE]"),
+    "completion_json_stream": ("GET", "/api/v1/completion_json_stream",
+                               lambda q, c: {"params": {"query": q}}, b'"/content"', b'"message":"DONE"'),
+    "agent_stream": ("GET", "/api/v1/agent_stream",
+                     lambda q, c: {"params": {"query": q}}, b'"/content"', b'"message":"DONE"'),
+    "agent_simple": ("GET", "/api/v1/agent_simple",
+                     lambda q, c: {"params": {"query": q}}, b'"output"', b'"last_response_id"'),
+    "agent_stream_v2": ("GET", "/api/v2/agent_stream",
+                        lambda q, c: {"params": {"query": q, "thread_id": f"loadtest_{c}"}}, b'"/content"', b'"message":"DONE"'),
+    "ag_ui": ("POST", "/api/ag-ui",
+              lambda q, c: {"json": _ag_ui_body(q), "headers": {"accept": "text/event-stream"}}, b"TEXT_MESSAGE_CONTENT",
+              b"RUN_FINISHED"),
+}
+
+# 串流中途失敗時 server 送的最後一個 frame (見 resumable_stream.py)
+ERROR_MARKERS = (b'"message":"ERROR"', b"RUN_ERROR")
+
+# name: (path, marker of the first content message)；一個對話的每一輪都走同一條 WebSocket
+WS_ENDPOINTS = {
+    "agent_ws": ("/api/v1/agent_ws", '"/content"'),
+    "agent_ws_v2": ("/api/v2/agent_ws", '"/content"'),
+}
+
+
+def endpoint_path(name: str) -> str:
+    return WS_ENDPOINTS[name][0] if name in WS_ENDPOINTS else ENDPOINTS[name][1]
+
+
+## 量測
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def process_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime, stime 是 stat 的第 14、15 個欄位 (")" 之後從第 3 個欄位開始算)
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def process_rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def sample_rss(pid: int, peak: list, interval: float = 0.1):
+    while True:
+        peak[0] = max(peak[0], process_rss_mb(pid))
+        await asyncio.sleep(interval)
+
+
+async def one_request(client: httpx.AsyncClient, name: str, query: str, conversation: str | None = None) -> dict:
+    """One request; status is 200 only when the stream ended with its success frame (DONE / [DONE] / RUN_FINISHED)."""
+    method, path, build, marker, end_marker = ENDPOINTS[name]
+    start = time.perf_counter()
+    ttfb = ttft = None
+    size = 0
+    finished = errored = False
+    tail = b""
+    try:
+        async with client.stream(method, path, **build(query, conversation or uuid.uuid4().hex)) as response:
+            async for chunk in response.aiter_bytes():
+                now = time.perf_counter()
+                if ttfb is None:
+                    ttfb = now - start
+                if ttft is None and marker in chunk and b"[DONE]" not in chunk[:20]:
+                    ttft = now - start
+                size += len(chunk)
+                window = tail + chunk  # marker 可能被切在兩個 chunk 之間
+                finished = finished or end_marker in window
+                errored = errored or any(error in window for error in ERROR_MARKERS)
+                tail = window[-64:]
+            status = response.status_code
+    except httpx.HTTPError as e:
+        return {"status": type(e).__name__, "total": time.perf_counter() - start}
+    if status == 200 and errored:
+        status = "error_frame"
+    elif status == 200 and not finished:
+        status = "truncated"  # 沒有錯誤 frame 但也沒有正常結束
+    return {"status": status, "ttfb": ttfb, "ttft": ttft, "total": time.perf_counter() - start, "bytes": size}
+
+
+async def ws_conversation(client: httpx.AsyncClient, name: str, queries: list[str]) -> list[dict]:
+    """Ask the queries one after another over a single WebSocket; one result per turn (the first one includes the handshake)."""
+    import websockets  # uvicorn[standard] 已經裝了
+
+    path, marker = WS_ENDPOINTS[name]
+    url = str(client.base_url).replace("http", "ws", 1).rstrip("/") + path
+    results = []
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            await ws.recv()  # {"type": "ready", ...}
+            for turn, query in enumerate(queries):
+                if turn:
+                    start = time.perf_counter()
+                await ws.send(json.dumps({"type": "ask", "id": str(turn), "query": query}))
+                ttfb = ttft = None
+                size = 0
+                status = 200
+                while True:
+                    message = await ws.recv()
+                    if message.startswith('{"type":'):
+                        continue  # heartbeat
+                    now = time.perf_counter()
+                    if ttfb is None:
+                        ttfb = now - start
+                    if ttft is None and marker in message:
+                        ttft = now - start
+                    size += len(message.encode())
+                    if '"message":"DONE"' in message:
+                        break
+                    if '"message":"ERROR"' in message or '"message":"CANCELLED"' in message:
+                        status = "turn_error"
+                        break
+                results.append({"status": status, "ttfb": ttfb, "ttft": ttft, "total": time.perf_counter() - start, "bytes": size})
+    except (OSError, websockets.WebSocketException) as e:
+        results.append({"status": type(e).__name__, "total": time.perf_counter() - start})
+    return results
+
+
+async def one_conversation(client: httpx.AsyncClient, name: str, queries: list[str]) -> list[dict]:
+    if name in WS_ENDPOINTS:
+        return await ws_conversation(client, name, queries)
+    # SSE / JSON: 每一輪都是一個新的 request (v2 同一個對話用同一個 thread_id)
+    conversation = uuid.uuid4().hex
+    return [await one_request(client, name, query, conversation) for query in queries]
+
+
+def pick_query(i: int, mode: str) -> str:
+    if mode == "same":
+        return QUERIES[0]  # 流量高峰: 大家都在問同一件事
+    if mode == "unique":
+        return f"{QUERIES[i % len(QUERIES)]} #{uuid.uuid4().hex[:8]}"  # 不會被合併 (request_coalescing.py)
+    return QUERIES[i % len(QUERIES)]
+
+
+async def upstream_calls(mock_url: str | None) -> int | None:
+    if not mock_url:
+        return None
+    async with httpx.AsyncClient() as client:
+        stats = (await client.get(f"{mock_url}/health")).json()
+    return stats["chat_completions"] + stats["responses"]
+
+
+async def prompt_cache_tokens(client: httpx.AsyncClient, path: str) -> tuple[int, int] | None:
+    """(input tokens, cached tokens) recorded so far by the server for path, summed over models."""
+    try:
+        stats = (await client.get("/api/prompt_cache/stats")).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+    models = stats.get(path, {}).values()
+    return sum(m["input_tokens"] for m in models), sum(m["cached_tokens"] for m in models)
+
+
+async def run_endpoint(client: httpx.AsyncClient, name: str, total: int, concurrency: int, server_pid: int | None,
+                       query_mode: str = "rotate", mock_url: str | None = None, turns: int = 1) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            return await one_conversation(client, name, [pick_query(i * turns + turn, query_mode) for turn in range(turns)])
+
+    calls_before = await upstream_calls(mock_url)
+    tokens_before = await prompt_cache_tokens(client, endpoint_path(name))
+    peak = [0.0]
+    sampler = None
+    if server_pid:
+        cpu_before = process_cpu_seconds(server_pid)
+        rss_before = peak[0] = process_rss_mb(server_pid)
+        sampler = asyncio.create_task(sample_rss(server_pid, peak))
+
+    wall_start = time.perf_counter()
+    results = [result for conversation in await asyncio.gather(*(limited(i) for i in range(total))) for result in conversation]
+    wall = time.perf_counter() - wall_start
+    calls_after = await upstream_calls(mock_url)
+    tokens_after = await prompt_cache_tokens(client, endpoint_path(name))
+
+    if sampler:
+        sampler.cancel()
+
+    ok = [r for r in results if r["status"] == 200]
+    statuses = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+
+    report = {
+        "endpoint": name,
+        "requests": len(results),
+        "turns": turns,
+        "concurrency": concurrency,
+        "ok": len(ok),
+        "errors": len(results) - len(ok),  # HTTP 錯誤、連線錯誤、錯誤 frame、沒有正常結束的串流
+        "statuses": statuses,
+        "wall_seconds": wall,
+        "streams_per_sec": len(ok) / wall if wall else 0,
+    }
+    for metric in ("ttfb", "ttft", "total"):
+        values = [r[metric] for r in ok if r.get(metric) is not None]
+        report[metric] = {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+    report["bytes_per_stream"] = sum(r["bytes"] for r in ok) / len(ok) if ok else 0
+    if calls_before is not None:
+        # 一個 agent run 可能打好幾次 upstream (tool call 之後再呼叫一次)
+        report["upstream_calls"] = calls_after - calls_before
+    if tokens_before is not None and tokens_after is not None:
+        input_tokens = tokens_after[0] - tokens_before[0]
+        cached_tokens = tokens_after[1] - tokens_before[1]
+        report["prompt_cache"] = {"input_tokens": input_tokens, "cached_tokens": cached_tokens,
+                                  "hit_rate": cached_tokens / input_tokens if input_tokens else 0}
+    if server_pid:
+        cpu = process_cpu_seconds(server_pid) - cpu_before
+        report["server_cpu_ms_per_stream"] = cpu * 1000 / len(ok) if ok else float("nan")
+        report["server_cpu_percent"] = cpu / wall * 100 if wall else 0
+        report["server_rss_peak_mb"] = peak[0]
+        report["server_rss_delta_kb_per_stream"] = (peak[0] - rss_before) * 1024 / len(results)
+    return report
+
+
+def print_report(report: dict):
+    ms = lambda v: f"{v * 1000:8.1f}"
+    turns = f", {report['turns']} turns per conversation" if report.get("turns", 1) > 1 else ""
+    print(f"\n== {report['endpoint']}  ({report['ok']}/{report['requests']} ok, {report['errors']} errors, concurrency {report['concurrency']}{turns}, "
+          f"{report['streams_per_sec']:.1f} streams/s)  statuses={report['statuses']}")
+    print(f"   {'ms':<6}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for metric in ("ttfb", "ttft", "total"):
+        row = report[metric]
+        print(f"   {metric:<6}{ms(row['p50'])} {ms(row['p95'])} {ms(row['p99'])}")
+    print(f"   bytes/stream: {report['bytes_per_stream']:.0f}")
+    if "upstream_calls" in report:
+        print(f"   upstream calls: {report['upstream_calls']} for {report['requests']} requests")
+    if report.get("prompt_cache", {}).get("input_tokens"):
+        cache = report["prompt_cache"]
+        print(f"   prompt cache: {cache['cached_tokens']}/{cache['input_tokens']} input tokens cached ({cache['hit_rate']:.0%})")
+    if "server_cpu_ms_per_stream" in report:
+        print(f"   server CPU: {report['server_cpu_ms_per_stream']:.1f} ms/stream ({report['server_cpu_percent']:.0f}% of one core), "
+              f"RSS peak {report['server_rss_peak_mb']:.1f} MB (+{report['server_rss_delta_kb_per_stream']:.1f} KB/stream)")
+
+
+## 啟動 mock upstream 與 server
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60, status: int | None = None):
+    """Wait until url answers (with the given status code, if any)."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+            try:
+                response = await client.get(url, timeout=1)
+                if status is None or response.status_code == status:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def start_processes(args, workdir: str) -> tuple[subprocess.Popen, subprocess.Popen, str, str]:
+    mock_port = args.mock_port or free_port()
+    server_port = args.server_port or free_port()
+    mock_args = [
+        sys.executable, os.path.join(HERE, "mock_upstream.py"), "--port", str(mock_port),
+        "--tokens-per-sec", str(args.tokens_per_sec), "--ttft-ms", str(args.ttft_ms),
+        "--output-tokens", str(args.output_tokens), "--tool-call-prob", str(args.tool_call_prob),
+        "--error-rate", str(args.error_rate), "--error-status", str(args.error_status),
+        "--search-latency-ms", str(args.search_latency_ms), "--cache-min-tokens", str(args.cache_min_tokens),
+        "--tool-call-tail-ms", str(args.tool_call_tail_ms),
+    ] + (["--no-reasoning"] if args.no_reasoning else [])
+    mock = subprocess.Popen(mock_args)
+
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "OPENAI_API_KEY": "mock",
+        "TAVILY_API_KEY": "mock",
+        "TAVILY_API_BASE_URL": f"http://127.0.0.1:{mock_port}",
+        "OPENAI_AGENTS_DISABLE_TRACING": "1",
+        "CONVERSATIONS_DB": os.path.join(workdir, "conversations.db"),
+        "JOBS_DB": os.path.join(workdir, "jobs.db"),
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+    })
+    if args.router:
+        env["MODEL_ROUTER"] = args.router
+    if args.speculative:
+        env["SPECULATIVE_TOOLS"] = "1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+    return mock, server, f"http://127.0.0.1:{server_port}", f"http://127.0.0.1:{mock_port}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline load test for main.py against mock_upstream.py")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"comma separated: {', '.join([*ENDPOINTS, *WS_ENDPOINTS])}")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=50, help="requests per endpoint")
+    parser.add_argument("--base-url", help="test an already running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the server for CPU / memory (with --base-url)")
+    parser.add_argument("--mock-port", type=int)
+    parser.add_argument("--server-port", type=int)
+    parser.add_argument("--tokens-per-sec", type=float, default=50)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--tool-call-prob", type=float, default=1)
+    parser.add_argument("--no-reasoning", action="store_true")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--search-latency-ms", type=float, default=200)
+    parser.add_argument("--router", choices=("off", "shadow", "on"), help="MODEL_ROUTER of the started server (model_router.py)")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024,
+                        help="shortest prefix the mock prompt cache hits; lower it to see hits with the short demo prompts")
+    parser.add_argument("--tool-call-tail-ms", type=float, default=0,
+                        help="mock delay between the end of function_call arguments and response.completed")
+    parser.add_argument("--speculative", action="store_true", help="SPECULATIVE_TOOLS=1 on the started server (speculative_tools.py)")
+    parser.add_argument("--queries", choices=("rotate", "same", "unique"), default="rotate",
+                        help="rotate through a few queries, send the same query (traffic spike) or make every query unique")
+    parser.add_argument("--turns", type=int, default=1, help="questions per conversation (--requests is the number of conversations)")
+    parser.add_argument("--no-keepalive", action="store_true", help="new HTTP connection for every request (proxies without keep-alive)")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per endpoint before measuring")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = [name for name in names if name not in ENDPOINTS and name not in WS_ENDPOINTS]
+    if unknown:
+        parser.error(f"unknown endpoints: {unknown}")
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            mock_url = None
+            if args.base_url:
+                base_url, server_pid = args.base_url, args.server_pid
+            else:
+                mock, server, base_url, mock_url = start_processes(args, workdir)
+                processes = [server, mock]
+                await wait_ready(f"{mock_url}/health", mock)
+                await wait_ready(f"{base_url}/readyz", server, status=200)  # 等背景 warm-up 完成
+                server_pid = server.pid
+
+            reports = []
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=0 if args.no_keepalive else args.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(300, connect=10), limits=limits) as client:
+                for name in names:
+                    # 第一次 request 會有 import / 連線建立的成本，不算進結果
+                    for i in range(args.warmup):
+                        await one_conversation(client, name, [QUERIES[i % len(QUERIES)]])
+                    report = await run_endpoint(client, name, args.requests, args.concurrency, server_pid, args.queries, mock_url,
+                                                args.turns)
+                    reports.append(report)
+                    if not args.json:
+                        print_report(report)
+            if args.json:
+                print(json.dumps(reports, indent=2))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
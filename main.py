@@ -1,42 +1,86 @@
-from dataclasses import dataclass
-import os
+from contextlib import aclosing, asynccontextmanager
+import sys
 import uuid
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, FileResponse
+from typing import Callable
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from openai.types.shared import reasoning
-from pydantic import BaseModel, Field
-import json
-import jiter
-import asyncio
-from datetime import datetime
+from pydantic import BaseModel, ValidationError
 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-
-# AG-UI Protocol imports
-from ag_ui.core import (
-    RunAgentInput,
-    EventType,
-    RunStartedEvent,
-    RunFinishedEvent,
-    RunErrorEvent,
-    TextMessageStartEvent,
-    TextMessageContentEvent,
-    TextMessageEndEvent,
-    ToolCallStartEvent,
-    ToolCallArgsEvent,
-    ToolCallEndEvent,
-    StepStartedEvent,
-    StepFinishedEvent,
-)
-from ag_ui.encoder import EventEncoder
 
 load_dotenv(".env", override=True)
 
-openai = AsyncOpenAI()
-app = FastAPI()
+from structured_logging import setup_logging, get_logger, event_logger
+
+setup_logging()
+logger = get_logger("main")
+
+from admission import AdmissionController, AdmissionRejected, Slot
+from response_cache import ResponseCache
+from http_clients import default_openai_client, close_http_clients, preconnect
+from resumable_stream import ResumableRun, ResumableRunRegistry, parse_event_id
+from stream_metrics import StreamTimer, metrics, timed_stream
+from warmup import Warmup, WarmupFailed
+from request_coalescing import SingleFlight, coalesce_key, coalesced_requests, count_coalesced
+from streaming_json import JSONPatchEncoder
+from prompt_cache import prompt_cache_stats, record_usage, volatile_run_config
+from model_router import RouteDecision, model_for, route, router_stats
+from tool_compaction import compaction_stats
+from conversation_state import REPLAY, TurnPlan, chain_rejected, conversation_state_stats, user_message
+from jobs import JobManager
+from speculative_tools import new_speculation
+from ws_transport import AgentSocket, ws_stats
+from source_store import SourceStoreRegistry
+from stream_pipeline import (
+    StreamFrame,
+    FRAME_OUTPUT,
+    FRAME_TOOL_OUTPUT,
+    FRAME_DONE,
+    agent_frames,
+    cancel_when_closed,
+    cancelled_runs,
+    coalesce,
+    sse_stream,
+)
+
+# agents / openai / tavily / ag_ui 很重，不在 import 時載入: server 先開始接連線，再由背景 warm-up 載入，見 warmup.py
+warmup = Warmup()
+
+def load_agents():
+    import qa_agents  # Agents SDK、tools、agent 定義，OpenAI / Tavily 共用有連線池的 client (見 http_clients.py)
+    qa_agents.agent_registry.warm_up()
+
+def load_ag_ui():
+    import ag_ui_stream
+
+def load_encodings():
+    import tiktoken
+    tiktoken.encoding_for_model("gpt-5")  # v2 的 session 計算 token 用，第一次要讀 (或下載) BPE 檔
+
+async def loaded_agents():
+    """qa_agents, waiting for the background warm-up if it is still running."""
+    await warmup.wait()
+    import qa_agents
+    return qa_agents
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup.start([
+        ("import qa_agents", load_agents),
+        ("import ag_ui", load_ag_ui),
+        ("tiktoken encodings", load_encodings, False),
+        ("preconnect upstreams", preconnect, False),
+    ])
+    await jobs.start()
+    yield
+    await jobs.stop()
+    await warmup.stop()
+    await close_http_clients()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -45,6 +89,129 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 每個 model 的併發上限與速率限制，拿不到 slot 就快速回 503，見 admission.py
+admission = AdmissionController()
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "server busy, please retry later", "model": exc.model, "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(WarmupFailed)
+async def warmup_failed_handler(request: Request, exc: WarmupFailed):
+    return JSONResponse(status_code=503, content={"error": str(exc)})
+
+# readiness probe: warm-up 完成前回 503 (process 已經在接連線，但 load balancer 先不要導流量過來)
+@app.get("/readyz")
+async def readyz():
+    return JSONResponse(status_code=200 if warmup.ready else 503, content=warmup.status())
+
+@app.get("/api/admission/stats")
+async def get_admission_stats():
+    return admission.stats()
+
+# Prometheus 指標: 串流延遲 (stream_metrics.py) + 各種 stats
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def collect_server_stats():
+    admission_stats = admission.stats()
+    qa_agents = sys.modules.get("qa_agents")  # warm-up 完成前還沒有 search cache
+    search_stats = qa_agents.search_cache.stats() if qa_agents else {}
+    return [
+        ("stream_cancelled_runs_total", "counter", "Agent runs cancelled because the client disconnected.",
+         {(("endpoint", endpoint),): count for endpoint, count in cancelled_runs.items()}),
+        ("admission_active", "gauge", "Runs currently holding an admission slot.",
+         {(("model", model),): s["active"] for model, s in admission_stats.items()}),
+        ("admission_queue_depth", "gauge", "Requests waiting for an admission slot.",
+         {(("model", model),): s["waiting"] for model, s in admission_stats.items()}),
+        ("admission_rejected_total", "counter", "Requests rejected with 503 by admission control.",
+         {(("model", model),): s["rejected"] for model, s in admission_stats.items()}),
+        ("admission_wait_seconds_avg", "gauge", "Average time admitted requests waited for a slot.",
+         {(("model", model),): s["wait_seconds_avg"] for model, s in admission_stats.items()}),
+        ("search_cache_requests_total", "counter", "web_search / knowledge_search cache lookups.",
+         {(("result", key),): search_stats[key] for key in search_stats.keys() & {"hits", "misses", "coalesced"}}),
+        ("coalesced_requests_total", "counter", "Requests served by another identical request's upstream call.",
+         {(("endpoint", endpoint),): count for endpoint, count in coalesced_requests.items()}),
+        ("completion_cache_requests_total", "counter", "completion_stream response cache lookups.",
+         {(("result", key),): completion_cache.stats()[key] for key in ("hits", "misses")}),
+    ]
+
+metrics.register_collector(collect_server_stats)
+
+# Agent 串流可以續傳: run 在背景跑，重連時帶 Last-Event-ID 接著送，見 resumable_stream.py
+stream_runs = ResumableRunRegistry()
+
+def resumable_response(run: ResumableRun, after: int = -1, media_type: str = "text/event-stream",
+                       timer: StreamTimer = None) -> StreamingResponse:
+    """SSE response following `run`; with the timer of the request that started the run, records its first byte."""
+    response = StreamingResponse(run.subscribe(after, timer.on_first_byte if timer else None), media_type=media_type)
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["X-Run-Id"] = run.run_id
+    return response
+
+def start_admitted_run(slot: Slot, chunks, **kwargs) -> ResumableRun:
+    """stream_runs.start() holding the admission slot until the run's task is done.
+
+    The slot is released by the task's done callback, not by a finally inside the generator: that finally never runs
+    if the task is cancelled before it starts iterating, and then the slot would leak.
+    """
+    try:
+        run = stream_runs.start(chunks, **kwargs)
+    except BaseException:
+        slot.release()
+        raise
+    run.task.add_done_callback(lambda _: slot.release())
+    return run
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse that releases its admission slot when the response is over, even if the body was never iterated
+    (client gone before the first chunk, or sending the headers failed)."""
+
+    def __init__(self, slot: Slot, content, **kwargs):
+        self.slot = slot
+        try:
+            super().__init__(slot.guard(content), **kwargs)
+        except BaseException:
+            slot.release()
+            raise
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+def resume_stream(request: Request, run_id: str = None, media_type: str = "text/event-stream") -> Response | None:
+    """If the request reconnects to an existing run, return a response that resumes it; None means start a new run."""
+    last_event = parse_event_id(request.headers.get("last-event-id"))
+    if last_event is None:
+        if run_id is None or stream_runs.get(run_id) is None:
+            return None
+        after = -1  # 同一個 run_id 重送: 從頭重播，不開新的 run
+    else:
+        run_id, after = last_event
+
+    run = stream_runs.get(run_id)
+    if run is None or not run.can_resume(after):
+        # 204 讓 EventSource 停止重連 (run 已經過期，或所有事件都送過了)
+        return Response(status_code=204)
+    stream_runs.resumed += 1
+    logger.info("resuming run", extra={"run_id": run_id, "after": after})
+    return resumable_response(run, after, media_type)
+
+def join_in_flight(key, endpoint: str) -> StreamingResponse | None:
+    """Attach to an identical request's run that is still streaming: replay what it already sent, then follow it live."""
+    run = stream_runs.find_active(key) if key is not None else None
+    if run is None:
+        return None
+    count_coalesced(endpoint)
+    return resumable_response(run)
+
 # 首頁路由
 @app.get("/")
 async def index():
@@ -54,15 +221,41 @@ async def index():
 app.mount("/static", StaticFiles(directory="static"), name="static")
     
 ## Form + Streaming
+TRANSLATION_MODEL = "gpt-4.1-mini"
+
+# 相同的翻譯請求直接重播快取的串流，不花 upstream tokens，見 response_cache.py
+completion_cache = ResponseCache()
+
 @app.get("/api/v1/completion_stream")
-async def get_completion_stream(query: str):
-    response = StreamingResponse(generate_completion_stream(query), media_type="text/event-stream")
+async def get_completion_stream(query: str, cache: bool = True):
+    timer = StreamTimer("/api/v1/completion_stream", TRANSLATION_MODEL)
+    chunks = await completion_cache.get(TRANSLATION_MODEL, query) if cache else None
+    if chunks is not None:
+        response = StreamingResponse(timed_stream(replay_completion_stream(chunks, timer), timer, first_byte=False),
+                                     media_type="text/event-stream")
+        response.headers["X-Cache"] = "HIT"
+    else:
+        await warmup.wait()
+        slot = await admission.admit(TRANSLATION_MODEL)
+        response = AdmittedStreamingResponse(slot, timed_stream(generate_completion_stream(query, cache, timer), timer), media_type="text/event-stream")
+        response.headers["X-Cache"] = "MISS" if cache else "BYPASS"
     response.headers["X-Accel-Buffering"] = "no"
     return response
 
-async def generate_completion_stream(query: str):
+@app.get("/api/v1/completion_cache/stats")
+async def get_completion_cache_stats():
+    return completion_cache.stats()
+
+async def replay_completion_stream(chunks: list[str], timer: StreamTimer = None):
+    # 和 generate_completion_stream 一樣的 frame 格式，一次寫出
+    yield "".join(f"data: {chunk_text}\n\n" for chunk_text in chunks) + "data: [DONE]\n\n"
+    if timer:
+        timer.on_cached_write()  # yield 回來時已經寫給 client 了
+
+async def generate_completion_stream(query: str, cache: bool = False, timer: StreamTimer = None):
+    openai = default_openai_client()
     response = await openai.chat.completions.create(
-        model='gpt-4.1-mini',
+        model=TRANSLATION_MODEL,
         messages=[
             {"role": "system", "content": """You are a bilingual translation assistant. Follow these rules:
 - If user inputs English, translate to Traditional Chinese (Taiwan variant)
@@ -72,421 +265,502 @@ async def generate_completion_stream(query: str):
             {'role': 'user', 'content': query}
         ],
         temperature=0,
-        stream=True
+        stream=True,
+        stream_options={"include_usage": True}
     )
 
-    async for chunk in response: 
-      chunk_text = chunk.choices[0].delta.content or ""
-      if chunk_text:
-          yield f"data: {chunk_text}\n\n"
+    chunks = []
+
+    # client 斷線時 generator 會被關閉，async with 會一併關掉 upstream 的連線
+    async with response:
+      async for chunk in response: 
+        if chunk.usage and timer:
+            record_usage(*timer.labels, chunk.usage)
+        if not chunk.choices:  # include_usage 的最後一個 chunk 只有 usage
+            continue
+        chunk_text = chunk.choices[0].delta.content or ""
+        if chunk_text:
+            if timer:
+                timer.on_delta()
+            chunks.append(chunk_text)
+            yield f"data: {chunk_text}\n\n"
+
+    # 只有完整跑完的回應才放進快取
+    if cache:
+        await completion_cache.set(TRANSLATION_MODEL, query, chunks)
     
     yield "data: [DONE]\n\n"
 
 ## Form + Streaming + Structured Output
-
-class QueryResult(BaseModel):
-    content: str
-    following_questions: list[str] = Field(description="3 follow-up questions exploring different aspects of the topic.")
+# QueryResult 定義在 qa_agents.py (agent 的 structured output 也用它)
 
 @app.get("/api/v1/completion_json_stream")
-async def get_completion_json_stream(query: str):
-    response = StreamingResponse(generate_completion_json_stream(query), media_type="text/event-stream")
-    response.headers["X-Accel-Buffering"] = "no"
-    return response
-
-async def generate_completion_json_stream(query: str):
-    json_str = ''
+async def get_completion_json_stream(request: Request, query: str):
+    resumed = resume_stream(request)
+    if resumed is not None:
+        return resumed
+    # 相同的問題正在回答中: 接上同一個 upstream 串流，見 request_coalescing.py
+    key = coalesce_key("/api/v1/completion_json_stream", "gpt-4.1-mini", query)
+    joined = join_in_flight(key, "/api/v1/completion_json_stream")
+    if joined is not None:
+        return joined
+    qa_agents = await loaded_agents()
+    timer = StreamTimer("/api/v1/completion_json_stream", "gpt-4.1-mini")
+    slot = await admission.admit("gpt-4.1-mini")
+    run = start_admitted_run(slot, timed_stream(generate_completion_json_stream(query, qa_agents.QueryResult, timer), timer, first_byte=False), key=key)
+    return resumable_response(run, timer=timer)
+
+async def generate_completion_json_stream(query: str, response_format: type, timer: StreamTimer = None):
+    # 和 agent 串流一樣合併連續的 patch 再送出，見 stream_pipeline.py
+    async for chunk in sse_stream(coalesce(completion_json_frames(query, response_format, timer))):
+        yield chunk
+
+async def completion_json_frames(query: str, response_format: type, timer: StreamTimer = None):
+    openai = default_openai_client()
+    patches = JSONPatchEncoder()
     async with openai.beta.chat.completions.stream(model="gpt-4.1-mini", 
                                                    messages=[
                                                        {"role": "system", "content": """You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese."""},
                                                        {'role': 'user', 'content': query}
                                                    ],
                                                    stream_options={"include_usage": True}, 
-                                                   response_format=QueryResult) as stream:
-      previous_content = ""
+                                                   response_format=response_format) as stream:
       async for event in stream:
           if event.type == "content.delta":
-              json_str += event.delta # 累加完整的 json 字串來做解析
-
-              try:
-                  result = jiter.from_json(json_str.encode('utf-8'), partial_mode="trailing-strings")
-                  
-                  # 兩種輸出方式:
-
-                  # 方法一: 針對 content 欄位，我們只輸出 delta 新增的字: 前端做累加，例如 esponseContentDiv.innerHTML += jsonData.content;
-                  if "content" in result:
-                      current_content = result["content"]
-                      if current_content != previous_content:
-                          result["content"] = current_content[len(previous_content):]
-                          previous_content = current_content
-                      elif current_content == previous_content:
-                          result["content"] = ''
-                      
-                  # 方法二: 其他欄位保持完整輸出: 前端要顯示的話，需要整個區塊替換掉
-
-                  yield f"data: {json.dumps(result)}\n\n"
-              except ValueError:
-                  # JSON 還不完整，繼續等待更多數據
-                  pass
+              if timer:
+                  timer.on_delta()
+              # 只送新增的部分 (JSON patch): 字串欄位送新增的字，陣列送新增的元素，前端用 applyPatch() 還原整個物件
+              ops = patches.feed(event.delta)
+              if ops:
+                  yield StreamFrame(FRAME_OUTPUT, {"patch": ops})
           elif event.type == "chunk" and event.chunk.usage:
               usage = event.chunk.usage
-              print(f"usage: {usage}")
-              print(f"final output: {json_str}")
+              logger.info("usage: %s", usage)
+              if timer:
+                  timer.output_tokens = usage.completion_tokens
+                  record_usage(*timer.labels, usage)
+              logger.debug("final output: %s", patches.root)
     
-    done_event = { "message": "DONE" }
-    yield f"data: {json.dumps(done_event)}\n\n"    
+    yield StreamFrame(FRAME_DONE, { "message": "DONE" })
  
 
 ## Chat Agent + Streaming + Structured Output
-from agents import Agent, Runner, set_default_openai_key, function_tool, trace, ItemHelpers, ModelSettings
-from openai.types.responses import ResponseTextDeltaEvent, ResponseCompletedEvent
-
-from tavily import AsyncTavilyClient
+# tools 和 agent 的定義在 qa_agents.py
 
-tavily_client = AsyncTavilyClient()
+@app.get("/api/stream_stats")
+async def get_stream_stats():
+    return {"cancelled_runs": cancelled_runs, "resumable_runs": stream_runs.stats(), "coalesced_requests": coalesced_requests}
 
-@function_tool
-async def web_search(query: str) -> str:
-    """
-    Search the web for information
+@app.get("/api/model_router/stats")
+async def get_model_router_stats():
+    return router_stats()
 
-    Args:
-        query: The query keyword to search the web for.        
-    """
-    
-    print(f"  ⚙️ 呼叫函式 web_search 參數: {query}")
+@app.get("/api/tool_compaction/stats")
+async def get_tool_compaction_stats():
+    # 每個 tool 壓縮前後的 tokens，見 tool_compaction.py
+    return compaction_stats()
 
-    response = await tavily_client.search(query)
+@app.get("/api/conversation_state/stats")
+async def get_conversation_state_stats():
+    return conversation_state_stats()
 
-    print(f"  ⚙️ 呼叫函式 web_search 結果: {response}")
+@app.get("/api/prompt_cache/stats")
+async def get_prompt_cache_stats():
+    # 每個 endpoint / model 的 input tokens 有多少是 upstream prompt cache 命中的，見 prompt_cache.py
+    return prompt_cache_stats()
 
-    return response['results']
+@app.get("/api/search_cache/stats")
+async def get_search_cache_stats():
+    return (await loaded_agents()).search_cache.stats()
 
 
 @app.get("/api/v1/agent_stream")
-async def get_agent_stream(query: str, previous_response_id: str = None, trace_id: str = None):
-    response = StreamingResponse(generate_agent_stream(query, previous_response_id, trace_id), media_type="text/event-stream")
-    response.headers["X-Accel-Buffering"] = "no"
-    return response
+async def get_agent_stream(request: Request, query: str, previous_response_id: str = None, trace_id: str = None):
+    resumed = resume_stream(request)
+    if resumed is not None:
+        return resumed
+    agent = (await loaded_agents()).agent_registry.get("qa_stream")
+    # key 用 agent 自己的 model: 同一個 query 的路由結果一定一樣，所以不用先 route 就能找到相同的 run
+    key = coalesce_key("/api/v1/agent_stream", agent.model, query, previous_response_id)
+    joined = join_in_flight(key, "/api/v1/agent_stream")
+    if joined is not None:
+        return joined
+    # 確定要開新的 run 才路由，簡單的問題分到小 model，見 model_router.py
+    decision = route("/api/v1/agent_stream", agent, query, previous_response_id=previous_response_id)
+    model = model_for(decision, agent)
+    timer = StreamTimer("/api/v1/agent_stream", model)
+    slot = await admission.admit(model)
+    run = start_admitted_run(slot, timed_stream(generate_agent_stream(agent, query, previous_response_id, trace_id, timer, decision), timer, first_byte=False), key=key)
+    return resumable_response(run, timer=timer)
+
+async def generate_agent_stream(agent, query: str, previous_response_id: str = None, trace_id: str = None, timer: StreamTimer = None,
+                                decision: RouteDecision = None):
+    async for chunk in sse_stream(agent_stream_frames(agent, query, previous_response_id, trace_id, timer, decision)):
+        yield chunk
+
+async def agent_stream_frames(agent, query: str, previous_response_id: str = None, trace_id: str = None, timer: StreamTimer = None,
+                              decision: RouteDecision = None, endpoint: str = "/api/v1/agent_stream"):
+    """qa_stream run as coalesced StreamFrames, shared by the SSE endpoint and the WebSocket transport."""
+    await loaded_agents()  # agents 由 warm-up 載入，不在 event loop 上 import
+    from agents import Runner, trace
+    from qa_agents import CustomAgentContext
+
+    logger.info("previous_response_id: %s", previous_response_id)
+
+    speculation = new_speculation()  # SPECULATIVE_TOOLS=1: web_search 在參數串流完就先開始，見 speculative_tools.py
+    with trace("FastAPI Agent", trace_id=trace_id):
+        result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id,
+                                     context=CustomAgentContext(speculation=speculation),  # web_search 查到的來源存在這裡
+                                     run_config=volatile_run_config(**decision.run_config_kwargs(agent) if decision else {}))
 
-async def generate_agent_stream(query: str, previous_response_id: str = None, trace_id: str = None):
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    agent = Agent(
-        name="QA Agent",
-        instructions= f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. Today's date is {today}.""",
-        tools=[web_search],
-        model="gpt-5-mini",
-        output_type=QueryResult,
-        model_settings=ModelSettings(
-            reasoning = {
-                "effort": "low",
-                "summary": "auto"
-            }
-        )
-    )
-    print(f"previous_response_id: {previous_response_id}")
+    frames = agent_frames(result, structured=True, on_event=event_logger(endpoint), timer=timer, speculation=speculation)
+    frames = cancel_when_closed(frames, result, endpoint=endpoint)
+    async for frame in coalesce(frames):
+        yield frame
 
-    with trace("FastAPI Agent", trace_id=trace_id):
-        result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id)
-
-    json_str = ''
-    previous_content = ''
-    last_response_id = None
-
-    async for event in result.stream_events():
-        print(event)
-        if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
-            print(event.data.delta)
-
-            json_str += event.data.delta
-            try:
-                parsed_data = jiter.from_json(json_str.encode('utf-8'), partial_mode="trailing-strings")
-                
-                if "content" in parsed_data:
-                    current_content = parsed_data["content"]
-                    if current_content != previous_content:
-                        parsed_data["content"] = current_content[len(previous_content):]
-                        previous_content = current_content
-                    elif current_content == previous_content:
-                        parsed_data["content"] = ''
-                    
-                yield f"data: {json.dumps(parsed_data)}\n\n"
-            except ValueError:
-                # JSON 還不完整，繼續等待更多數據
-                pass
-        elif event.type == "raw_response_event" and event.data.type == "response.output_item.added" and event.data.item.type == "reasoning":
-            think_chunk = {
-                "message": "THINK_START",
-            }
-            yield f"data: {json.dumps(think_chunk)}\n\n"                                   
-        elif event.type == "raw_response_event"  and event.data.type == "response.reasoning_summary_text.done":
-            think_chunk = {
-                "message": "THINK_TEXT",
-                "text": event.data.text
-            }
-            yield f"data: {json.dumps(think_chunk)}\n\n"   
-        elif event.type == "run_item_stream_event":
-            if event.item.type == "tool_call_item":
-                print("-- Tool was called")
-                yield f"data: {json.dumps({'message': 'CALL_TOOL', 'tool_name': str(event.item.raw_item.name), 'arguments': str(event.item.raw_item.arguments)})}\n\n"
-            elif event.item.type == "tool_call_output_item":
-                print(f"-- Tool output: {event.item.output}")
-            elif event.item.type == "message_output_item":
-                print(f"-- Message output:\n {ItemHelpers.text_message_output(event.item)}")                
-            else:
-                pass  # Ignore other event types            
-
-    last_response_id = result.last_response_id
-    print(f"last_response_id: {last_response_id}")
-    
-    done_event = { "message": "DONE", "last_response_id": last_response_id }
-    yield f"data: {json.dumps(done_event)}\n\n"
+    logger.info("last_response_id: %s", result.last_response_id)
 
 
 ## Simple Agent (非串流)
+# 相同的問題同時進來只跑一次 agent，大家拿同一個結果，見 request_coalescing.py
+agent_simple_runs = SingleFlight()
+
 @app.get("/api/v1/agent_simple")
 async def get_agent_simple(query: str, previous_response_id: str = None, trace_id: str = None):
-    today = datetime.now().strftime("%Y-%m-%d")
+    agent = (await loaded_agents()).agent_registry.get("qa_simple")
+    from agents import RunConfig, Runner, trace
+    from qa_agents import CustomAgentContext
 
-    agent = Agent(
-        name="QA Agent",
-        instructions=f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. """,
-        tools=[web_search],
-        model="gpt-5.1",
-    )
-    print(f"previous_response_id: {previous_response_id}")
+    logger.info("previous_response_id: %s", previous_response_id)
 
-    with trace("FastAPI Agent Simple", trace_id=trace_id):
-        result = await Runner.run(agent, input=query, previous_response_id=previous_response_id)
+    async def run_agent():
+        # 只有真的跑 agent 的 request 路由，等同一個結果的不算
+        decision = route("/api/v1/agent_simple", agent, query, previous_response_id=previous_response_id)
+        model = model_for(decision, agent)
+        async with await admission.admit(model):
+            with trace("FastAPI Agent Simple", trace_id=trace_id):
+                result = await Runner.run(agent, input=query, previous_response_id=previous_response_id,
+                                          context=CustomAgentContext(),
+                                          run_config=RunConfig(**decision.run_config_kwargs(agent)))
+        record_usage("/api/v1/agent_simple", model, result.context_wrapper.usage)
 
-    return {
-        "output": result.final_output,
-        "last_response_id": result.last_response_id
-    }
+        return {
+            "output": result.final_output,
+            "last_response_id": result.last_response_id
+        }
+
+    key = coalesce_key("/api/v1/agent_simple", agent.model, query, previous_response_id)
+    return await agent_simple_runs.do(key, run_agent, endpoint="/api/v1/agent_simple")
 
 
 ## Simple Agent Streaming (串流但不使用 structured output)
 @app.get("/api/v1/agent_simple_stream")
-async def get_agent_simple_stream(query: str, previous_response_id: str = None, trace_id: str = None):
-    response = StreamingResponse(generate_agent_simple_stream(query, previous_response_id, trace_id), media_type="text/event-stream")
-    response.headers["X-Accel-Buffering"] = "no"
-    return response
-
-async def generate_agent_simple_stream(query: str, previous_response_id: str = None, trace_id: str = None):
-    today = datetime.now().strftime("%Y-%m-%d")
-
-    agent = Agent(
-        name="QA Agent",
-        instructions=f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese.""",
-        tools=[web_search],
-        model="gpt-5.1",
-        model_settings=ModelSettings(
-            reasoning={
-                "effort": "low",
-                "summary": "auto"
-            }
-        )
-    )
-    print(f"previous_response_id: {previous_response_id}")
-
+async def get_agent_simple_stream(request: Request, query: str, previous_response_id: str = None, trace_id: str = None):
+    resumed = resume_stream(request)
+    if resumed is not None:
+        return resumed
+    agent = (await loaded_agents()).agent_registry.get("qa_simple_stream")
+    key = coalesce_key("/api/v1/agent_simple_stream", agent.model, query, previous_response_id)
+    joined = join_in_flight(key, "/api/v1/agent_simple_stream")
+    if joined is not None:
+        return joined
+    decision = route("/api/v1/agent_simple_stream", agent, query, previous_response_id=previous_response_id)
+    model = model_for(decision, agent)
+    timer = StreamTimer("/api/v1/agent_simple_stream", model)
+    slot = await admission.admit(model)
+    run = start_admitted_run(slot, timed_stream(generate_agent_simple_stream(agent, query, previous_response_id, trace_id, timer, decision), timer, first_byte=False), key=key)
+    return resumable_response(run, timer=timer)
+
+async def generate_agent_simple_stream(agent, query: str, previous_response_id: str = None, trace_id: str = None, timer: StreamTimer = None,
+                                       decision: RouteDecision = None):
+    await loaded_agents()
+    from agents import RunConfig, Runner, trace
+    from qa_agents import CustomAgentContext
+
+    logger.info("previous_response_id: %s", previous_response_id)
+
+    speculation = new_speculation()
     with trace("FastAPI Agent Simple Stream", trace_id=trace_id):
-        result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id)
-
-        async for event in result.stream_events():
-            print(event)
-            if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
-                content = { "content": event.data.delta }
-                yield f"data: {json.dumps(content)}\n\n"
-            elif event.type == "raw_response_event" and event.data.type == "response.output_item.added" and event.data.item.type == "reasoning":
-                think_chunk = {
-                    "message": "THINK_START",
-                }
-                yield f"data: {json.dumps(think_chunk)}\n\n"
-            elif event.type == "raw_response_event" and event.data.type == "response.reasoning_summary_text.done":
-                think_chunk = {
-                    "message": "THINK_TEXT",
-                    "text": event.data.text
-                }
-                yield f"data: {json.dumps(think_chunk)}\n\n"
-            elif event.type == "run_item_stream_event":
-                if event.item.type == "tool_call_item":
-                    yield f"data: {json.dumps({'message': 'CALL_TOOL', 'tool_name': str(event.item.raw_item.name), 'arguments': str(event.item.raw_item.arguments)})}\n\n"
-
-    last_response_id = result.last_response_id
-
-    done_event = {"message": "DONE", "last_response_id": last_response_id}
-    yield f"data: {json.dumps(done_event)}\n\n"
-
-
-# 加上 context 參數 https://openai.github.io/openai-agents-python/context/
-from agents import RunContextWrapper
-
-@dataclass
-class CustomAgentContext:
-  search_source: dict
-
-
-@function_tool
-async def knowledge_search(wrapper: RunContextWrapper[CustomAgentContext], query: str) -> str:
-    """
-    Search the web for information
-
-    Args:
-        query: The query keyword to search the web for.        
-    """
-    
-    print(f"  ⚙️ 呼叫函式 web_search 參數: {query}")
-
-    response = await tavily_client.search(query)
-
-    wrapper.context.search_source[query] = response
-
-    result = [ x["content"] for x in response["results"] ]
+        result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id,
+                                     context=CustomAgentContext(speculation=speculation),
+                                     run_config=RunConfig(**decision.run_config_kwargs(agent) if decision else {}))
 
-    print(f"  ⚙️ 呼叫函式 web_search 結果: {result}")
-
-    return str(result)
+        frames = agent_frames(result, on_event=event_logger("/api/v1/agent_simple_stream"), timer=timer, speculation=speculation)
+        frames = cancel_when_closed(frames, result, endpoint="/api/v1/agent_simple_stream")
+        async for chunk in sse_stream(coalesce(frames)):
+            yield chunk
 
 
 ## V2 版本: 增強 Context Engineering
-from agents import SQLiteSession
-# from agents.extensions.memory import AdvancedSQLiteSession
-from custom_sqlite_session import CustomSQLiteSession
+# knowledge_search、CustomAgentContext、session 在 qa_agents.py
 
 @app.get("/api/v2/agent_stream")
-async def get_agent_stream_v2(query: str, thread_id: str):
-    response = StreamingResponse(generate_agent_stream_v2(query, thread_id), media_type="text/event-stream")
+async def get_agent_stream_v2(request: Request, query: str, thread_id: str):
+    resumed = resume_stream(request)
+    if resumed is not None:
+        return resumed
+    # 同一個 thread 開在好幾個畫面上: 共用進行中的 run，不要各自跑一次 (也不會同時寫同一個 session)
+    run = stream_runs.find_active((thread_id, query))
+    if run is not None:
+        logger.info("sharing run", extra={"run_id": run.run_id, "thread_id": thread_id})
+        return resumable_response(run)
+    qa_agents = await loaded_agents()
+    model = qa_agents.agent_registry.get("qa_v2").model
+    timer = StreamTimer("/api/v2/agent_stream", model)
+    slot = await admission.admit(model)
+    run = start_admitted_run(slot, timed_stream(generate_agent_stream_v2(qa_agents, query, thread_id, timer), timer, first_byte=False), key=(thread_id, query))
+    return resumable_response(run, timer=timer)
+
+async def generate_agent_stream_v2(qa_agents, query: str, thread_id: str, timer: StreamTimer = None, on_result: Callable = None):
+    async for chunk in sse_stream(agent_v2_frames(qa_agents, query, thread_id, timer, on_result)):
+        yield chunk
+
+async def agent_v2_frames(qa_agents, query: str, thread_id: str, timer: StreamTimer = None, on_result: Callable = None,
+                          endpoint: str = "/api/v2/agent_stream"):
+    """qa_v2 run on the thread's conversation as coalesced StreamFrames, shared by SSE, jobs and the WebSocket transport.
+
+    The history is either chained with previous_response_id or replayed from the local session (see conversation_state.py);
+    the finished turn is appended to the session before the DONE frame goes out.
+    """
+    await loaded_agents()
+    from agents import Runner, trace
+
+    agent = qa_agents.agent_registry.get("qa_v2")
+    logger.info("thread_id: %s", thread_id)
+
+    session = qa_agents.conversation_session(thread_id, agent)
+    state = qa_agents.conversation_state
+    turn = await state.plan(thread_id)
+
+    while True:
+        run_input = query
+        if turn.mode == REPLAY:
+            current_items = await session.get_items()  # 整個對話 (超過門檻會 trim，見 custom_sqlite_session.py)
+            logger.info("current_items_count: %d", len(current_items))
+            run_input = current_items + [user_message(query)]
+        state.started(thread_id, turn, run_input)
+
+        custom_agent_context = qa_agents.CustomAgentContext(thread_id=thread_id, speculation=new_speculation())
+
+        with trace("FastAPI Agent v2", trace_id=f"trace_{thread_id}"):
+            result = Runner.run_streamed(agent, input=run_input, previous_response_id=turn.previous_response_id,
+                                         context=custom_agent_context, run_config=volatile_run_config())
+
+        frames = agent_frames(result, structured=True, timer=timer, speculation=custom_agent_context.speculation)
+        frames = cancel_when_closed(frames, result, endpoint=endpoint)
+        sent = False
+        try:
+            async for frame in coalesce(frames):
+                if frame.kind == FRAME_TOOL_OUTPUT:
+                    logger.debug("search_source: %s", result.context_wrapper.context.search_source) # 也可以看到最新更新後的 context (這個沒有傳給 LLM，只是我們內部用)
+                if frame.kind == FRAME_DONE:
+                    await state.commit(session, thread_id, turn, query, result)
+                    sources = custom_agent_context.search_source
+                    if len(sources):
+                        # 引用的來源之後再用 GET /api/sources/{id} 拿，不放進串流
+                        source_stores.keep(sources)
+                        frame.data["sources"] = sources.id
+                sent = True
+                yield frame
+        except Exception as e:
+            if sent or turn.mode == REPLAY or not chain_rejected(e):
+                raise
+            # OpenAI 那邊的 response 已經不能接了: 還沒送出任何東西，改用 session 重跑這一輪
+            logger.warning("previous_response_id rejected, replaying the session", extra={"thread_id": thread_id, "error": str(e)})
+            turn = TurnPlan(REPLAY, "rejected")
+            continue
+        break
+
+    logger.debug("result: %s", result.context_wrapper)
+    logger.debug("search_source: %s", result.context_wrapper.context.search_source)
+    if on_result:
+        on_result(result)
+
+
+## 搜尋來源: v2 的 DONE frame 帶 sources id，需要引用時再拿，見 source_store.py
+source_stores = SourceStoreRegistry()
+
+@app.get("/api/sources/{store_id}")
+async def get_sources(store_id: str):
+    store = source_stores.get(store_id)
+    if store is None:
+        return JSONResponse(status_code=404, content={"error": "sources not found or expired"})
+    return {"id": store_id, "queries": store.queries, "sources": store.citations()}
+
+@app.get("/api/sources/{store_id}/{ref}")
+async def get_source(store_id: str, ref: str):
+    store = source_stores.get(store_id)
+    citation = store.citation(ref) if store else None
+    if citation is None:
+        return JSONResponse(status_code=404, content={"error": "source not found or expired"})
+    return {**citation, "content": store.content(ref)}
+
+
+## WebSocket: 同一個對話的很多輪走同一條連線，不用每一題都開一個新的 SSE request，見 ws_transport.py
+@app.websocket("/api/v1/agent_ws")
+async def agent_ws(websocket: WebSocket):
+    agent = (await loaded_agents()).agent_registry.get("qa_stream")
+
+    async def run_turn(query: str, state: dict):
+        # 上一輪的 last_response_id 記在連線上，client 不用自己帶
+        previous_response_id = state.get("last_response_id")
+        decision = route("/api/v1/agent_ws", agent, query, previous_response_id=previous_response_id)
+        model = model_for(decision, agent)
+        timer = StreamTimer("/api/v1/agent_ws", model)
+        frames = agent_stream_frames(agent, query, previous_response_id, None, timer, decision, endpoint="/api/v1/agent_ws")
+        async with await admission.admit(model), aclosing(timed_stream(frames, timer)) as frames:
+            async for frame in frames:
+                if frame.kind == FRAME_DONE:
+                    state["last_response_id"] = frame.data["last_response_id"]
+                yield frame
+
+    socket = AgentSocket(websocket, "/api/v1/agent_ws", run_turn, websocket.query_params.get("thread_id"))
+    socket.state["last_response_id"] = websocket.query_params.get("previous_response_id")
+    await socket.serve()
+
+@app.websocket("/api/v2/agent_ws")
+async def agent_ws_v2(websocket: WebSocket):
+    qa_agents = await loaded_agents()
+    model = qa_agents.agent_registry.get("qa_v2").model
+
+    async def run_turn(query: str, state: dict):
+        # 和 /api/v2/agent_stream 一樣接著 thread_id 的 session
+        timer = StreamTimer("/api/v2/agent_ws", model)
+        frames = agent_v2_frames(qa_agents, query, state["thread_id"], timer, endpoint="/api/v2/agent_ws")
+        async with await admission.admit(model), aclosing(timed_stream(frames, timer)) as frames:
+            async for frame in frames:
+                yield frame
+
+    await AgentSocket(websocket, "/api/v2/agent_ws", run_turn, websocket.query_params.get("thread_id")).serve()
+
+@app.get("/api/ws/stats")
+async def get_ws_stats():
+    return ws_stats()
+
+
+## 背景 job: 很久的 v2 run 不綁在一條連線上，見 jobs.py
+jobs = JobManager()
+
+class JobRequest(BaseModel):
+    query: str
+    thread_id: str | None = None
+
+async def agent_v2_job(job):
+    qa_agents = await loaded_agents()
+    timer = StreamTimer("/api/jobs", qa_agents.agent_registry.get("qa_v2").model)
+
+    def on_result(result):
+        job.result = {
+            "output": result.final_output.model_dump() if isinstance(result.final_output, BaseModel) else result.final_output,
+            "thread_id": job.params["thread_id"],
+            "search_source": list(result.context_wrapper.context.search_source),  # 查過的 query
+            "sources": result.context_wrapper.context.search_source.citations(),  # 來源清單，內容不放進 job
+        }
+
+    async for chunk in timed_stream(generate_agent_stream_v2(qa_agents, job.params["query"], job.params["thread_id"], timer, on_result), timer, first_byte=False):
+        yield chunk
+
+jobs.register("agent_v2", agent_v2_job)
+
+def job_links(job_id: str) -> dict:
+    return {"status": f"/api/jobs/{job_id}", "stream": f"/api/jobs/{job_id}/stream", "cancel": f"/api/jobs/{job_id}/cancel"}
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(body: JobRequest):
+    # 同一個 thread 的 job 會接著同一個 session (和 /api/v2/agent_stream 一樣)
+    thread_id = body.thread_id or f"job_{uuid.uuid4().hex}"
+    job_id = await jobs.submit("agent_v2", {"query": body.query, "thread_id": thread_id})
+    return {"job_id": job_id, "status": "queued", "thread_id": thread_id, "links": job_links(job_id)}
+
+@app.get("/api/jobs/stats")
+async def get_job_stats():
+    return jobs.stats()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    return {**job, "links": job_links(job_id)}
+
+@app.get("/api/jobs/{job_id}/stream")
+async def stream_job(request: Request, job_id: str):
+    # 隨時都可以接上: 先補送已經產生的事件 (帶 Last-Event-ID 就從那之後)，還在跑就接著收
+    if await jobs.get(job_id) is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    last_event = parse_event_id(request.headers.get("last-event-id"))
+    after = last_event[1] if last_event and last_event[0] == job_id else -1
+    response = StreamingResponse(jobs.events(job_id, after), media_type="text/event-stream")
     response.headers["X-Accel-Buffering"] = "no"
     return response
 
-async def generate_agent_stream_v2(query: str, thread_id: str):
-
-    # session = SQLiteSession(thread_id, "conversations.db")
-    # session = AdvancedSQLiteSession(session_id=thread_id, create_tables=True, db_path="advanced_conversations.db")
-
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    agent = Agent[CustomAgentContext](
-        name="QA Agent",
-        instructions= f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. Today's date is {today}.""",
-        tools=[knowledge_search],
-        model="gpt-5-mini",
-        output_type=QueryResult,
-        model_settings=ModelSettings(
-            reasoning = {
-                "effort": "low",
-                "summary": "auto"
-            }
-        )
-    )
-    print(f"thread_id: {thread_id}")
-
-    session = CustomSQLiteSession(thread_id, "conversations.db", agent=agent)
-    current_items = await session.get_items()
-    print(f"current_items_count: {len(current_items)}")
-
-    custom_agent_context = CustomAgentContext(search_source={})
-
-
-    with trace("FastAPI Agent v2", trace_id=f"trace_{thread_id}"):
-        result = Runner.run_streamed(agent, input=query, session=session, context=custom_agent_context)
-
-    json_str = ''
-    previous_content = ''
-    last_response_id = None
-
-    async for event in result.stream_events():
-        #print(event)
-        if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
-            #print(event.data.delta)
-
-            json_str += event.data.delta
-            try:
-                parsed_data = jiter.from_json(json_str.encode('utf-8'), partial_mode="trailing-strings")
-                
-                if "content" in parsed_data:
-                    current_content = parsed_data["content"]
-                    if current_content != previous_content:
-                        parsed_data["content"] = current_content[len(previous_content):]
-                        previous_content = current_content
-                    elif current_content == previous_content:
-                        parsed_data["content"] = ''
-                    
-                yield f"data: {json.dumps(parsed_data)}\n\n"
-            except ValueError:
-                # JSON 還不完整，繼續等待更多數據
-                pass
-        elif event.type == "raw_response_event" and event.data.type == "response.output_item.added" and event.data.item.type == "reasoning":
-            think_chunk = {
-                "message": "THINK_START",
-            }
-            yield f"data: {json.dumps(think_chunk)}\n\n"                                   
-        elif event.type == "raw_response_event"  and event.data.type == "response.reasoning_summary_text.done":
-            think_chunk = {
-                "message": "THINK_TEXT",
-                "text": event.data.text
-            }
-            yield f"data: {json.dumps(think_chunk)}\n\n"   
-        elif event.type == "raw_response_event" and event.data.type == "response.completed":
-            print(f"last_response_id: {event.data}")
-            last_response_id = event.data.response.id
-        elif event.type == "run_item_stream_event":
-            if event.item.type == "tool_call_item":
-                print("-- Tool was called")
-                yield f"data: {json.dumps({'message': 'CALL_TOOL', 'tool_name': str(event.item.raw_item.name), 'arguments': str(event.item.raw_item.arguments)})}\n\n"
-            elif event.item.type == "tool_call_output_item":
-                print(f"-- Tool output: {event.item.output}")
-                
-                print(f"search_source: {result.context_wrapper.context.search_source}") # 也可以看到最新更新後的 context (這個沒有傳給 LLM，只是我們內部用)
-
-            elif event.item.type == "message_output_item":
-                #print(f"-- Message output:\n {ItemHelpers.text_message_output(event.item)}")                
-                pass
-            else:
-                pass  # Ignore other event types            
-
-    done_event = { "message": "DONE", "last_response_id": last_response_id }
-    yield f"data: {json.dumps(done_event)}\n\n"
-
-    print(f"result: {result.context_wrapper}")
-    print("--------------------------------")
-    print(f"search_source: {result.context_wrapper.context.search_source}")
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = await jobs.cancel(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    return job
 
 
 ## AG-UI Protocol Endpoint
+# AGUIFrameEncoder 在 ag_ui_stream.py
 @app.post("/api/ag-ui")
-async def ag_ui_endpoint(input_data: RunAgentInput, request: Request):
+async def ag_ui_endpoint(request: Request):
     """AG-UI Protocol compatible endpoint"""
+    qa_agents = await loaded_agents()
+    from ag_ui_stream import EventEncoder, EventType, RunAgentInput, RunErrorEvent
+
+    # body 自己驗證 (不寫成 RunAgentInput 參數)，這樣 import main 時不用載入 ag_ui
+    try:
+        input_data = RunAgentInput.model_validate(await request.json())
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()])
+    except ValueError as e:
+        raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": str(e), "input": None}])
+
     accept_header = request.headers.get("accept")
     encoder = EventEncoder(accept=accept_header)
 
-    response = StreamingResponse(
-        generate_ag_ui_stream(input_data, encoder),
-        media_type=encoder.get_content_type()
-    )
-    response.headers["X-Accel-Buffering"] = "no"
-    return response
+    # 以 run_id 續傳: 重送同一個 run_id (可帶 Last-Event-ID) 會接上還在跑或剛跑完的 run
+    resumed = resume_stream(request, input_data.run_id, media_type=encoder.get_content_type())
+    if resumed is not None:
+        return resumed
 
+    agent = qa_agents.agent_registry.get("qa_ag_ui")
+    decision = route("/api/ag-ui", agent, last_user_message(input_data), history=len(input_data.messages),
+                     previous_response_id=input_data.parent_run_id)
+    model = model_for(decision, agent)
+    timer = StreamTimer("/api/ag-ui", model)
+    slot = await admission.admit(model)
+    run = start_admitted_run(slot, timed_stream(generate_ag_ui_stream(agent, input_data, encoder, timer, decision), timer, first_byte=False), run_id=input_data.run_id,
+                             on_error=lambda e: encoder.encode(RunErrorEvent(type=EventType.RUN_ERROR, message=str(e))))
+    return resumable_response(run, media_type=encoder.get_content_type(), timer=timer)
 
-async def generate_ag_ui_stream(input_data: RunAgentInput, encoder: EventEncoder):
-    """Generate AG-UI protocol compliant event stream"""
-    today = datetime.now().strftime("%Y-%m-%d")
 
-    # Extract the last user message as query
-    query = ""
+def last_user_message(input_data) -> str:
+    """The last user message of an AG-UI request, used as the query."""
     for msg in reversed(input_data.messages):
         if msg.role == "user":
-            query = msg.content if isinstance(msg.content, str) else str(msg.content)
-            break
+            return msg.content if isinstance(msg.content, str) else str(msg.content)
+    return ""
+
+
+async def generate_ag_ui_stream(agent, input_data, encoder, timer: StreamTimer = None, decision: RouteDecision = None):
+    """Generate AG-UI protocol compliant event stream"""
+    await loaded_agents()
+    from agents import Runner, trace
+    from ag_ui_stream import AGUIFrameEncoder, EventType, RunErrorEvent, RunStartedEvent
+    from qa_agents import CustomAgentContext
+
+    # Extract the last user message as query
+    query = last_user_message(input_data)
 
     thread_id = input_data.thread_id or str(uuid.uuid4())
     run_id = input_data.run_id or str(uuid.uuid4())
-    message_id = str(uuid.uuid4())
 
     # Use parent_run_id as previous_response_id for conversation continuity
     previous_response_id = input_data.parent_run_id
-    print(f"[AG-UI] thread_id: {thread_id}, run_id: {run_id}, parent_run_id (previous_response_id): {previous_response_id}")
+    logger.info("[AG-UI] thread_id: %s, run_id: %s, parent_run_id (previous_response_id): %s", thread_id, run_id, previous_response_id)
 
     try:
         # Send RUN_STARTED event
@@ -498,131 +772,23 @@ async def generate_ag_ui_stream(input_data: RunAgentInput, encoder: EventEncoder
             )
         )
 
-        agent = Agent(
-            name="QA Agent",
-            instructions=f"""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. Today's date is {today}.""",
-            tools=[web_search],
-            model="gpt-5.1",
-            model_settings=ModelSettings(
-                reasoning={
-                    "effort": "low",
-                    "summary": "auto"
-                }
-            )
-        )
+        ag_ui_encoder = AGUIFrameEncoder(encoder, thread_id, run_id)
 
+        speculation = new_speculation()
         with trace("FastAPI AG-UI Agent", trace_id=f"trace_{run_id}"):
-            result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id)
-
-            text_started = False
-            reasoning_step_id = None
-            last_response_id = None  # Track the last response ID from the agent
-
-            async for event in result.stream_events():
-                print(f"[AG-UI] {event}")
-
-                # Capture last_response_id from response.completed event
-                if event.type == "raw_response_event" and event.data.type == "response.completed":
-                    last_response_id = event.data.response.id
-                    print(f"[AG-UI] Captured last_response_id: {last_response_id}")
-
-                # Handle reasoning start
-                if event.type == "raw_response_event" and event.data.type == "response.output_item.added" and event.data.item.type == "reasoning":
-                    reasoning_step_id = f"step_{uuid.uuid4()}"
-                    yield encoder.encode(
-                        StepStartedEvent(
-                            type=EventType.STEP_STARTED,
-                            step_name="Thinking"
-                        )
-                    )
-
-                # Handle reasoning summary done
-                elif event.type == "raw_response_event" and event.data.type == "response.reasoning_summary_text.done":
-                    if reasoning_step_id:
-                        yield encoder.encode(
-                            StepFinishedEvent(
-                                type=EventType.STEP_FINISHED
-                            )
-                        )
-                        reasoning_step_id = None
-
-                # Handle text message delta
-                elif event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
-                    # Send TEXT_MESSAGE_START on first text delta
-                    if not text_started:
-                        yield encoder.encode(
-                            TextMessageStartEvent(
-                                type=EventType.TEXT_MESSAGE_START,
-                                message_id=message_id,
-                                role="assistant"
-                            )
-                        )
-                        text_started = True
-
-                    # Send TEXT_MESSAGE_CONTENT
-                    yield encoder.encode(
-                        TextMessageContentEvent(
-                            type=EventType.TEXT_MESSAGE_CONTENT,
-                            message_id=message_id,
-                            delta=event.data.delta
-                        )
-                    )
-
-                # Handle tool calls
-                elif event.type == "run_item_stream_event":
-                    if event.item.type == "tool_call_item":
-                        tool_call_id = f"tc_{uuid.uuid4()}"
-                        tool_name = str(event.item.raw_item.name)
-                        tool_args = str(event.item.raw_item.arguments)
-
-                        yield encoder.encode(
-                            ToolCallStartEvent(
-                                type=EventType.TOOL_CALL_START,
-                                tool_call_id=tool_call_id,
-                                tool_call_name=tool_name
-                            )
-                        )
-
-                        yield encoder.encode(
-                            ToolCallArgsEvent(
-                                type=EventType.TOOL_CALL_ARGS,
-                                tool_call_id=tool_call_id,
-                                delta=tool_args
-                            )
-                        )
-
-                        yield encoder.encode(
-                            ToolCallEndEvent(
-                                type=EventType.TOOL_CALL_END,
-                                tool_call_id=tool_call_id
-                            )
-                        )
-
-        # Send TEXT_MESSAGE_END if text was started
-        if text_started:
-            yield encoder.encode(
-                TextMessageEndEvent(
-                    type=EventType.TEXT_MESSAGE_END,
-                    message_id=message_id
-                )
-            )
-
-        # Use last_response_id as the run_id for RUN_FINISHED
-        # This allows the frontend to use it as parent_run_id in the next request
-        final_run_id = last_response_id or run_id
-        print(f"[AG-UI] RUN_FINISHED with run_id: {final_run_id}")
+            result = Runner.run_streamed(agent, input=query, previous_response_id=previous_response_id,
+                                         context=CustomAgentContext(thread_id=thread_id, speculation=speculation),
+                                         run_config=volatile_run_config(**decision.run_config_kwargs(agent) if decision else {}))
 
-        # Send RUN_FINISHED event
-        yield encoder.encode(
-            RunFinishedEvent(
-                type=EventType.RUN_FINISHED,
-                thread_id=thread_id,
-                run_id=final_run_id
-            )
-        )
+            frames = agent_frames(result, on_event=event_logger("/api/ag-ui"), timer=timer, speculation=speculation)
+            frames = cancel_when_closed(frames, result, endpoint="/api/ag-ui")
+            async for frame in coalesce(frames):
+                chunk = ag_ui_encoder.encode(frame)
+                if chunk:
+                    yield chunk
 
     except Exception as e:
-        print(f"[AG-UI] Error: {e}")
+        logger.exception("[AG-UI] Error: %s", e)
         yield encoder.encode(
             RunErrorEvent(
                 type=EventType.RUN_ERROR,
@@ -0,0 +1,433 @@
+# 本機模擬的 OpenAI (Chat Completions / Responses 串流) 與 Tavily search，給 loadtest.py 壓測用，不花真的 quota
+#
+#   python mock_upstream.py --port 8100 --tokens-per-sec 50 --ttft-ms 300 --tool-call-prob 1 --error-rate 0.01
+#
+# main.py 指向這裡:
+#   OPENAI_BASE_URL=http://127.0.0.1:8100/v1
+#   TAVILY_API_BASE_URL=http://127.0.0.1:8100
+#
+# 支援的行為 (參數或 MOCK_* 環境變數):
+#   - TTFT、每秒 token 數、輸出 token 數
+#   - 有 tools 時依機率先回一個 function_call (收到 function_call_output 之後才回答)
+#   - request 有 reasoning 設定時送出 reasoning summary
+#   - response_format / text.format 是 json_schema 時，輸出符合 schema 的 JSON
+#   - 依比例注入 500 / 429 錯誤
+#   - prompt prefix cache: 記住看過的 prompt 前綴，usage 回報 cached_tokens (見 prompt_cache.py)
+#   - 小 model 比較快: --model-speedup gpt-5-nano=3 (TTFT 除以 3、每秒 token 數乘以 3，見 model_router.py)
+#   - previous_response_id: 接著之前回過的 response (input tokens 加上前面的 context)，不認得的 id 回 404 (見 conversation_state.py)
+#   - function_call 的參數分段串流，--tool-call-tail-ms 模擬參數送完到 response.completed 之間的時間 (見 speculative_tools.py)
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("the", "agent", "stream", "token", "latency", "search", "result", "model", "answer", "context",
+         "串流", "回答", "搜尋", "結果", "模型")
+
+
+class MockConfig:
+    def __init__(self):
+        self.tokens_per_sec = float(os.environ.get("MOCK_TOKENS_PER_SEC", "50"))
+        self.ttft_ms = float(os.environ.get("MOCK_TTFT_MS", "300"))
+        self.output_tokens = int(os.environ.get("MOCK_OUTPUT_TOKENS", "200"))
+        self.tool_call_prob = float(os.environ.get("MOCK_TOOL_CALL_PROB", "1"))
+        self.reasoning = os.environ.get("MOCK_REASONING", "1") == "1"
+        self.error_rate = float(os.environ.get("MOCK_ERROR_RATE", "0"))
+        self.error_status = int(os.environ.get("MOCK_ERROR_STATUS", "500"))
+        self.search_latency_ms = float(os.environ.get("MOCK_SEARCH_LATENCY_MS", "200"))
+        self.cache_min_tokens = int(os.environ.get("MOCK_CACHE_MIN_TOKENS", "1024"))
+        self.model_speedup = _parse_speedup(os.environ.get("MOCK_MODEL_SPEEDUP", "gpt-5-nano=3"))
+        self.tool_call_tail_ms = float(os.environ.get("MOCK_TOOL_CALL_TAIL_MS", "0"))
+
+
+def _parse_speedup(value: str) -> dict[str, float]:
+    """'gpt-5-nano=3,gpt-4.1-mini=1.5' -> {model: factor}"""
+    speedup = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            model, factor = pair.split("=", 1)
+            speedup[model.strip()] = float(factor)
+    return speedup
+
+
+config = MockConfig()
+app = FastAPI()
+stats = {"chat_completions": 0, "responses": 0, "search": 0, "errors": 0, "request_bytes": 0}
+
+
+class PrefixCache:
+    """Simplified upstream prompt cache: remembers the hash of every prompt prefix that ends on a segment boundary.
+
+    Segments are the parts of the request in prompt order (tools, instructions / system, each input item).
+    Like the real one, only prefixes of at least cache_min_tokens count and hits are rounded down to 128 tokens.
+    """
+
+    def __init__(self, max_entries: int = 50_000):
+        self.max_entries = max_entries
+        self._seen: OrderedDict[str, None] = OrderedDict()
+
+    def lookup(self, model: str, segments: list[str]) -> tuple[int, int]:
+        """(input tokens, cached tokens) for a prompt made of segments; the prefixes are remembered."""
+        digest = hashlib.sha1(model.encode())
+        chars = cached_chars = 0
+        for segment in segments:
+            digest.update(segment.encode())
+            chars += len(segment)
+            key = digest.hexdigest()
+            if key in self._seen:
+                cached_chars = chars
+                self._seen.move_to_end(key)
+            else:
+                self._seen[key] = None
+                if len(self._seen) > self.max_entries:
+                    self._seen.popitem(last=False)
+        input_tokens = max(1, chars // 4)
+        cached_tokens = cached_chars // 4 // 128 * 128
+        if cached_tokens < config.cache_min_tokens:
+            cached_tokens = 0
+        return input_tokens, min(cached_tokens, input_tokens)
+
+
+prefix_cache = PrefixCache()
+
+# response id -> 這個 response 結束時整個 context 的 tokens (給 previous_response_id 接著用)
+stored_responses: OrderedDict[str, int] = OrderedDict()
+MAX_STORED_RESPONSES = 50_000
+
+
+def _segments(*parts) -> list[str]:
+    segments = []
+    for part in parts:
+        if part is None or part == [] or part == {}:
+            continue
+        if isinstance(part, list):
+            segments.extend(json.dumps(item, ensure_ascii=False, sort_keys=True) for item in part)
+        else:
+            segments.append(part if isinstance(part, str) else json.dumps(part, ensure_ascii=False, sort_keys=True))
+    return segments
+
+
+def _tokens(n: int) -> list[str]:
+    return [random.choice(WORDS) + " " for _ in range(n)]
+
+
+def _fake_value(schema: dict, defs: dict, n_tokens: int):
+    """Build a value that matches a (simple) JSON schema; strings are filled with n_tokens words."""
+    if "$ref" in schema:
+        schema = defs[schema["$ref"].rsplit("/", 1)[-1]]
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        props = schema.get("properties", {})
+        share = max(1, n_tokens // max(1, len(props)))
+        return {key: _fake_value(sub, defs, share) for key, sub in props.items()}
+    if schema_type == "array":
+        return [_fake_value(schema.get("items", {}), defs, max(1, n_tokens // 6)) for _ in range(3)]
+    if schema_type in ("integer", "number"):
+        return 1
+    if schema_type == "boolean":
+        return True
+    return "".join(_tokens(n_tokens)).strip()
+
+
+def _split(text: str, n: int) -> list[str]:
+    """Split text into roughly n deltas."""
+    size = max(1, len(text) // max(1, n))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _output_deltas(json_schema: dict | None) -> list[str]:
+    if json_schema:
+        schema = json_schema.get("schema", {})
+        text = json.dumps(_fake_value(schema, schema.get("$defs", {}), config.output_tokens), ensure_ascii=False)
+        return _split(text, config.output_tokens)
+    return _tokens(config.output_tokens)
+
+
+def _speed(model: str) -> float:
+    return config.model_speedup.get(model, 1.0)
+
+
+async def _pace(deltas, model: str = ""):
+    """Sleep TTFT before the first delta, then 1/tokens_per_sec between deltas (scaled by the model's speedup)."""
+    speed = _speed(model)
+    await asyncio.sleep(config.ttft_ms / 1000 / speed)
+    gap = 1 / (config.tokens_per_sec * speed) if config.tokens_per_sec > 0 else 0
+    for i, delta in enumerate(deltas):
+        if i and gap:
+            await asyncio.sleep(gap)
+        yield delta
+
+
+def _inject_error():
+    if config.error_rate > 0 and random.random() < config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(status_code=config.error_status,
+                            content={"error": {"message": "injected error", "type": "mock_error", "code": None}})
+    return None
+
+
+def _sse(data: dict, event: str | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+## Chat Completions
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    stats["chat_completions"] += 1
+    body = await request.json()
+    if error := _inject_error():
+        return error
+
+    response_format = body.get("response_format") or {}
+    json_schema = response_format.get("json_schema") if response_format.get("type") == "json_schema" else None
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", "mock")
+    prompt_tokens, cached_tokens = prefix_cache.lookup(model, _segments(body.get("tools"), response_format, body.get("messages")))
+
+    def chat_usage(completion_tokens: int) -> dict:
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+    def chunk(delta: dict, finish_reason=None, usage=None, choices=True):
+        return _sse({
+            "id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+            "usage": usage,
+        })
+
+    async def stream():
+        deltas = _output_deltas(json_schema)
+        yield chunk({"role": "assistant", "content": ""})
+        async for delta in _pace(deltas, model):
+            yield chunk({"content": delta})
+        yield chunk({}, finish_reason="stop")
+        if include_usage:
+            yield chunk({}, usage=chat_usage(len(deltas)), choices=False)
+        yield "data: [DONE]\n\n"
+
+    if not body.get("stream"):
+        content = "".join(_output_deltas(json_schema))
+        return {"id": chunk_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": chat_usage(config.output_tokens)}
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+## Responses API
+def _last_user_text(input_items) -> str:
+    if isinstance(input_items, str):
+        return input_items
+    for item in reversed(input_items or []):
+        if item.get("role") == "user":
+            content = item.get("content")
+            if isinstance(content, str):
+                return content
+            return " ".join(part.get("text", "") for part in content or [] if isinstance(part, dict))
+    return ""
+
+
+def _wants_tool_call(body: dict) -> str | None:
+    """Name of the function tool to call, or None when the model should answer directly."""
+    tools = [tool for tool in body.get("tools") or [] if tool.get("type") == "function"]
+    if not tools:
+        return None
+    input_items = body.get("input")
+    # 收到 tool 的結果之後就回答 (結果後面可能還接著 developer message，見 prompt_cache.py)
+    if isinstance(input_items, list) and any(item.get("type") == "function_call_output" for item in input_items):
+        return None
+    if random.random() >= config.tool_call_prob:
+        return None
+    return tools[0]["name"]
+
+
+def _usage(input_tokens: int, cached_tokens: int, output_tokens: int) -> dict:
+    return {
+        "input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": cached_tokens},
+        "output_tokens": output_tokens, "output_tokens_details": {"reasoning_tokens": 0},
+        "total_tokens": input_tokens + output_tokens,
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    stats["responses"] += 1
+    raw = await request.body()
+    stats["request_bytes"] += len(raw)
+    body = json.loads(raw)
+    if error := _inject_error():
+        return error
+    previous_response_id = body.get("previous_response_id")
+    if previous_response_id and previous_response_id not in stored_responses:
+        return JSONResponse(status_code=404, content={"error": {
+            "message": f"Previous response with id '{previous_response_id}' not found.", "type": "invalid_request_error",
+            "param": "previous_response_id", "code": "previous_response_not_found"}})
+
+    response_id = f"resp_{uuid.uuid4().hex}"
+    model = body.get("model", "mock")
+    text_format = (body.get("text") or {}).get("format") or {}
+    json_schema = text_format if text_format.get("type") == "json_schema" else None
+    tool_name = _wants_tool_call(body)
+    input_tokens, cached_tokens = prefix_cache.lookup(
+        model, _segments(body.get("tools"), body.get("instructions"), text_format, body.get("input")))
+    if previous_response_id:
+        # 前面的 context 在 upstream，不用重新上傳，但一樣算 input tokens
+        input_tokens += stored_responses[previous_response_id]
+    seq = 0
+
+    def event(data: dict) -> str:
+        nonlocal seq
+        data["sequence_number"] = seq
+        seq += 1
+        return _sse(data, data["type"])
+
+    def response_object(status: str, output: list, usage=None) -> dict:
+        return {
+            "id": response_id, "object": "response", "created_at": time.time(), "model": model,
+            "status": status, "output": output, "usage": usage, "parallel_tool_calls": True,
+            "tool_choice": "auto", "tools": body.get("tools") or [], "error": None, "incomplete_details": None,
+            "instructions": body.get("instructions"), "metadata": {}, "temperature": None, "top_p": None,
+        }
+
+    async def stream():
+        output = []
+        yield event({"type": "response.created", "response": response_object("in_progress", [])})
+
+        if body.get("reasoning") and config.reasoning:
+            await asyncio.sleep(config.ttft_ms / 2000 / _speed(model))
+            item = {"id": f"rs_{uuid.uuid4().hex}", "type": "reasoning", "summary": []}
+            yield event({"type": "response.output_item.added", "output_index": len(output), "item": dict(item)})
+            summary = "**Planning** " + "".join(_tokens(20)).strip()
+            yield event({"type": "response.reasoning_summary_text.done", "item_id": item["id"], "output_index": len(output),
+                         "summary_index": 0, "text": summary})
+            item["summary"] = [{"type": "summary_text", "text": summary}]
+            yield event({"type": "response.output_item.done", "output_index": len(output), "item": item})
+            output.append(item)
+
+        if tool_name:
+            await asyncio.sleep(config.ttft_ms / 1000 / _speed(model))
+            item = {"id": f"fc_{uuid.uuid4().hex}", "type": "function_call", "status": "completed",
+                    "call_id": f"call_{uuid.uuid4().hex}", "name": tool_name,
+                    "arguments": json.dumps({"query": _last_user_text(body.get("input"))[:100]}, ensure_ascii=False)}
+            yield event({"type": "response.output_item.added", "output_index": len(output), "item": dict(item, arguments="")})
+            arguments = item["arguments"]
+            step = max(1, len(arguments) // 4)
+            for start in range(0, len(arguments), step):
+                yield event({"type": "response.function_call_arguments.delta", "item_id": item["id"], "output_index": len(output),
+                             "delta": arguments[start:start + step]})
+            yield event({"type": "response.function_call_arguments.done", "item_id": item["id"], "output_index": len(output),
+                         "arguments": arguments})
+            # 參數送完之後 model 還在產生 (例如其他 output item)，SDK 要等到 response.completed 才執行 tool
+            await asyncio.sleep(config.tool_call_tail_ms / 1000 / _speed(model))
+            yield event({"type": "response.output_item.done", "output_index": len(output), "item": item})
+            output.append(item)
+            output_tokens = 20
+        else:
+            message_id = f"msg_{uuid.uuid4().hex}"
+            index = len(output)
+            yield event({"type": "response.output_item.added", "output_index": index,
+                         "item": {"id": message_id, "type": "message", "role": "assistant", "status": "in_progress", "content": []}})
+            yield event({"type": "response.content_part.added", "item_id": message_id, "output_index": index, "content_index": 0,
+                         "part": {"type": "output_text", "text": "", "annotations": []}})
+            deltas = []
+            async for delta in _pace(_output_deltas(json_schema), model):
+                deltas.append(delta)
+                yield event({"type": "response.output_text.delta", "item_id": message_id, "output_index": index,
+                             "content_index": 0, "delta": delta, "logprobs": []})
+            text = "".join(deltas)
+            part = {"type": "output_text", "text": text, "annotations": []}
+            yield event({"type": "response.output_text.done", "item_id": message_id, "output_index": index,
+                         "content_index": 0, "text": text, "logprobs": []})
+            yield event({"type": "response.content_part.done", "item_id": message_id, "output_index": index,
+                         "content_index": 0, "part": part})
+            item = {"id": message_id, "type": "message", "role": "assistant", "status": "completed", "content": [part]}
+            yield event({"type": "response.output_item.done", "output_index": index, "item": item})
+            output.append(item)
+            output_tokens = len(deltas)
+
+        stored_responses[response_id] = input_tokens + output_tokens
+        if len(stored_responses) > MAX_STORED_RESPONSES:
+            stored_responses.popitem(last=False)
+        yield event({"type": "response.completed", "response": response_object("completed", output, _usage(input_tokens, cached_tokens, output_tokens))})
+
+    if not body.get("stream"):
+        # 非串流 (Runner.run): 一樣的延遲，最後回傳 response.completed 裡的 response
+        async for chunk in stream():
+            last = chunk
+        return JSONResponse(json.loads(last.split("data: ", 1)[1])["response"])
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+## Tavily
+@app.post("/search")
+async def search(request: Request):
+    stats["search"] += 1
+    body = await request.json()
+    await asyncio.sleep(config.search_latency_ms / 1000)
+    query = body.get("query", "")
+    return {
+        "query": query,
+        "answer": None,
+        "images": [],
+        "results": [
+            {"title": f"{query} #{i}", "url": f"https://example.com/{i}", "content": "".join(_tokens(60)), "score": 0.9 - i * 0.1}
+            for i in range(5)
+        ],
+        "response_time": config.search_latency_ms / 1000,
+    }
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", **stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI / Tavily upstream for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--tokens-per-sec", type=float, default=config.tokens_per_sec)
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms)
+    parser.add_argument("--output-tokens", type=int, default=config.output_tokens)
+    parser.add_argument("--tool-call-prob", type=float, default=config.tool_call_prob)
+    parser.add_argument("--no-reasoning", action="store_true", help="never emit reasoning summaries")
+    parser.add_argument("--error-rate", type=float, default=config.error_rate)
+    parser.add_argument("--error-status", type=int, default=config.error_status, help="500 or 429")
+    parser.add_argument("--search-latency-ms", type=float, default=config.search_latency_ms)
+    parser.add_argument("--model-speedup", default=None, help="per-model speed factors, e.g. gpt-5-nano=3,gpt-4.1-mini=1.5")
+    parser.add_argument("--cache-min-tokens", type=int, default=config.cache_min_tokens,
+                        help="shortest prompt prefix the simulated prompt cache will hit (OpenAI: 1024)")
+    parser.add_argument("--tool-call-tail-ms", type=float, default=config.tool_call_tail_ms,
+                        help="delay between the end of function_call arguments and response.completed")
+    args = parser.parse_args()
+
+    config.tokens_per_sec = args.tokens_per_sec
+    config.ttft_ms = args.ttft_ms
+    config.output_tokens = args.output_tokens
+    config.tool_call_prob = args.tool_call_prob
+    config.reasoning = config.reasoning and not args.no_reasoning
+    config.error_rate = args.error_rate
+    config.error_status = args.error_status
+    config.search_latency_ms = args.search_latency_ms
+    config.cache_min_tokens = args.cache_min_tokens
+    config.tool_call_tail_ms = args.tool_call_tail_ms
+    if args.model_speedup is not None:
+        config.model_speedup = _parse_speedup(args.model_speedup)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Model router: 依問題的難易度選 model 和 reasoning effort
+#
+# QA agent 原本每個 request 都用固定的 model (gpt-5-mini / gpt-5.1)，連「你好」「謝謝」也一樣，
+# 這裡用便宜的本地規則 (不呼叫 LLM) 把簡單的問題分到小 model:
+#   - fast:    很短、沒有要查資料的意圖、沒有對話歷史 (例如打招呼、常識問題) -> ROUTER_FAST_MODEL + ROUTER_FAST_EFFORT
+#   - default: 其他所有問題 -> agent 原本的 model 和設定，不影響難的問題的回答品質
+#
+# MODEL_ROUTER 設定模式:
+#   off     不分流
+#   shadow  (預設) 照原本的 model 跑，只記錄 (log + /metrics) 如果打開會選哪一個，先觀察分流比例再決定要不要打開
+#   on      套用分流結果
+#
+# 套用的方式是 RunConfig(model=..., model_settings=...) 覆蓋這次 run 的 model，共用的 agent 本身不變。
+# GET /api/model_router/stats 是各 endpoint 的分流數量，StreamTimer 依 model 記錄的 TTFT 可以比較兩邊的延遲。
+
+import os
+import re
+from dataclasses import dataclass, field
+
+from stream_metrics import metrics
+from structured_logging import get_logger
+
+logger = get_logger("model_router")
+
+MODEL_ROUTER = os.environ.get("MODEL_ROUTER", "shadow").lower()  # off / shadow / on
+ROUTER_FAST_MODEL = os.environ.get("ROUTER_FAST_MODEL", "gpt-5-nano")
+ROUTER_FAST_EFFORT = os.environ.get("ROUTER_FAST_EFFORT", "minimal") or None  # 空字串: 不改 reasoning effort
+ROUTER_FAST_MAX_CHARS = int(os.environ.get("ROUTER_FAST_MAX_CHARS", "60"))
+ROUTER_FAST_MAX_HISTORY = int(os.environ.get("ROUTER_FAST_MAX_HISTORY", "1"))  # AG-UI messages 數量 (含這次的問題)
+
+TIER_FAST = "fast"
+TIER_DEFAULT = "default"
+
+# 要查最新資料 (一定會呼叫 web_search)，或問題本身需要推理的關鍵字
+_SEARCH_INTENT = re.compile(
+    r"https?://|\b(19|20)\d\d\b|最新|今天|今年|現在|目前|新聞|股價|價格|匯率|天氣|搜尋|查一下|幫我查|"
+    r"\b(latest|today|current|news|price|weather|search|look up|recent)\b",
+    re.IGNORECASE,
+)
+_REASONING_INTENT = re.compile(
+    r"比較|分析|為什麼|如何|怎麼|步驟|證明|計算|程式|優缺點|\b(compare|analy[sz]e|why|how|explain|steps?|prove|calculate|code|pros)\b",
+    re.IGNORECASE,
+)
+
+routed_requests = metrics.counter("model_route_total", "QA agent requests by router decision.", ("endpoint", "tier", "mode"))
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    tier: str
+    model: str
+    effort: str | None = None
+    reasons: tuple[str, ...] = field(default_factory=tuple)
+    applied: bool = False
+
+    def run_config_kwargs(self, agent) -> dict:
+        """RunConfig(model=..., model_settings=...) overrides for this run; empty when the agent's own model is used."""
+        if not self.applied or self.tier == TIER_DEFAULT:
+            return {}
+        from agents import ModelSettings
+
+        kwargs = {"model": self.model}
+        if self.effort:
+            reasoning = agent.model_settings.reasoning
+            if reasoning is not None and not isinstance(reasoning, dict):
+                reasoning = reasoning.model_dump(exclude_none=True)
+            # 保留 agent 的其他 reasoning 設定 (例如 summary)，只換 effort
+            kwargs["model_settings"] = ModelSettings(reasoning={**(reasoning or {}), "effort": self.effort})
+        return kwargs
+
+
+def classify(query: str, history: int = 0, previous_response_id: str | None = None) -> tuple[str, tuple[str, ...]]:
+    """(tier, reasons) from cheap local signals: length, search / reasoning intent and conversation history."""
+    text = query.strip()
+    reasons = []
+    if len(text) > ROUTER_FAST_MAX_CHARS:
+        reasons.append("long")
+    if _SEARCH_INTENT.search(text):
+        reasons.append("search_intent")
+    if _REASONING_INTENT.search(text):
+        reasons.append("reasoning_intent")
+    if previous_response_id or history > ROUTER_FAST_MAX_HISTORY:
+        reasons.append("history")  # 追問要看前文，簡短的「那另一個呢?」不一定簡單
+    return (TIER_DEFAULT if reasons else TIER_FAST), tuple(reasons)
+
+
+def route(endpoint: str, agent, query: str, history: int = 0, previous_response_id: str | None = None) -> RouteDecision:
+    """Pick the model for this request (see MODEL_ROUTER for off / shadow / on)."""
+    if MODEL_ROUTER == "off":
+        return RouteDecision(TIER_DEFAULT, agent.model)
+    tier, reasons = classify(query, history, previous_response_id)
+    applied = MODEL_ROUTER == "on"
+    if tier == TIER_FAST:
+        decision = RouteDecision(tier, ROUTER_FAST_MODEL, ROUTER_FAST_EFFORT, reasons, applied)
+    else:
+        decision = RouteDecision(tier, agent.model, None, reasons, applied)
+    routed_requests.inc((endpoint, tier, MODEL_ROUTER))
+    logger.info("model route", extra={"endpoint": endpoint, "tier": tier, "model": decision.model,
+                                      "reasons": ",".join(reasons), "mode": MODEL_ROUTER})
+    return decision
+
+
+def model_for(decision: RouteDecision, agent) -> str:
+    """Model this request actually runs on (for admission and metrics labels)."""
+    return decision.model if decision.applied else agent.model
+
+
+def router_stats() -> dict:
+    stats = {"mode": MODEL_ROUTER, "fast_model": ROUTER_FAST_MODEL, "fast_effort": ROUTER_FAST_EFFORT, "endpoints": {}}
+    for (endpoint, tier, mode), count in routed_requests.items():
+        if mode == MODEL_ROUTER:
+            stats["endpoints"].setdefault(endpoint, {})[tier] = int(count)
+    return stats
@@ -2,24 +2,26 @@
 # 改用 OpenAI 和 Tavily search
 
 import asyncio
-import aiohttp
 import json
 
 from typing import List
 from pydantic import Field, BaseModel
 
-from openai import AsyncOpenAI
 from tavily import TavilyClient
 
 import os
 from dotenv import load_dotenv
 load_dotenv(".env", override=True)
 
+from http_clients import openai_client as pooled_openai_client, jina_session, close_http_clients
+# 固定的任務說明放在 system，會變的內容 (問題、網頁) 依穩定程度往後放，讓 prompt cache 命中，見 prompt_cache.py
+from prompt_cache import cache_friendly_messages
+
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY") 
 TAVILY_API_KEY = os.environ.get("TAVILY_API_KEY") 
 JINA_API_KEY = os.environ.get("JINA_API_KEY")
 
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+openai_client = pooled_openai_client(api_key=OPENAI_API_KEY)
 tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
 
 JINA_BASE_URL = "https://r.jina.ai/"
@@ -36,10 +38,8 @@ async def generate_first_search_queries(user_query):
         "precise search queries that would help gather comprehensive information on the topic. "
         "Return only a list of strings, for example: ['query1', 'query2', 'query3']."
     )
-    messages = [
-        {"role": "system", "content": "You are a helpful and precise research assistant."},
-        {"role": "user", "content": f"User Query: {user_query}\n\n{prompt}"}
-    ]
+    messages = cache_friendly_messages("You are a helpful and precise research assistant.", prompt,
+                                       ("User Query", user_query))
 
     completion = await openai_client.beta.chat.completions.parse(
         model="gpt-4o-mini",
@@ -67,14 +67,13 @@ async def fetch_webpage_text(url):
         "Authorization": f"Bearer {JINA_API_KEY}"
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(full_url, headers=headers) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    text = await resp.text()
-                    print(f"Jina fetch error for {url}: {resp.status} - {text}")
-                    return ""
+        async with jina_session().get(full_url, headers=headers) as resp:
+            if resp.status == 200:
+                return await resp.text()
+            else:
+                text = await resp.text()
+                print(f"Jina fetch error for {url}: {resp.status} - {text}")
+                return ""
     except Exception as e:
         print(f"從 Jina 獲取網頁內容時發生錯誤：{e}")
         return ""
@@ -88,10 +87,9 @@ async def is_page_useful(user_query, page_text):
         "determine if the webpage contains information relevant and useful for addressing the query. "
         "Respond with exactly one word: 'Yes' if the page is useful, or 'No' if it is not. Do not include any extra text."
     )
-    messages = [
-        {"role": "system", "content": "You are a strict and concise evaluator of research relevance."},
-        {"role": "user", "content": f"User Query: {user_query}\n\nWebpage Content (first 20000 characters):\n{page_text[:20000]}\n\n{prompt}"}
-    ]
+    messages = cache_friendly_messages("You are a strict and concise evaluator of research relevance.", prompt,
+                                       ("User Query", user_query),
+                                       ("Webpage Content (first 20000 characters)", page_text[:20000]))
 
     completion = await openai_client.beta.chat.completions.parse(
         model="gpt-4o-mini",
@@ -108,10 +106,10 @@ async def extract_relevant_context(user_query, search_query, page_text):
         "and the webpage content, extract all pieces of information that are relevant to answering the user's query. "
         "Return only the relevant context as plain text without commentary."
     )
-    messages = [
-        {"role": "system", "content": "You are an expert in extracting and summarizing relevant information."},
-        {"role": "user", "content": f"User Query: {user_query}\nSearch Query: {search_query}\n\nWebpage Content (first 20000 characters):\n{page_text[:20000]}\n\n{prompt}"}
-    ]
+    messages = cache_friendly_messages("You are an expert in extracting and summarizing relevant information.", prompt,
+                                       ("User Query", user_query),
+                                       ("Search Query", search_query),
+                                       ("Webpage Content (first 20000 characters)", page_text[:20000]))
 
     response = await openai_client.chat.completions.create(
         model=DEFAULT_MODEL,
@@ -127,10 +125,10 @@ async def get_new_search_queries(user_query, previous_search_queries, all_contex
         "If further research is needed, provide up to four new search queries as a Python list (for example, "
         "['new query1', 'new query2']). If you believe no further research is needed, respond with exactly [] empty list."
     )
-    messages = [
-        {"role": "system", "content": "You are a systematic research planner."},
-        {"role": "user", "content": f"User Query: {user_query}\nPrevious Search Queries: {previous_search_queries}\n\nExtracted Relevant Contexts:\n{context_combined}\n\n{prompt}"}
-    ]
+    messages = cache_friendly_messages("You are a systematic research planner.", prompt,
+                                       ("User Query", user_query),
+                                       ("Extracted Relevant Contexts", context_combined),
+                                       ("Previous Search Queries", str(previous_search_queries)))
 
     completion = await openai_client.beta.chat.completions.parse(
         model="gpt-4o-mini",
@@ -149,10 +147,9 @@ async def generate_final_report(user_query, all_contexts):
         "Include all relevant insights and conclusions without extraneous commentary."
         "輸出請用台灣繁體中文"
     )
-    messages = [
-        {"role": "system", "content": "You are a skilled report writer."},
-        {"role": "user", "content": f"User Query: {user_query}\n\nGathered Relevant Contexts:\n{context_combined}\n\n{prompt}"}
-    ]
+    messages = cache_friendly_messages("You are a skilled report writer.", prompt,
+                                       ("User Query", user_query),
+                                       ("Gathered Relevant Contexts", context_combined))
 
     print("--------------------------------")
     print(f"最終報告生成 prompt (共有 {len(all_contexts)} 筆參考資料): ", messages)
@@ -248,8 +245,14 @@ async def async_main():
     print(final_report)
 
 
+async def run_and_close():
+    try:
+        await async_main()
+    finally:
+        await close_http_clients()
+
 def main():
-    asyncio.run(async_main())
+    asyncio.run(run_and_close())
 
 if __name__ == "__main__":
     main()
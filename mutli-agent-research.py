@@ -4,24 +4,26 @@
 #
 
 from pydantic import BaseModel, Field
-from agents import Agent, Runner, function_tool, WebSearchTool, ModelSettings
+from agents import Agent, Runner, function_tool, WebSearchTool, ModelSettings, set_default_openai_client
 import datetime
-import aiohttp
 import os
 
-from tavily import AsyncTavilyClient
 
 from dotenv import load_dotenv
 load_dotenv(".env", override=True)
 
+from http_clients import openai_client, tavily_client as pooled_tavily_client, jina_session, close_http_clients
+
 TAVILY_API_KEY = os.environ.get("TAVILY_API_KEY") 
 JINA_API_KEY = os.environ.get("JINA_API_KEY")
 
-tavily_client = AsyncTavilyClient(api_key=TAVILY_API_KEY)
+tavily_client = pooled_tavily_client(api_key=TAVILY_API_KEY)
+set_default_openai_client(openai_client())
 
+# 日期放在 prompt 最後面: 前面幾千 tokens 的固定說明隔天也能命中 prompt cache (見 prompt_cache.py)
 today = datetime.datetime.now().strftime('%Y-%m-%d')
 
-sub_agent_prompt = f"""You are a research subagent working as part of a team. The current date is {today}. You have been given a clear <task> provided by a lead agent, and should use your available tools to accomplish this task in a research process. Follow the instructions below closely to accomplish your specific <task> well:
+sub_agent_prompt = f"""You are a research subagent working as part of a team. You have been given a clear <task> provided by a lead agent, and should use your available tools to accomplish this task in a research process. Follow the instructions below closely to accomplish your specific <task> well:
 
 <research_process>
 1. **Planning**: First, think through the task thoroughly using generate_plan tool. Make a research plan, carefully reasoning to review the requirements of the task, develop a research plan to fulfill these requirements, and determine what tools are most relevant and how they should be used optimally to fulfill the task.
@@ -66,9 +68,11 @@ For maximum efficiency, whenever you need to perform multiple independent operat
 To prevent overloading the system, it is required that you stay under a limit of 20 tool calls and under about 100 sources. This is the absolute maximum upper limit. If you exceed this limit, the subagent will be terminated. Therefore, whenever you get to around 15 tool calls or 100 sources, make sure to stop gathering sources, and instead return answer immediately. Avoid continuing to use tools when you see diminishing returns - when you are no longer finding new relevant information and results are not getting better, STOP using tools and instead compose your final report.
 </maximum_tool_call_limit>
 
-Follow the <research_process> and the <research_guidelines> above to accomplish the task, making sure to parallelize tool calls for maximum efficiency. Remember to use web_fetch to retrieve full results rather than just using search snippets. Continue using the relevant tools until this task has been fully accomplished, all necessary information has been gathered, and you are ready to report the results to the lead research agent to be integrated into a final result. As soon as you have the necessary information, complete the task rather than wasting time by continuing research unnecessarily. As soon as the task is done, immediately return and provide your detailed, condensed, complete, accurate report to the lead researcher."""
+Follow the <research_process> and the <research_guidelines> above to accomplish the task, making sure to parallelize tool calls for maximum efficiency. Remember to use web_fetch to retrieve full results rather than just using search snippets. Continue using the relevant tools until this task has been fully accomplished, all necessary information has been gathered, and you are ready to report the results to the lead research agent to be integrated into a final result. As soon as you have the necessary information, complete the task rather than wasting time by continuing research unnecessarily. As soon as the task is done, immediately return and provide your detailed, condensed, complete, accurate report to the lead researcher.
+
+The current date is {today}."""
 
-lead_agent_prompt = f"""You are an expert research lead, focused on high-level research strategy, planning, efficient delegation to subagents, and final report writing. Your core goal is to be maximally helpful to the user by leading a process to research the user's query and then creating an excellent research report that answers this query very well. Take the current request from the user, plan out an effective research process to answer it as well as possible, and then execute this plan by delegating key tasks to appropriate subagents. The current date is {today}.
+lead_agent_prompt = f"""You are an expert research lead, focused on high-level research strategy, planning, efficient delegation to subagents, and final report writing. Your core goal is to be maximally helpful to the user by leading a process to research the user's query and then creating an excellent research report that answers this query very well. Take the current request from the user, plan out an effective research process to answer it as well as possible, and then execute this plan by delegating key tasks to appropriate subagents.
 
 <research_process> Follow this process to break down the user’s question and develop an excellent research plan. Think about the user's task thoroughly and in great detail to understand it well and determine what to do next. Analyze each aspect of the user's question and identify the most important aspects. Consider multiple approaches with complete, thorough reasoning. Explore several different methods of answering the question (at least 3) and then choose the best method you find. Follow this process closely:
 
@@ -205,7 +209,9 @@ NEVER create a subagent to generate the final report - YOU write and craft this
 Avoid creating subagents to research topics that could cause harm. Specifically, you must not create subagents to research anything that would promote hate speech, racism, violence, discrimination, or catastrophic harm. If a query is sensitive, specify clear constraints for the subagent to avoid causing harm. </important_guidelines>
 You have a query provided to you by the user, which serves as your primary goal. You should do your best to thoroughly accomplish the user's task. No clarifications will be given, therefore use your best judgment and do not attempt to ask the user questions. Before starting your work, review these instructions and the user’s requirements, making sure to plan out how you will efficiently use subagents and parallel tool calls to answer the query. Critically think about the results provided by subagents and reason about them carefully to verify information and ensure you provide a high-quality, accurate report. Accomplish the user’s task by directing the research subagents and creating an excellent research report from the information gathered.
 
-最後報告輸出請用台灣繁體中文"""
+最後報告輸出請用台灣繁體中文
+
+The current date is {today}."""
 
 @function_tool
 async def web_search(query: str):
@@ -233,14 +239,13 @@ async def web_fetch(url: str) -> str:
         "Authorization": f"Bearer {JINA_API_KEY}"
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(full_url, headers=headers) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    text = await resp.text()
-                    print(f"Jina fetch error for {url}: {resp.status} - {text}")
-                    return ""
+        async with jina_session().get(full_url, headers=headers) as resp:
+            if resp.status == 200:
+                return await resp.text()
+            else:
+                text = await resp.text()
+                print(f"Jina fetch error for {url}: {resp.status} - {text}")
+                return ""
     except Exception as e:
         print(f"從 Jina 獲取網頁內容時發生錯誤：{e}")
         return ""
@@ -278,7 +283,10 @@ if __name__ == "__main__":
     query = "請研究 2025年 AI 在軟體開發領域的最新發展趨勢"
     
     async def main():
-        result = await Runner.run(lead_agent, query, max_turns=100) # Default is 10
-        print(result)
+        try:
+            result = await Runner.run(lead_agent, query, max_turns=100) # Default is 10
+            print(result)
+        finally:
+            await close_http_clients()
     
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,102 @@
+# Prompt caching: 讓 OpenAI 的 prompt prefix cache 命中
+#
+# OpenAI 會自動快取 prompt 的前綴 (至少 1024 tokens，之後每 128 tokens 一段)，命中的部分 (usage 的 cached_tokens)
+# 比較便宜、TTFT 也比較短。但前綴只要有一個 token 不同，後面就全部不能用快取，所以 prompt 的組法要:
+#   - 固定的內容放前面: system prompt、任務說明 (tools 和 instructions 本來就在最前面)
+#   - 會變的內容依穩定程度往後放: 使用者的問題 > 這次抓到的網頁 > 今天日期之類每次都可能不同的值
+#
+#   cache_friendly_messages(system, task, ("User Query", q), ("Webpage", page))   Chat Completions 的 messages
+#   Runner.run(agent, ..., run_config=volatile_run_config())                     今天日期接在 input 最後面，不寫進 instructions
+#   ModelSettings(extra_args=prompt_cache_args("qa_stream"))                       每種 agent 自己的 prompt_cache_key
+#   record_usage(endpoint, model, usage)                                           記錄 input / cached tokens
+#
+# GET /api/prompt_cache/stats 是每個 endpoint 的命中率，/metrics 有 prompt_input_tokens_total / prompt_cached_tokens_total。
+
+import os
+from datetime import datetime
+
+from stream_metrics import metrics
+
+# 多個部署共用同一個 OpenAI 帳號時，用前綴區分各自的 prompt_cache_key
+PROMPT_CACHE_KEY_PREFIX = os.environ.get("PROMPT_CACHE_KEY_PREFIX", "")
+
+_LABELS = ("endpoint", "model")
+prompt_requests = metrics.counter("prompt_requests_total", "Model calls with usage recorded.", _LABELS)
+prompt_input_tokens = metrics.counter("prompt_input_tokens_total", "Input (prompt) tokens sent upstream.", _LABELS)
+prompt_cached_tokens = metrics.counter("prompt_cached_tokens_total", "Input tokens served from the upstream prompt cache.", _LABELS)
+
+
+def cache_friendly_messages(system: str, task: str = "", *sections: tuple[str, str]) -> list[dict]:
+    """Chat messages with the fixed instructions first and the (title, text) sections after them.
+
+    Pass sections from the most stable (e.g. the user query shared by a whole research run)
+    to the least stable (e.g. the page fetched for this call).
+    """
+    messages = [{"role": "system", "content": f"{system}\n\n{task}" if task else system}]
+    if sections:
+        messages.append({"role": "user", "content": "\n\n".join(f"{title}:\n{text}" for title, text in sections)})
+    return messages
+
+
+def volatile_context() -> str:
+    """Values that change between requests; they go after everything that can be cached."""
+    return f"Today's date is {datetime.now().strftime('%Y-%m-%d')}."
+
+
+def append_volatile_context(data):
+    """call_model_input_filter: append volatile_context() to the end of the model input (not saved to the session)."""
+    from agents.run import ModelInputData
+
+    model_data = data.model_data
+    return ModelInputData(
+        input=[*model_data.input, {"role": "developer", "content": volatile_context()}],
+        instructions=model_data.instructions,
+    )
+
+
+def volatile_run_config(**kwargs):
+    """RunConfig for agents whose instructions used to contain today's date (kwargs go to RunConfig)."""
+    from agents import RunConfig
+
+    return RunConfig(call_model_input_filter=append_volatile_context, **kwargs)
+
+
+def prompt_cache_args(name: str) -> dict:
+    """ModelSettings.extra_args that route requests of the same agent to the same prompt cache."""
+    return {"prompt_cache_key": f"{PROMPT_CACHE_KEY_PREFIX}{name}"}
+
+
+def usage_tokens(usage) -> tuple[int, int]:
+    """(input tokens, cached tokens) from Agents SDK / Responses usage or Chat Completions usage."""
+    if usage is None:
+        return 0, 0
+    if hasattr(usage, "prompt_tokens"):
+        details = getattr(usage, "prompt_tokens_details", None)
+        return usage.prompt_tokens or 0, (getattr(details, "cached_tokens", 0) or 0)
+    details = getattr(usage, "input_tokens_details", None)
+    return getattr(usage, "input_tokens", 0) or 0, (getattr(details, "cached_tokens", 0) or 0)
+
+
+def record_usage(endpoint: str, model: str, usage):
+    input_tokens, cached_tokens = usage_tokens(usage)
+    if not input_tokens:
+        return
+    labels = (endpoint, str(model))
+    prompt_requests.inc(labels, getattr(usage, "requests", 1) or 1)  # agent run 的 usage 是好幾次 model 呼叫的加總
+    prompt_input_tokens.inc(labels, input_tokens)
+    prompt_cached_tokens.inc(labels, cached_tokens)
+
+
+def prompt_cache_stats() -> dict:
+    """{endpoint: {model: requests, input / cached tokens and the token-weighted hit rate}}"""
+    stats = {}
+    for labels, input_tokens in prompt_input_tokens.items():
+        endpoint, model = labels
+        cached_tokens = prompt_cached_tokens.get(labels)
+        stats.setdefault(endpoint, {})[model] = {
+            "requests": int(prompt_requests.get(labels)),
+            "input_tokens": int(input_tokens),
+            "cached_tokens": int(cached_tokens),
+            "hit_rate": round(cached_tokens / input_tokens, 3) if input_tokens else 0,
+        }
+    return stats
@@ -0,0 +1,196 @@
+# Agents SDK 的部分: tools、各種 QA agent 的定義、v2 的 session
+#
+# import agents / openai / tavily 要好幾秒，所以 main.py 不在 import 時載入這個模組，
+# 而是在 server 開始接連線之後由背景 warm-up 載入 (見 warmup.py)，endpoint 先 await warmup.wait() 再使用。
+#
+# instructions 都是固定的字串 (今天日期由 main.py 的 run_config 接在 input 最後面)，
+# 每種 agent 有自己的 prompt_cache_key，讓 upstream 的 prompt cache 命中，見 prompt_cache.py。
+
+import os
+from dataclasses import dataclass, field
+
+from agents import Agent, ModelSettings, RunContextWrapper, function_tool, set_default_openai_client
+from pydantic import BaseModel, Field
+
+from agent_registry import AgentRegistry, output_schema
+from conversation_state import ConversationState
+from custom_sqlite_session import CustomSQLiteSession
+from http_clients import default_openai_client, tavily_client as pooled_tavily_client
+from prompt_cache import prompt_cache_args
+from search_cache import SearchCache
+from source_store import SourceStore
+from speculative_tools import Speculation, speculative_tool
+from tool_compaction import compact_search_output
+from structured_logging import get_logger
+
+logger = get_logger("qa_agents")
+
+# Agents SDK 也用同一個 OpenAI client (同一個連線池)，見 http_clients.py
+set_default_openai_client(default_openai_client())
+
+tavily_client = pooled_tavily_client()
+
+# 相同的查詢在 TTL 內直接用快取，同時進行中的相同查詢只打一次 Tavily，見 search_cache.py
+search_cache = SearchCache(tavily_client)
+
+# 兩個 search tool 都沒有副作用，SPECULATIVE_TOOLS=1 時可以在參數串流完就先開始查，見 speculative_tools.py
+speculative_tool("web_search", lambda args: search_cache.search(args["query"]))
+speculative_tool("knowledge_search", lambda args: search_cache.search(args["query"]))
+
+# 每種 agent 只在啟動時建立一次，見 agent_registry.py
+agent_registry = AgentRegistry()
+
+
+class QueryResult(BaseModel):
+    content: str
+    following_questions: list[str] = Field(description="3 follow-up questions exploring different aspects of the topic.")
+
+
+# 加上 context 參數 https://openai.github.io/openai-agents-python/context/
+@dataclass
+class CustomAgentContext:
+  search_source: SourceStore = field(default_factory=SourceStore)  # 查到的來源 (精簡的紀錄，內容需要時再讀)，見 source_store.py
+  thread_id: str | None = None
+  speculation: Speculation | None = None
+
+
+async def cached_search(wrapper: RunContextWrapper, tool: str, query: str) -> dict:
+    """Search result for the tool call, reusing the run's speculative search when one was started with the same query."""
+    speculation = getattr(wrapper.context, "speculation", None)
+    task = speculation.take(tool, {"query": query}) if speculation else None
+    return await (task or search_cache.search(query))
+
+
+@function_tool
+async def web_search(wrapper: RunContextWrapper, query: str) -> str:
+    """
+    Search the web for information
+
+    Args:
+        query: The query keyword to search the web for.
+    """
+
+    logger.info("⚙️ 呼叫函式 web_search 參數: %s", query)
+
+    response = await cached_search(wrapper, "web_search", query)
+
+    logger.debug("⚙️ 呼叫函式 web_search 結果: %s", response)
+
+    # 來源留在 context (見 source_store.py)，給 model 的是壓縮過的版本，見 tool_compaction.py
+    if isinstance(wrapper.context, CustomAgentContext):
+        wrapper.context.search_source.add(query, response)
+
+    return compact_search_output("web_search", response["results"], str(response["results"])).text
+
+
+## Chat Agent + Streaming + Structured Output
+agent_registry.register("qa_stream", lambda: Agent(
+    name="QA Agent",
+    instructions="""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese.""",
+    tools=[web_search],
+    model="gpt-5-mini",
+    output_type=output_schema(QueryResult),
+    model_settings=ModelSettings(
+        reasoning = {
+            "effort": "low",
+            "summary": "auto"
+        },
+        extra_args=prompt_cache_args("qa_stream"),
+    )
+))
+
+
+## Simple Agent (非串流)
+agent_registry.register("qa_simple", lambda: Agent(
+    name="QA Agent",
+    instructions="""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese. """,
+    tools=[web_search],
+    model="gpt-5.1",
+    model_settings=ModelSettings(extra_args=prompt_cache_args("qa_simple")),
+))
+
+
+## Simple Agent Streaming (串流但不使用 structured output)
+agent_registry.register("qa_simple_stream", lambda: Agent(
+    name="QA Agent",
+    instructions="""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese.""",
+    tools=[web_search],
+    model="gpt-5.1",
+    model_settings=ModelSettings(
+        reasoning={
+            "effort": "low",
+            "summary": "auto"
+        },
+        extra_args=prompt_cache_args("qa_simple_stream"),
+    )
+))
+
+
+@function_tool
+async def knowledge_search(wrapper: RunContextWrapper[CustomAgentContext], query: str) -> str:
+    """
+    Search the web for information
+
+    Args:
+        query: The query keyword to search the web for.
+    """
+
+    logger.info("⚙️ 呼叫函式 knowledge_search 參數: %s", query)
+
+    response = await cached_search(wrapper, "knowledge_search", query)
+
+    wrapper.context.search_source.add(query, response)
+
+    result = [ x["content"] for x in response["results"] ]
+
+    logger.debug("⚙️ 呼叫函式 knowledge_search 結果: %s", result)
+
+    return compact_search_output("knowledge_search", response["results"], str(result), fields=("content",)).text
+
+
+## V2 版本: 增強 Context Engineering
+# from agents import SQLiteSession
+# from agents.extensions.memory import AdvancedSQLiteSession
+
+CONVERSATIONS_DB = os.environ.get("CONVERSATIONS_DB", "conversations.db")
+
+agent_registry.register("qa_v2", lambda: Agent[CustomAgentContext](
+    name="QA Agent",
+    instructions="""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese.""",
+    tools=[knowledge_search],
+    model="gpt-5-mini",
+    output_type=output_schema(QueryResult),
+    model_settings=ModelSettings(
+        reasoning = {
+            "effort": "low",
+            "summary": "auto"
+        },
+        extra_args=prompt_cache_args("qa_v2"),
+    )
+))
+
+
+def conversation_session(thread_id: str, agent: Agent) -> CustomSQLiteSession:
+    # session = SQLiteSession(thread_id, "conversations.db")
+    # session = AdvancedSQLiteSession(session_id=thread_id, create_tables=True, db_path="advanced_conversations.db")
+    return CustomSQLiteSession(thread_id, CONVERSATIONS_DB, agent=agent)
+
+
+# 能接著 previous_response_id 就不重送整個 session，見 conversation_state.py
+conversation_state = ConversationState(CONVERSATIONS_DB)
+
+
+## AG-UI
+agent_registry.register("qa_ag_ui", lambda: Agent(
+    name="QA Agent",
+    instructions="""You are a helpful assistant that can answer questions and help with tasks. Always respond in Traditional Chinese.""",
+    tools=[web_search],
+    model="gpt-5.1",
+    model_settings=ModelSettings(
+        reasoning={
+            "effort": "low",
+            "summary": "auto"
+        },
+        extra_args=prompt_cache_args("qa_ag_ui"),
+    )
+))
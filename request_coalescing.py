@@ -0,0 +1,64 @@
+# 無狀態 endpoint 的 request 合併: 很多人同時問一樣的問題 (例如新聞事件的流量高峰)，只打一次 upstream
+#
+#   - 串流 endpoint: key 相同的 request 接到進行中的 ResumableRun (見 resumable_stream.py)，
+#     先收到已經送出的部分，再接著收即時的 delta
+#   - 非串流 endpoint (agent_simple): SingleFlight，等同一個 task 的結果
+#
+# 只合併不帶對話狀態的 request (沒有 previous_response_id)，key = (endpoint, model, 正規化後的 query)。
+# model 是 agent 自己的 model: 路由只看 query，所以在 route() 之前就能算 key，合併到的 request 不會再路由一次。
+# 跑完就不再合併 (這不是快取)，之後相同的 query 會開新的 upstream 呼叫。COALESCE_REQUESTS=0 可以關掉。
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Hashable
+
+from search_cache import normalize_query
+from structured_logging import get_logger
+
+logger = get_logger("request_coalescing")
+
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1").lower() not in ("0", "false", "no")
+
+# 接到別人進行中 upstream 呼叫的 request 數量 (依 endpoint 分)
+coalesced_requests: dict[str, int] = {}
+
+
+def coalesce_key(endpoint: str, model: str, query: str, previous_response_id: str | None = None) -> Hashable | None:
+    """Key for identical stateless requests; None means the request must not be shared."""
+    if not COALESCE_REQUESTS or previous_response_id:
+        return None
+    return ("coalesce", endpoint, model, normalize_query(query))
+
+
+def count_coalesced(endpoint: str):
+    coalesced_requests[endpoint] = coalesced_requests.get(endpoint, 0) + 1
+    logger.info("coalesced request", extra={"endpoint": endpoint})
+
+
+class SingleFlight:
+    """Runs one call per key at a time; identical concurrent calls await the same task."""
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable | None, fn: Callable[[], Awaitable], endpoint: str = ""):
+        if key is None:
+            return await fn()
+        task = self._in_flight.get(key)
+        if task is not None:
+            count_coalesced(endpoint)
+        else:
+            # 獨立的 task: 第一個 request 被取消 (client 斷線)，也不會影響其他在等的人
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # 所有等待的人都已經離開時，避免 "exception was never retrieved"
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
@@ -0,0 +1,112 @@
+# Exact-match 回應快取: 相同 model + 相同 query 直接重播上次的串流，不花 upstream tokens
+#
+# 記憶體 LRU 為主，可選擇用 SQLite 持久化 (設定 RESPONSE_CACHE_DB)，server 重啟後仍然有效。
+# 快取的是原始的 chunk 列表，重播時照原本的 frame 格式 (每個 chunk 一個 `data:` 事件) 組成一整段、一次寫出，
+# 前端不需要改；內容已經完整，不需要再模擬逐字串流。
+
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))  # 秒
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "")  # 空字串代表只用記憶體
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    # 翻譯結果和大小寫有關，所以只正規化空白
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+class ResponseCache:
+    """In-memory LRU of streamed chunks with optional SQLite persistence."""
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_size: int = RESPONSE_CACHE_SIZE,
+                 db_path: str = RESPONSE_CACHE_DB, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, chunks)
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = None
+        self._lock = threading.Lock()
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, chunks TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, query: str) -> str:
+        return f"{model}\x00{normalize_query(query)}"
+
+    async def get(self, model: str, query: str) -> list[str] | None:
+        key = self.make_key(model, query)
+        now = self.clock()
+
+        entry = self._entries.get(key)
+        if entry is None and self._conn is not None:
+            entry = await asyncio.to_thread(self._db_get, key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is not None:
+            expires_at, chunks = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return chunks
+            self._entries.pop(key, None)
+
+        self.misses += 1
+        return None
+
+    async def set(self, model: str, query: str, chunks: list[str]):
+        key = self.make_key(model, query)
+        entry = (self.clock() + self.ttl, list(chunks))
+        self._remember(key, entry)
+        if self._conn is not None:
+            await asyncio.to_thread(self._db_set, key, entry)
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _db_get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT expires_at, chunks FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _db_set(self, key, entry):
+        expires_at, chunks = entry
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, chunks, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(chunks, ensure_ascii=False), expires_at),
+            )
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (self.clock(),))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "persistent": self._conn is not None,
+        }
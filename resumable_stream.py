@@ -0,0 +1,241 @@
+# 可續傳的 SSE 串流: 每個 run 有 id，送出的事件編號並保留在有上限的 replay buffer
+#
+# 手機切換網路時 EventSource 會帶著 Last-Event-ID 重送同一個 GET，原本這會開一個全新的 agent run
+# (tokens 和 tool call 都重花一次，使用者從頭等)。現在:
+#
+#   run = stream_runs.start(chunks, run_id)    run 在背景 task 跑，輸出寫進 buffer，不綁在某一條連線上
+#   run.subscribe(after=-1)                     從 buffer 讀事件，每個事件帶 `id: <run_id>:<seq>`
+#   重連時解析 Last-Event-ID，從 seq + 1 開始接續 (run 還在跑就繼續跟著即時輸出)
+#
+# 每條連線的第一個事件是只有 `id: <run_id>:-1` 的空事件，所以就算 run 還沒有任何輸出，EventSource 重連時也會帶 Last-Event-ID
+# 接回同一個 run，不會再開一個新的 run。run 失敗時最後送一個錯誤 frame (SSE 是 {"message":"ERROR"}，AG-UI 是 RUN_ERROR)，
+# 前端收到就關掉 EventSource；之後再重連 (帶 Last-Event-ID) 會拿到 204，EventSource 停止重連。
+#
+# 沒有任何連線在讀的 run 會在 RESUME_GRACE_SECONDS 後取消 (等於原本的斷線取消，只是給 client 重連的時間)，
+# 跑完的 run 保留 RESUME_TTL_SECONDS 供重連補齊最後的事件。
+#
+# 同一個 run 也可以廣播給多個 subscriber (例如同一個 thread 開在好幾個畫面上):
+#   stream_runs.start(chunks, key=(thread_id, query))   以 key 登記進行中的 run
+#   stream_runs.find_active(key)                        相同 key 的新連線直接訂閱，不再跑一次 agent
+# 每個 subscriber 只是 buffer 上的一個游標，不複製事件。落後超過 RESUME_SUBSCRIBER_MAX_LAG 個事件的慢 client
+# 會被斷線 (不拖慢 producer 和其他人)，它可以帶 Last-Event-ID 重連，從 buffer 接續。
+
+import asyncio
+import json
+import os
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import AsyncIterator, Callable, Hashable
+
+from structured_logging import get_logger
+
+logger = get_logger("resumable_stream")
+
+RESUME_BUFFER_EVENTS = int(os.environ.get("RESUME_BUFFER_EVENTS", "2000"))  # 每個 run 最多保留幾個事件
+RESUME_GRACE_SECONDS = float(os.environ.get("RESUME_GRACE_SECONDS", "15"))  # 沒人讀多久後取消 run
+RESUME_TTL_SECONDS = float(os.environ.get("RESUME_TTL_SECONDS", "60"))  # 跑完後保留多久
+RESUME_MAX_RUNS = int(os.environ.get("RESUME_MAX_RUNS", "1000"))
+RESUME_SUBSCRIBER_MAX_LAG = int(os.environ.get("RESUME_SUBSCRIBER_MAX_LAG", "500"))  # subscriber 最多落後幾個事件
+
+
+def format_event_id(run_id: str, seq: int) -> str:
+    return f"{run_id}:{seq}"
+
+
+def parse_event_id(value: str | None) -> tuple[str, int] | None:
+    """Parse a `Last-Event-ID` header of the form `<run_id>:<seq>`."""
+    if not value:
+        return None
+    run_id, _, seq = value.strip().rpartition(":")
+    if not run_id or not (seq.isdigit() or seq == "-1"):  # -1: 連線開頭的空事件，還沒收到任何輸出
+        return None
+    return run_id, int(seq)
+
+
+def sse_error(error: Exception) -> str:
+    """The terminal frame of a failed run, in the `data: {...}` format the static pages expect."""
+    data = {"message": "ERROR", "error": str(error) or type(error).__name__}
+    return f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+def with_event_id(chunk: str, event_id: str) -> str:
+    """Add an `id:` field to the last SSE event in chunk (a chunk may hold several events)."""
+    if chunk.endswith("\n\n"):
+        return f"{chunk[:-1]}id: {event_id}\n\n"
+    return f"{chunk}id: {event_id}\n\n"
+
+
+class ResumableRun:
+    """One run's numbered output: a bounded replay buffer plus live notification of new events."""
+
+    def __init__(self, run_id: str, max_events: int = RESUME_BUFFER_EVENTS, max_lag: int = RESUME_SUBSCRIBER_MAX_LAG,
+                 cancel_when_idle: bool = True):
+        self.run_id = run_id
+        self.cancel_idle = cancel_when_idle  # False: 沒有人在讀也繼續跑 (背景 job，見 jobs.py)
+        self.events: deque = deque(maxlen=max_events)  # (seq, chunk)
+        self.max_lag = max_lag
+        self.next_seq = 0
+        self.done = False
+        self.subscribers = 0
+        self.slow_consumers = 0
+        self.task: asyncio.Task | None = None
+        self._idle_handle: asyncio.TimerHandle | None = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: str):
+        self.events.append((self.next_seq, chunk))
+        self.next_seq += 1
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume(self, after: int) -> bool:
+        """True if every event after `after` is still in the buffer and there is something left to send."""
+        first = self.events[0][0] if self.events else self.next_seq
+        if after + 1 < first or after >= self.next_seq:
+            return False
+        return not (self.done and after + 1 >= self.next_seq)
+
+    async def subscribe(self, after: int = -1, on_first_event: Callable = None) -> AsyncIterator[str]:
+        """Yield SSE chunks (with ids) after seq `after`, following the run live until it finishes.
+
+        on_first_event is called once the first run event (not the id prelude) has been written to this connection.
+        """
+        self.subscribers += 1
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        try:
+            if after < 0:
+                # 先讓 EventSource 記住 run id: 第一個輸出之前斷線，重連也會帶 Last-Event-ID
+                yield f"id: {format_event_id(self.run_id, -1)}\n\n"
+            seq = after + 1
+            # 晚加入的 subscriber 要先追上已經 buffer 的事件，這段不算落後
+            max_lag = max(self.max_lag, self.next_seq - seq)
+            while True:
+                changed = self._changed
+                first = self.events[0][0] if self.events else self.next_seq
+                if seq < first:
+                    # client 太慢，要的事件已經被擠出 buffer，結束這條連線
+                    logger.warning("replay buffer overrun", extra={"run_id": self.run_id, "seq": seq, "first": first})
+                    return
+                for event_seq, chunk in list(islice(self.events, seq - first, None)):
+                    yield with_event_id(chunk, format_event_id(self.run_id, event_seq))
+                    seq = event_seq + 1
+                    if on_first_event is not None:
+                        # yield 回來時 StreamingResponse 已經 send() 完這個事件
+                        on_first_event()
+                        on_first_event = None
+                    if self.max_lag > 0 and self.next_seq - seq > max_lag:
+                        # 慢 client: 斷線讓它自己帶 Last-Event-ID 重連，不要讓 buffer 因為它而被撐滿
+                        self.slow_consumers += 1
+                        logger.warning("slow consumer disconnected", extra={"run_id": self.run_id, "lag": self.next_seq - seq})
+                        return
+                if self.done and seq >= self.next_seq:
+                    return
+                if seq >= self.next_seq:
+                    await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.cancel_when_idle()
+
+    def cancel_when_idle(self, grace: float = RESUME_GRACE_SECONDS):
+        """Cancel the run if no client subscribes within `grace` seconds."""
+        if not self.cancel_idle:
+            return
+        self._idle_handle = asyncio.get_running_loop().call_later(grace, self.cancel)
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            logger.info("no client attached, cancelling run", extra={"run_id": self.run_id})
+            self.task.cancel()
+
+
+class ResumableRunRegistry:
+    """Runs by id; each run's chunks are produced by a background task so they outlive a connection."""
+
+    def __init__(self, max_runs: int = RESUME_MAX_RUNS, ttl: float = RESUME_TTL_SECONDS,
+                 max_events: int = RESUME_BUFFER_EVENTS):
+        self.max_runs = max_runs
+        self.ttl = ttl
+        self.max_events = max_events
+        self.runs: OrderedDict[str, ResumableRun] = OrderedDict()
+        self.active: dict[Hashable, ResumableRun] = {}  # key -> 進行中的 run
+        self.resumed = 0
+        self.shared = 0
+
+    def get(self, run_id: str) -> ResumableRun | None:
+        return self.runs.get(run_id)
+
+    def find_active(self, key: Hashable) -> ResumableRun | None:
+        """A still-running run started with `key` whose output can be replayed from the beginning."""
+        run = self.active.get(key)
+        if run is None or run.done or not run.can_resume(-1):
+            return None
+        self.shared += 1
+        return run
+
+    def start(self, chunks: AsyncIterator[str], run_id: str | None = None, key: Hashable = None,
+              cancel_when_idle: bool = True, on_error: Callable[[Exception], str] | None = sse_error) -> ResumableRun:
+        """Run `chunks` in a background task; when it raises, `on_error(e)` is appended as the last event."""
+        run_id = run_id or uuid.uuid4().hex
+        self._evict()
+        run = ResumableRun(run_id, self.max_events, cancel_when_idle=cancel_when_idle)
+        self.runs[run_id] = run
+        if key is not None:
+            self.active[key] = run
+        run.task = asyncio.create_task(self._pump(run, chunks, key, on_error))
+        # 一直沒有連線來讀 (例如 client 在 response 開始前就斷了) 也要取消
+        run.cancel_when_idle()
+        return run
+
+    async def _pump(self, run: ResumableRun, chunks: AsyncIterator[str], key: Hashable = None,
+                    on_error: Callable[[Exception], str] | None = None):
+        try:
+            async for chunk in chunks:
+                run.append(chunk)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception("resumable run failed", extra={"run_id": run.run_id})
+            if on_error is not None:
+                # 讓 client 知道 run 已經結束，不要一直重連
+                run.append(on_error(e))
+        finally:
+            run.finish()
+            if key is not None and self.active.get(key) is run:
+                del self.active[key]
+            asyncio.get_running_loop().call_later(self.ttl, self._expire, run)
+
+    def _expire(self, run: ResumableRun):
+        if self.runs.get(run.run_id) is run:
+            del self.runs[run.run_id]
+
+    def _evict(self):
+        # 超過上限時先丟掉最舊的、已經跑完的 run
+        if len(self.runs) < self.max_runs:
+            return
+        for run_id, run in list(self.runs.items()):
+            if run.done:
+                del self.runs[run_id]
+                if len(self.runs) < self.max_runs:
+                    return
+
+    def stats(self) -> dict:
+        return {
+            "runs": len(self.runs),
+            "running": sum(1 for run in self.runs.values() if not run.done),
+            "subscribers": sum(run.subscribers for run in self.runs.values()),
+            "buffered_events": sum(len(run.events) for run in self.runs.values()),
+            "resumed": self.resumed,
+            "shared": self.shared,
+            "slow_consumers": sum(run.slow_consumers for run in self.runs.values()),
+        }
@@ -0,0 +1,97 @@
+# 搜尋結果快取: TTL + LRU，並合併同時進行中的相同查詢 (single-flight)
+#
+# 熱門問題常常在幾分鐘內被很多人問，每次都打 Tavily 會重複付出延遲和 quota。
+# 以正規化後的 query 為 key:
+#   - 命中且還沒過期: 直接回傳 (hits)
+#   - 相同 query 正在查詢中: 等同一個 upstream 呼叫的結果 (coalesced)
+#   - 其他: 呼叫 upstream 並放進快取 (misses)
+# 等同一個 upstream 呼叫的人全部取消時，upstream 呼叫也一起取消。
+
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "600"))  # 秒
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "1024"))  # 最多快取幾筆
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    return _WHITESPACE.sub(" ", query).strip().lower()
+
+
+class SearchCache:
+    """Async TTL/LRU cache with single-flight coalescing in front of a Tavily-like client."""
+
+    def __init__(self, client, ttl: float = SEARCH_CACHE_TTL, max_size: int = SEARCH_CACHE_SIZE, clock=time.monotonic):
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, response)
+        self._in_flight: dict = {}                  # key -> asyncio.Task
+        self._waiters: dict = {}                    # key -> 還在等 in-flight 結果的呼叫數
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def search(self, query: str, **kwargs) -> dict:
+        key = (normalize_query(query), tuple(sorted(kwargs.items())))
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self._entries[key]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # 獨立的 task: 第一個呼叫的人被取消，也不會影響其他在等的人
+            task = asyncio.ensure_future(self._fetch(key, query, kwargs))
+            self._in_flight[key] = task
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not task.done():
+                    # 所有呼叫的人都離開了 (例如被放棄的 speculative 呼叫，見 speculative_tools.py): 不用再等 upstream
+                    task.cancel()
+
+    async def _fetch(self, key, query, kwargs) -> dict:
+        try:
+            response = await self.client.search(query, **kwargs)
+        finally:
+            self._in_flight.pop(key, None)
+
+        self._entries[key] = (self.clock() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return response
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+        }
+
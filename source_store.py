@@ -0,0 +1,179 @@
+# 搜尋來源的精簡存放: web_search / knowledge_search 查到的來源留在 run context，但不留整包 Tavily response
+#
+# 原本 context.search_source[query] = response，整個 Tavily response (content、raw_content、images...) 跟著 run 活到結束，
+# 搜尋好幾次的一輪在記憶體裡就是好幾 MB，v2 最後還把整個 dict 寫進 log。SourceStore 每個 run 一個:
+#   - 每筆結果是一個 SourceRecord (__slots__): ref、query、url、title、score、內容的 hash 和長度
+#   - 內容小於 SOURCE_INLINE_BYTES、而且這個 run 留在記憶體的內容還沒超過 SOURCE_STORE_MEMORY_BYTES 時放在記憶體，
+#     其他的寫進這個 run 自己的暫存檔；暫存檔超過 SOURCE_STORE_SPILL_BYTES 之後只留 hash，不留內容
+#   - 相同的內容 (同一個 hash) 只存一次，不同 query 查到同一頁共用同一個 ref；沒有內容的結果不合併
+#   - citations() 只有來源清單 (沒有內容)，content(ref) 需要時才從記憶體 / 暫存檔讀出來
+#
+# v2 的 DONE frame 帶 "sources": store id，前端要顯示引用時再拿:
+#   GET /api/sources/{id}          查過的 query 和來源清單
+#   GET /api/sources/{id}/{ref}    一個來源的完整內容
+# 最近 SOURCE_STORE_KEEP 個 run 的 store 保留 SOURCE_STORE_TTL 秒，之後關閉 (暫存檔一起刪除)。
+
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from stream_metrics import metrics
+
+SOURCE_INLINE_BYTES = int(os.environ.get("SOURCE_INLINE_BYTES", "4096"))
+SOURCE_STORE_MEMORY_BYTES = int(os.environ.get("SOURCE_STORE_MEMORY_BYTES", str(256 * 1024)))  # 每個 run
+SOURCE_STORE_SPILL_BYTES = int(os.environ.get("SOURCE_STORE_SPILL_BYTES", str(32 * 1024 * 1024)))  # 每個 run
+SOURCE_STORE_KEEP = int(os.environ.get("SOURCE_STORE_KEEP", "200"))
+SOURCE_STORE_TTL = float(os.environ.get("SOURCE_STORE_TTL", "900"))  # 秒
+
+source_content_bytes = metrics.counter("source_store_content_bytes_total", "Search result content kept per run, by where it went.",
+                                       ("storage",))
+
+
+class SourceRecord:
+    __slots__ = ("ref", "query", "url", "title", "score", "content_hash", "content_length", "inline", "offset")
+
+    def __init__(self, ref: str, query: str, url: str, title: str, score: float | None, content_hash: str, content_length: int):
+        self.ref = ref
+        self.query = query
+        self.url = url
+        self.title = title
+        self.score = score
+        self.content_hash = content_hash
+        self.content_length = content_length
+        self.inline: bytes | None = None  # 放在記憶體的內容
+        self.offset: int | None = None    # 或是在暫存檔的位置
+
+    def citation(self) -> dict:
+        return {"ref": self.ref, "query": self.query, "url": self.url, "title": self.title, "score": self.score,
+                "content_hash": self.content_hash, "content_length": self.content_length}
+
+
+class SourceStore:
+    """Per-run store of search sources: compact records in memory, large content spilled to a temp file."""
+
+    def __init__(self, inline_limit: int = SOURCE_INLINE_BYTES, memory_limit: int = SOURCE_STORE_MEMORY_BYTES,
+                 spill_limit: int = SOURCE_STORE_SPILL_BYTES):
+        self.id = uuid.uuid4().hex
+        self.inline_limit = inline_limit
+        self.memory_limit = memory_limit
+        self.spill_limit = spill_limit
+        self.queries: dict[str, list[str]] = {}  # query -> refs，依查詢的順序
+        self._records: dict[str, SourceRecord] = {}
+        self._by_hash: dict[str, str] = {}
+        self._spill = None
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.dropped = 0
+
+    def add(self, query: str, response: dict) -> list[str]:
+        """Keep the results of one search call; returns their refs."""
+        refs = []
+        for result in response.get("results") or []:
+            data = (result.get("raw_content") or result.get("content") or "").encode()
+            content_hash = hashlib.sha1(data).hexdigest()[:16]
+            # 沒有內容的結果 hash 全都一樣，不能合併，否則後面的結果會變成第一筆的 url / title
+            ref = self._by_hash.get(content_hash) if data else None
+            if ref is None:
+                ref = f"s{len(self._records) + 1}"
+                record = SourceRecord(ref, query, result.get("url") or "", result.get("title") or "", result.get("score"),
+                                      content_hash, len(data))
+                self._keep(record, data)
+                self._records[ref] = record
+                if data:
+                    self._by_hash[content_hash] = ref
+            if ref not in refs:
+                refs.append(ref)
+        self.queries[query] = refs
+        return refs
+
+    def _keep(self, record: SourceRecord, data: bytes):
+        if len(data) <= self.inline_limit and self.memory_bytes + len(data) <= self.memory_limit:
+            record.inline = data
+            self.memory_bytes += len(data)
+            source_content_bytes.inc(("memory",), len(data))
+        elif self.spilled_bytes + len(data) <= self.spill_limit:
+            if self._spill is None:
+                self._spill = tempfile.TemporaryFile(prefix="sources_")
+            self._spill.seek(self.spilled_bytes)
+            self._spill.write(data)
+            record.offset = self.spilled_bytes
+            self.spilled_bytes += len(data)
+            source_content_bytes.inc(("spill",), len(data))
+        else:
+            self.dropped += 1
+            source_content_bytes.inc(("dropped",), len(data))
+
+    def citation(self, ref: str) -> dict | None:
+        record = self._records.get(ref)
+        return record.citation() if record else None
+
+    def citations(self) -> list[dict]:
+        return [record.citation() for record in self._records.values()]
+
+    def content(self, ref: str) -> str | None:
+        """Full content of a source, read back from the temp file if it was spilled; None when it was not kept."""
+        record = self._records.get(ref)
+        if record is None:
+            return None
+        if record.inline is not None:
+            return record.inline.decode()
+        if record.offset is None or self._spill is None:
+            return None
+        self._spill.seek(record.offset)
+        return self._spill.read(record.content_length).decode()
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            for record in self._records.values():
+                record.offset = None
+
+    def stats(self) -> dict:
+        return {"queries": len(self.queries), "sources": len(self._records), "memory_bytes": self.memory_bytes,
+                "spilled_bytes": self.spilled_bytes, "dropped": self.dropped}
+
+    # 以前 search_source 是 {query: response}，list(search_source) / `query in search_source` 照舊可以用
+    def __iter__(self):
+        return iter(self.queries)
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+    def __contains__(self, query) -> bool:
+        return query in self.queries
+
+    def __repr__(self) -> str:
+        return f"SourceStore(id={self.id}, {', '.join(f'{k}={v}' for k, v in self.stats().items())})"
+
+
+class SourceStoreRegistry:
+    """Keeps the stores of recent runs so their citations can be fetched after the stream ended."""
+
+    def __init__(self, keep: int = SOURCE_STORE_KEEP, ttl: float = SOURCE_STORE_TTL, clock=time.monotonic):
+        self.keep_count = keep
+        self.ttl = ttl
+        self.clock = clock
+        self._stores: OrderedDict[str, tuple[float, SourceStore]] = OrderedDict()
+
+    def keep(self, store: SourceStore):
+        self._stores[store.id] = (self.clock() + self.ttl, store)
+        self._stores.move_to_end(store.id)
+        self._evict()
+
+    def get(self, store_id: str) -> SourceStore | None:
+        self._evict()
+        entry = self._stores.get(store_id)
+        return entry[1] if entry else None
+
+    def _evict(self):
+        now = self.clock()
+        while self._stores:
+            store_id, (expires_at, store) = next(iter(self._stores.items()))
+            if expires_at > now and len(self._stores) <= self.keep_count:
+                break
+            del self._stores[store_id]
+            store.close()
@@ -0,0 +1,107 @@
+# Speculative tool execution: function call 的參數串流完就先開始跑 tool
+#
+# SDK 要等整個 model response 結束 (response.completed)、送出 tool_call_item 之後才執行 tool，
+# 但 {"query": ...} 在 response.function_call_arguments.delta 串流完的時候就已經確定了，通常早好幾百 ms。
+# 對於沒有副作用 (idempotent) 的 tool，可以在參數一 parse 成功就先開始執行:
+#
+#   speculative_tool("web_search", lambda args: search_cache.search(args["query"]))   登記可以提前執行的 tool
+#   speculation = new_speculation()                                                   每個 run 一個 (SPECULATIVE_TOOLS=0 時是 None)
+#   agent_frames(result, speculation=speculation)                                     看 raw events，參數完整就開始
+#   task = speculation.take("web_search", {"query": query})                           真正的 tool 呼叫拿走進行中的 task
+#
+# 參數和真正呼叫時不一樣、或 run 結束前都沒有被拿走的 speculation 會被取消 (SearchCache 沒有人在等就取消 upstream)。
+# SPECULATIVE_TOOLS=1 打開 (預設關閉)。/metrics 的 speculative_tool_calls_total 是 started / used / discarded 的數量，
+# speculative_tool_head_start_seconds 是 tool 真正被呼叫時，speculation 已經先跑了多久。
+
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+from stream_metrics import LATENCY_BUCKETS, metrics
+from structured_logging import get_logger
+
+logger = get_logger("speculative_tools")
+
+SPECULATIVE_TOOLS = os.environ.get("SPECULATIVE_TOOLS", "0").lower() in ("1", "true", "yes")
+
+speculative_calls = metrics.counter("speculative_tool_calls_total", "Speculative tool executions by outcome.", ("tool", "outcome"))
+speculative_head_start = metrics.histogram("speculative_tool_head_start_seconds",
+                                           "How long a speculation had been running when the real tool call took it.", ("tool",),
+                                           LATENCY_BUCKETS)
+
+# tool name -> fn(arguments) 回傳 awaitable；只登記沒有副作用、可以重複執行的 tool
+_tools: dict[str, Callable[[dict], Awaitable]] = {}
+
+
+def speculative_tool(name: str, fn: Callable[[dict], Awaitable]):
+    """Allow the tool `name` to be started from its streamed arguments before the SDK invokes it."""
+    _tools[name] = fn
+
+
+def _key(name: str, arguments: dict) -> str:
+    return f"{name}:{json.dumps(arguments, sort_keys=True, ensure_ascii=False)}"
+
+
+class Speculation:
+    """Per-run speculative executor fed with the run's raw response events."""
+
+    def __init__(self):
+        self._names: dict[str, str] = {}      # function_call item id -> tool name
+        self._arguments: dict[str, str] = {}  # item id -> 目前收到的參數
+        self._tasks: dict[str, tuple[asyncio.Task, float]] = {}  # key -> (task, started_at)
+
+    def on_event(self, event):
+        if event.type != "raw_response_event":
+            return
+        data = event.data
+        if data.type == "response.output_item.added" and data.item.type == "function_call":
+            if data.item.name in _tools:
+                self._names[data.item.id] = data.item.name
+                self._arguments[data.item.id] = data.item.arguments or ""
+        elif data.type == "response.function_call_arguments.delta" and data.item_id in self._names:
+            self._arguments[data.item_id] += data.delta
+            self._try_start(data.item_id)
+        elif data.type == "response.function_call_arguments.done" and data.item_id in self._names:
+            self._arguments[data.item_id] = data.arguments
+            self._try_start(data.item_id)
+
+    def _try_start(self, item_id: str):
+        try:
+            arguments = json.loads(self._arguments[item_id])
+        except ValueError:
+            return  # 參數還沒收完
+        name = self._names.pop(item_id)
+        del self._arguments[item_id]
+        if not isinstance(arguments, dict):
+            return
+        key = _key(name, arguments)
+        if key in self._tasks:
+            return
+        self._tasks[key] = (asyncio.ensure_future(_tools[name](arguments)), time.perf_counter())
+        speculative_calls.inc((name, "started"))
+        logger.debug("speculative tool started", extra={"tool": name, "arguments": arguments})
+
+    def take(self, name: str, arguments: dict) -> asyncio.Task | None:
+        """The in-flight speculation for this exact call, or None (then the tool runs normally)."""
+        entry = self._tasks.pop(_key(name, arguments), None)
+        if entry is None:
+            return None
+        task, started_at = entry
+        speculative_calls.inc((name, "used"))
+        speculative_head_start.observe((name,), time.perf_counter() - started_at)
+        return task
+
+    def close(self):
+        """Cancel speculations nobody took (different arguments, or the run ended first)."""
+        for key, (task, _) in self._tasks.items():
+            task.cancel()
+            speculative_calls.inc((key.split(":", 1)[0], "discarded"))
+        self._tasks.clear()
+        self._names.clear()
+        self._arguments.clear()
+
+
+def new_speculation() -> Speculation | None:
+    return Speculation() if SPECULATIVE_TOOLS and _tools else None
@@ -0,0 +1,24 @@
+// 套用 server 送來的 structured output 增量 (RFC 6902 風格的 JSON patch，見 streaming_json.py 的 JSONPatchEncoder)
+//   {"op": "add", "path": "/following_questions/0", "value": "第一"}      新的欄位 / 陣列元素
+//   {"op": "append", "path": "/following_questions/0", "value": "個問題"}  字串後面接上新的字
+// 直接修改 doc，回傳這次有變動的最上層欄位名稱 (Set)，頁面只需要重畫這些欄位
+function applyPatch(doc, ops) {
+    const changed = new Set();
+    for (const op of ops) {
+        const keys = op.path.split('/').slice(1).map(key => key.replace(/~1/g, '/').replace(/~0/g, '~'));
+        changed.add(keys[0]);
+        let parent = doc;
+        for (const key of keys.slice(0, -1)) {
+            parent = parent[key];
+        }
+        const last = keys[keys.length - 1];
+        if (op.op === 'append') {
+            parent[last] += op.value;
+        } else if (Array.isArray(parent)) {
+            parent.splice(last === '-' ? parent.length : Number(last), 0, op.value);
+        } else {
+            parent[last] = op.value;
+        }
+    }
+    return changed;
+}
@@ -0,0 +1,217 @@
+# 串流延遲指標: TTFT、inter-token 間隔、tool 執行時間、tokens/sec，以 Prometheus text 格式輸出
+#
+# 不依賴 prometheus_client，用最簡單的 histogram (bisect 找 bucket)，每個 token 的成本只有一次 perf_counter() 加幾個加法，
+# 可以在 production 一直開著。
+#
+#   timer = StreamTimer("/api/v1/agent_stream", "gpt-5-mini")
+#   timer.on_delta()           每個 upstream delta
+#   timer.on_tool_start(...)   tool 開始 / 結束
+#   timer.on_cached_write()    快取的回應一次寫完 (沒有 upstream delta)，記錄 TTFT 和 first byte
+#   timer.output_tokens = ...  (可選) 由 usage 得到的 output tokens
+#   timed_stream(chunks, timer) 包住最後送給 client 的串流: 記錄 first byte，結束時 finish()
+#   timer.on_first_byte()      串流先進背景的 ResumableRun 時 (timed_stream(..., first_byte=False))，
+#                              由訂閱 run 的 response 在第一個事件寫給 client 之後呼叫，見 main.resumable_response
+
+import asyncio
+import time
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Iterable
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, label_values: tuple, value: float):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {series[-2]}"
+            yield f"{self.name}_count{labels} {series[-1]}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, label_values: tuple, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def items(self) -> list[tuple[tuple, float]]:
+        return list(self._values.items())
+
+    def get(self, label_values: tuple) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors: list[Callable] = []
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, tuple(labels), tuple(buckets))
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        metric = Counter(name, help, tuple(labels))
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable):
+        """collector() returns [(name, type, help, {label dict tuple: value})] computed at scrape time."""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, metric_type, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples.items():
+                    names = tuple(k for k, _ in labels)
+                    values = tuple(v for _, v in labels)
+                    lines.append(f"{name}{_format_labels(names, values)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+_LABELS = ("endpoint", "model")
+stream_requests = metrics.counter("stream_requests_total", "Streaming requests finished, by outcome.", _LABELS + ("outcome",))
+stream_ttft = metrics.histogram("stream_ttft_seconds", "Request start to first upstream delta.", _LABELS)
+stream_first_byte = metrics.histogram("stream_first_byte_seconds", "Request start to the first event written to the client's response.", _LABELS)
+stream_inter_delta = metrics.histogram("stream_inter_delta_seconds", "Gap between consecutive upstream deltas.", _LABELS, GAP_BUCKETS)
+stream_duration = metrics.histogram("stream_duration_seconds", "Request start to end of stream.", _LABELS)
+stream_tool_call = metrics.histogram("stream_tool_call_seconds", "Tool call duration inside an agent run.", _LABELS + ("tool",))
+stream_output_tokens = metrics.counter("stream_output_tokens_total", "Output tokens streamed (upstream usage, or delta count when usage is unavailable).", _LABELS)
+stream_tokens_per_second = metrics.histogram("stream_tokens_per_second", "Output tokens per second from first delta to end of stream.", _LABELS, RATE_BUCKETS)
+
+
+class StreamTimer:
+    """Per-request timing; every hook is a perf_counter() call plus a histogram update."""
+
+    __slots__ = ("labels", "start", "first_delta", "last_delta", "deltas", "first_byte", "tools", "output_tokens", "finished")
+
+    def __init__(self, endpoint: str, model: str):
+        self.labels = (endpoint, str(model))
+        self.start = time.perf_counter()
+        self.first_delta = None
+        self.last_delta = None
+        self.deltas = 0
+        self.first_byte = None
+        self.tools = {}
+        self.output_tokens = None
+        self.finished = False
+
+    def on_delta(self):
+        now = time.perf_counter()
+        if self.first_delta is None:
+            self.first_delta = now
+            stream_ttft.observe(self.labels, now - self.start)
+        else:
+            stream_inter_delta.observe(self.labels, now - self.last_delta)
+        self.last_delta = now
+        self.deltas += 1
+
+    def on_first_byte(self):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+            stream_first_byte.observe(self.labels, self.first_byte - self.start)
+
+    def on_cached_write(self):
+        """A cached response was written in one go: its first token and first byte reach the client together.
+
+        No delta is counted, so the replay doesn't add inter-delta or tokens/sec samples.
+        """
+        now = time.perf_counter()
+        stream_ttft.observe(self.labels, now - self.start)
+        if self.first_byte is None:
+            self.first_byte = now
+            stream_first_byte.observe(self.labels, now - self.start)
+
+    def on_tool_start(self, call_id: str, tool_name: str):
+        self.tools[call_id] = (tool_name, time.perf_counter())
+
+    def on_tool_end(self, call_id: str):
+        started = self.tools.pop(call_id, None)
+        if started is not None:
+            tool_name, start = started
+            stream_tool_call.observe(self.labels + (tool_name,), time.perf_counter() - start)
+
+    def finish(self, outcome: str = "ok"):
+        if self.finished:
+            return
+        self.finished = True
+        end = time.perf_counter()
+        stream_duration.observe(self.labels, end - self.start)
+        stream_requests.inc(self.labels + (outcome,))
+
+        tokens = self.output_tokens if self.output_tokens is not None else self.deltas
+        if tokens:
+            stream_output_tokens.inc(self.labels, tokens)
+        if self.first_delta is not None and end > self.first_delta:
+            stream_tokens_per_second.observe(self.labels, tokens / (end - self.first_delta))
+
+
+async def timed_stream(chunks: AsyncIterator[str], timer: StreamTimer, first_byte: bool = True) -> AsyncIterator[str]:
+    """Wrap the outgoing stream: record first byte, and finish the timer when the stream ends.
+
+    Pass first_byte=False when the chunks are produced into a background run rather than written to the client directly;
+    the first byte is then recorded on the response side (or not at all for jobs, which have no client at that point).
+    """
+    outcome = "error"
+    try:
+        async for chunk in chunks:
+            if first_byte and timer.first_byte is None:
+                timer.on_first_byte()
+            yield chunk
+        outcome = "ok"
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = "cancelled"
+        raise
+    finally:
+        timer.finish(outcome)
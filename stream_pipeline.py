@@ -0,0 +1,247 @@
+# Agents SDK 串流事件 -> 輸出 frame 的共用 pipeline
+#
+#   result.stream_events()  --agent_frames()-->  StreamFrame  --coalesce()-->  encoder (SSE / AG-UI)
+#
+# 原本每個 endpoint 各自寫一串 if/elif，而且每個 token 都 yield 一個 SSE 事件 (一次 write、一個網路封包)。
+# 這裡統一把事件翻譯成 StreamFrame，再依時間或大小合併連續的文字 frame，
+# tool / think / done 這類事件則會立刻 flush，不會被延遲。
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable
+
+from prompt_cache import record_usage
+from streaming_json import JSONPatchEncoder, extend_patch
+from structured_logging import get_logger
+
+logger = get_logger("stream_pipeline")
+
+# Coalescing 設定: 每 N ms 或累積 M 個字元就 flush 一次，兩者都設為 0 代表不合併 (每個 token 一個 frame)
+STREAM_FLUSH_INTERVAL_MS = int(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "30"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "2048"))
+
+# 沒有跑完就被關閉而取消的 run 數量 (依 endpoint 分): 沒有 client 在讀超過 RESUME_GRACE_SECONDS、WebSocket 斷線、job 被取消
+cancelled_runs: dict[str, int] = {}
+
+# Frame 種類
+FRAME_TEXT = "text"                # 純文字 delta: {"content": "..."}
+FRAME_OUTPUT = "output"            # structured output 增量: {"patch": [{"op": "append", "path": "/content", "value": "..."}]}，見 streaming_json.py
+FRAME_THINK_START = "think_start"
+FRAME_THINK_TEXT = "think_text"
+FRAME_TOOL_CALL = "tool_call"
+FRAME_TOOL_OUTPUT = "tool_output"  # 只在 server 內部使用，不送給前端
+FRAME_DONE = "done"
+
+MERGEABLE_FRAMES = (FRAME_TEXT, FRAME_OUTPUT)
+INTERNAL_FRAMES = (FRAME_TOOL_OUTPUT,)
+
+
+@dataclass
+class StreamFrame:
+    kind: str
+    data: dict
+
+
+def _call_id(raw_item) -> str | None:
+    if isinstance(raw_item, dict):
+        return raw_item.get("call_id")
+    return getattr(raw_item, "call_id", None)
+
+
+async def agent_frames(result, structured: bool = False, on_event: Callable | None = None, timer=None,
+                       speculation=None) -> AsyncIterator[StreamFrame]:
+    """Translate Runner.run_streamed() events into StreamFrames, ending with a DONE frame.
+
+    If a StreamTimer is given, upstream deltas and tool calls are recorded on it (see stream_metrics.py).
+    A Speculation (see speculative_tools.py) sees every event so tools can start from streamed arguments.
+    """
+    patches = JSONPatchEncoder() if structured else None
+
+    try:
+        async for event in result.stream_events():
+            if on_event:
+                on_event(event)
+            if speculation:
+                speculation.on_event(event)
+
+            if event.type == "raw_response_event":
+                data = event.data
+                if data.type == "response.output_text.delta":
+                    if timer:
+                        timer.on_delta()
+                    if patches:
+                        ops = patches.feed(data.delta)
+                        if ops:
+                            yield StreamFrame(FRAME_OUTPUT, {"patch": ops})
+                    else:
+                        yield StreamFrame(FRAME_TEXT, {"content": data.delta})
+                elif data.type == "response.output_item.added" and data.item.type == "reasoning":
+                    yield StreamFrame(FRAME_THINK_START, {"message": "THINK_START"})
+                elif data.type == "response.reasoning_summary_text.done":
+                    yield StreamFrame(FRAME_THINK_TEXT, {"message": "THINK_TEXT", "text": data.text})
+            elif event.type == "run_item_stream_event":
+                if event.item.type == "tool_call_item":
+                    if timer:
+                        timer.on_tool_start(_call_id(event.item.raw_item), str(event.item.raw_item.name))
+                    yield StreamFrame(FRAME_TOOL_CALL, {
+                        "message": "CALL_TOOL",
+                        "tool_name": str(event.item.raw_item.name),
+                        "arguments": str(event.item.raw_item.arguments),
+                    })
+                elif event.item.type == "tool_call_output_item":
+                    if timer:
+                        timer.on_tool_end(_call_id(event.item.raw_item))
+                    yield StreamFrame(FRAME_TOOL_OUTPUT, {"output": event.item.output})
+
+        if timer:
+            timer.output_tokens = result.context_wrapper.usage.output_tokens or None
+            record_usage(*timer.labels, result.context_wrapper.usage)
+        yield StreamFrame(FRAME_DONE, {"message": "DONE", "last_response_id": result.last_response_id})
+    finally:
+        if speculation:
+            speculation.close()
+
+
+async def cancel_when_closed(frames: AsyncIterator[StreamFrame], result, endpoint: str = "") -> AsyncIterator[StreamFrame]:
+    """Cancel the agent run when its frame stream is cancelled or closed before the DONE frame.
+
+    The run's consumer decides when that happens: the resumable registry after RESUME_GRACE_SECONDS without
+    a client (resumable_stream.py), a closed WebSocket (ws_transport.py) or a cancelled job (jobs.py).
+    result.cancel() stops the run task, which closes the upstream OpenAI stream and cancels pending tools.
+    """
+    cancelled = False
+    finished = False
+
+    def cancel_run(stopped: bool = False):
+        # stopped: 外層被取消或關閉，SDK 可能已經自己停掉 run (is_complete=True)，但還是要記一次
+        nonlocal cancelled
+        if cancelled or finished or (result.is_complete and not stopped):
+            return
+        cancelled = True
+        if not result.is_complete:
+            result.cancel()
+        cancelled_runs[endpoint] = cancelled_runs.get(endpoint, 0) + 1
+        logger.info("stream closed before the run finished, cancelled run", extra={"endpoint": endpoint})
+
+    try:
+        async for frame in frames:
+            if frame.kind == FRAME_DONE:
+                finished = True
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        cancel_run(stopped=True)
+        raise
+    finally:
+        # 沒有正常跑完 (generator 被取消或關閉) 也要停掉 run
+        cancel_run()
+
+
+def _merge(pending: StreamFrame, frame: StreamFrame):
+    for key, value in frame.data.items():
+        if key == "patch" and key in pending.data:
+            extend_patch(pending.data["patch"], value)
+        elif isinstance(value, str) and key in pending.data:
+            pending.data[key] += value
+        else:
+            pending.data[key] = value
+
+
+def _frame_size(frame: StreamFrame) -> int:
+    size = 0
+    for value in frame.data.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, list):
+            size += sum(len(op["value"]) for op in value if isinstance(op.get("value"), str))
+    return size
+
+
+async def coalesce(frames: AsyncIterator[StreamFrame],
+                   flush_interval_ms: int = STREAM_FLUSH_INTERVAL_MS,
+                   flush_bytes: int = STREAM_FLUSH_BYTES) -> AsyncIterator[StreamFrame]:
+    """Merge consecutive text/output frames, flushing every flush_interval_ms or flush_bytes."""
+    if flush_interval_ms <= 0 and flush_bytes <= 0:
+        try:
+            async for frame in frames:
+                yield frame
+        finally:
+            await frames.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    interval = flush_interval_ms / 1000
+    iterator = frames.__aiter__()
+    pending = None
+    pending_size = 0
+    deadline = None
+    next_task = None
+
+    try:
+        while True:
+            if pending is None and next_task is None:
+                # 沒有緩衝中的資料，不需要計時，直接等下一個 frame
+                try:
+                    frame = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if next_task is None:
+                    next_task = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(0, deadline - loop.time()) if pending is not None and interval > 0 else None
+                done, _ = await asyncio.wait({next_task}, timeout=timeout)
+                if not done:
+                    # 時間到了，先把緩衝送出去，上游的 frame 繼續等
+                    yield pending
+                    pending = None
+                    continue
+                task, next_task = next_task, None
+                try:
+                    frame = task.result()
+                except StopAsyncIteration:
+                    break
+
+            if frame.kind in MERGEABLE_FRAMES:
+                if pending is not None and pending.kind != frame.kind:
+                    yield pending
+                    pending = None
+                if pending is None:
+                    pending = StreamFrame(frame.kind, {k: list(v) if isinstance(v, list) else v for k, v in frame.data.items()})
+                    pending_size = _frame_size(frame)
+                    deadline = loop.time() + interval
+                else:
+                    _merge(pending, frame)
+                    pending_size += _frame_size(frame)
+                if flush_bytes > 0 and pending_size >= flush_bytes:
+                    yield pending
+                    pending = None
+            else:
+                # tool / think / done 事件: 先送出緩衝，再立刻送出這個事件
+                if pending is not None:
+                    yield pending
+                    pending = None
+                yield frame
+
+        if pending is not None:
+            yield pending
+    finally:
+        # 確實關掉上游 (例如 cancel_when_closed 會呼叫 result.cancel() 關掉 OpenAI 串流)，不要等 GC
+        if next_task is not None:
+            next_task.cancel()
+            await asyncio.gather(next_task, return_exceptions=True)
+        await iterator.aclose()
+
+
+def encode_sse(frame: StreamFrame) -> str:
+    """Encode a frame in the `data: {...}` format the static pages expect."""
+    if frame.kind in INTERNAL_FRAMES:
+        return ""
+    return f"data: {json.dumps(frame.data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+async def sse_stream(frames: AsyncIterator[StreamFrame]) -> AsyncIterator[str]:
+    async for frame in frames:
+        chunk = encode_sse(frame)
+        if chunk:
+            yield chunk
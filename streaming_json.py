@@ -0,0 +1,286 @@
+# 增量式 JSON parser: 給 structured output 串流用
+#
+# 原本的寫法是每收到一個 delta 就把整個 json_str 丟給 jiter 重新 parse 一次 (partial_mode="trailing-strings")，
+# 回應越長每個 token 的成本越高，整體是 O(n²)。
+# 這裡改成保留 parser 狀態，每個 delta 只處理新增的字元，並直接吐出欄位層級的事件:
+#
+#   ("append", path, text)   字串值新增的字 (例如 path=("content",))
+#   ("done", path, value)    某個值 (字串/數字/物件/陣列) 完整解析完成 (例如 path=("following_questions", 0))
+#
+# path 是從根節點開始的 key / index tuple。
+#
+# JSONPatchEncoder 再把這些事件轉成 RFC 6902 風格的 patch，前端套用 (static/json_patch.js) 就能還原出同一個物件，
+# 不管 output_type 長什麼樣子 (巢狀物件、物件陣列都可以)，每個字只會送一次:
+#
+#   {"op": "add", "path": "/following_questions/0", "value": "第一"}   新的欄位 / 陣列元素 (字串帶著目前收到的字)
+#   {"op": "append", "path": "/following_questions/0", "value": "個問題"}  字串後面接上新的字 (RFC 6902 沒有，擴充的 op)
+
+import json
+import re
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_LITERAL_CHARS = frozenset("0123456789+-.eEtruefalsn")
+_WHITESPACE = " \t\r\n"
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# parser 目前在等什麼
+_VALUE = 0             # 任何值
+_VALUE_OR_END = 1      # 剛讀到 '[': 值或 ']'
+_KEY_OR_END = 2        # 剛讀到 '{': key 或 '}'
+_KEY = 3               # 讀到 ',' 之後的 key
+_COLON = 4
+_COMMA_OR_END = 5
+_STRING = 6
+_LITERAL = 7
+_FINISHED = 8
+
+
+class StreamingJSONParser:
+    """Incremental JSON parser that keeps its state across feed() calls."""
+
+    def __init__(self):
+        self.root = None
+        self._stack = []          # [container, 目前的 key]，list 的 key 不用存
+        self._state = _VALUE
+        self._string_parts = []
+        self._string_is_key = False
+        self._escape = ""          # 被 chunk 切斷的 escape sequence
+        self._literal = ""
+
+    @property
+    def finished(self) -> bool:
+        return self._state == _FINISHED
+
+    def current_path(self) -> tuple:
+        path = []
+        last = len(self._stack) - 1
+        for depth, (container, key) in enumerate(self._stack):
+            if isinstance(container, dict):
+                path.append(key)
+            else:
+                # 解析中的子容器已經先掛到 list 上了 (見 _push)，它的 index 是最後一個元素
+                path.append(len(container) - 1 if depth < last else len(container))
+        return tuple(path)
+
+    def feed(self, chunk: str) -> list[tuple]:
+        """Consume the next chunk and return the events it produced."""
+        events = []
+        i = 0
+        n = len(chunk)
+        while i < n:
+            state = self._state
+            if state == _STRING:
+                i = self._read_string(chunk, i, events)
+                continue
+            if state == _LITERAL:
+                c = chunk[i]
+                if c in _LITERAL_CHARS:
+                    self._literal += c
+                    i += 1
+                    continue
+                self._finish_value(json.loads(self._literal), events)
+                self._literal = ""
+                continue  # 同一個字元交給下一個狀態處理
+
+            c = chunk[i]
+            i += 1
+            if c in _WHITESPACE:
+                continue
+
+            if state == _VALUE or state == _VALUE_OR_END:
+                if c == "]" and state == _VALUE_OR_END:
+                    self._close_container(events)
+                else:
+                    self._start_value(c, events)
+            elif state == _KEY_OR_END or state == _KEY:
+                if c == '"':
+                    self._string_is_key = True
+                    self._string_parts = []
+                    self._state = _STRING
+                elif c == "}" and state == _KEY_OR_END:
+                    self._close_container(events)
+                else:
+                    raise ValueError(f"Expected object key, got {c!r}")
+            elif state == _COLON:
+                if c != ":":
+                    raise ValueError(f"Expected ':', got {c!r}")
+                self._state = _VALUE
+            elif state == _COMMA_OR_END:
+                container = self._stack[-1][0]
+                if c == ",":
+                    self._state = _KEY if isinstance(container, dict) else _VALUE
+                elif (c == "}" and isinstance(container, dict)) or (c == "]" and isinstance(container, list)):
+                    self._close_container(events)
+                else:
+                    raise ValueError(f"Unexpected {c!r}")
+            elif state == _FINISHED:
+                raise ValueError(f"Unexpected data after JSON value: {c!r}")
+        return events
+
+    def close(self) -> list[tuple]:
+        """Flush a trailing top-level literal (e.g. a bare number)."""
+        events = []
+        if self._state == _LITERAL and not self._stack:
+            self._finish_value(json.loads(self._literal), events)
+            self._literal = ""
+        return events
+
+    def _start_value(self, c, events):
+        if c == "{":
+            self._push({}, events)
+            self._state = _KEY_OR_END
+        elif c == "[":
+            self._push([], events)
+            self._state = _VALUE_OR_END
+        elif c == '"':
+            self._string_is_key = False
+            self._string_parts = []
+            self._state = _STRING
+        elif c in _LITERAL_CHARS:
+            self._literal = c
+            self._state = _LITERAL
+        else:
+            raise ValueError(f"Unexpected {c!r}")
+
+    def _push(self, container, events):
+        # container 先掛到 parent 上，這樣 root 隨時都能看到目前已完成的部分
+        if self._stack:
+            parent, key = self._stack[-1]
+            if isinstance(parent, dict):
+                parent[key] = container
+            else:
+                parent.append(container)
+        else:
+            self.root = container
+        self._stack.append([container, None])
+
+    def _close_container(self, events):
+        path = self.current_path()[:-1]
+        container, _ = self._stack.pop()
+        events.append(("done", path, container))
+        self._after_value()
+
+    def _finish_value(self, value, events):
+        if not self._stack:
+            self.root = value
+            events.append(("done", (), value))
+            self._state = _FINISHED
+            return
+        path = self.current_path()
+        parent = self._stack[-1][0]
+        if isinstance(parent, dict):
+            parent[self._stack[-1][1]] = value
+        else:
+            parent.append(value)
+        events.append(("done", path, value))
+        self._after_value()
+
+    def _after_value(self):
+        self._state = _COMMA_OR_END if self._stack else _FINISHED
+
+    def _read_string(self, chunk, i, events):
+        if self._escape:
+            i = self._read_escape(chunk, i, events)
+            if self._escape:
+                return i
+
+        m = _STRING_SPECIAL.search(chunk, i)
+        end = m.start() if m else len(chunk)
+        if end > i:
+            text = chunk[i:end]
+            self._string_parts.append(text)
+            if not self._string_is_key:
+                events.append(("append", self.current_path(), text))
+        if not m:
+            return end
+
+        if m.group() == "\\":
+            self._escape = "\\"
+            return self._read_escape(chunk, end + 1, events)
+
+        # 字串結束
+        value = "".join(self._string_parts)
+        self._string_parts = []
+        if self._string_is_key:
+            self._stack[-1][1] = value
+            self._state = _COLON
+        else:
+            self._finish_value(value, events)
+        return end + 1
+
+    def _read_escape(self, chunk, i, events):
+        n = len(chunk)
+        while i < n:
+            self._escape += chunk[i]
+            i += 1
+            esc = self._escape
+            if len(esc) == 2 and esc[1] != "u":
+                text = _ESCAPES.get(esc[1])
+                if text is None:
+                    raise ValueError(f"Invalid escape {esc!r}")
+                break
+            if len(esc) == 6 and esc[1] == "u":
+                code = int(esc[2:], 16)
+                if 0xD800 <= code < 0xDC00:
+                    continue  # high surrogate: 等下一個 \uXXXX
+                text = chr(code)
+                break
+            if len(esc) == 12:
+                text = json.loads(f'"{esc}"')
+                break
+        else:
+            return i
+
+        self._escape = ""
+        self._string_parts.append(text)
+        if not self._string_is_key:
+            events.append(("append", self.current_path(), text))
+        return i
+
+
+def json_pointer(path: tuple) -> str:
+    """RFC 6901 JSON pointer for a parser path."""
+    return "".join("/" + str(key).replace("~", "~0").replace("/", "~1") for key in path)
+
+
+def extend_patch(ops: list[dict], more: list[dict]):
+    """Append ops, merging consecutive appends to the same string into one op."""
+    for op in more:
+        last = ops[-1] if ops else None
+        if last is not None and op["op"] == "append" and last["path"] == op["path"] and isinstance(last["value"], str):
+            # 前一個 op 是同一個字串的 add 或 append: 直接接在它的 value 後面
+            last["value"] += op["value"]
+        else:
+            ops.append(dict(op))
+
+
+class JSONPatchEncoder:
+    """Feeds output deltas to a StreamingJSONParser and returns RFC 6902 style patch ops for the new part."""
+
+    def __init__(self):
+        self.parser = StreamingJSONParser()
+        self._created = set()  # 已經送過 add 的 path
+
+    @property
+    def root(self):
+        return self.parser.root
+
+    def feed(self, chunk: str) -> list[dict]:
+        ops = []
+        for kind, path, value in self.parser.feed(chunk):
+            if not path:
+                continue  # 根物件: 前端從 {} 開始
+            if path in self._created:
+                if kind == "append":
+                    extend_patch(ops, [{"op": "append", "path": json_pointer(path), "value": value}])
+                continue
+            # 第一次看到這個 path: 先建立還沒送過的上層容器，再用目前的值 add
+            # (字串帶著第一段字，之後用 append；數字、布林、空容器在 done 時一次送出)
+            for i in range(1, len(path)):
+                parent = path[:i]
+                if parent not in self._created:
+                    self._created.add(parent)
+                    ops.append({"op": "add", "path": json_pointer(parent), "value": [] if isinstance(path[i], int) else {}})
+            self._created.add(path)
+            ops.append({"op": "add", "path": json_pointer(path), "value": value})
+        return ops
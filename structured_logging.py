@@ -0,0 +1,143 @@
+# 結構化 logging: 取代串流 hot path 裡的 print()
+#
+# 原本每個 stream event 都 print(event)，把 pydantic 物件轉成字串再同步寫到 stdout，
+# 高負載時是明顯的 CPU 成本，終端機或 pipe 太慢時還會卡住 event loop。
+# 這裡改用:
+#   - 標準 logging 的 level (LOG_LEVEL)
+#   - 每個 endpoint 可設定的 stream event 取樣率 (LOG_EVENT_SAMPLE_RATE / LOG_EVENT_SAMPLE_RATES)
+#   - QueueHandler + QueueListener: event loop 只把 record 丟進 queue，寫出都在背景 thread；
+#     args 都是不可變的值 (str、數字、tuple...) 時格式化也留給背景 thread，否則在呼叫的地方先格式化，
+#     免得物件在寫出前被改掉 (log 到的是之後的狀態)
+#
+# 設定範例:
+#   LOG_LEVEL=DEBUG
+#   LOG_FORMAT=json                                   json 或 text
+#   LOG_EVENT_SAMPLE_RATE=0                           預設不記錄個別 stream event
+#   LOG_EVENT_SAMPLE_RATES=/api/v1/agent_stream=0.01,/api/ag-ui=0.1
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Callable
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_EVENT_SAMPLE_RATE = float(os.environ.get("LOG_EVENT_SAMPLE_RATE", "0"))
+LOG_EVENT_SAMPLE_RATES = os.environ.get("LOG_EVENT_SAMPLE_RATES", "")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+ROOT_LOGGER = "app"
+
+_STANDARD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+def _parse_sample_rates(value: str) -> dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            endpoint, rate = item.rsplit("=", 1)
+            rates[endpoint.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra={...}` fields are included as top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+_IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+def _immutable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread when the record's args can't change before then."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args and not _immutable(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # 寧可丟 log 也不要卡住 event loop
+            dropped_records[0] += 1
+
+
+dropped_records = [0]
+_listener = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Route the `app` logger through a bounded queue to a background writer thread (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.handlers = [_DeferredQueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+_event_logger = get_logger("stream")
+_sample_rates = _parse_sample_rates(LOG_EVENT_SAMPLE_RATES)
+
+
+def event_logger(endpoint: str, rate: float | None = None) -> Callable | None:
+    """Return an on_event callback that logs a sample of stream events, or None when disabled.
+
+    Returning None lets agent_frames() skip the hook entirely, so disabled logging costs nothing per event.
+    """
+    if rate is None:
+        rate = _sample_rates.get(endpoint, LOG_EVENT_SAMPLE_RATE)
+    if rate <= 0 or not _event_logger.isEnabledFor(logging.DEBUG):
+        return None
+
+    def on_event(event):
+        if rate >= 1 or random.random() < rate:
+            # event 是可變的 pydantic 物件，會在這裡就轉成字串 (見 _DeferredQueueHandler)，只有取樣到的才付這個成本
+            _event_logger.debug("stream event %s", event, extra={"endpoint": endpoint, "event_type": event.type})
+
+    return on_event
+
@@ -0,0 +1,142 @@
+# Tool output compaction: web_search / knowledge_search 的結果先壓縮再給 model
+#
+# Tavily 的原始結果 (title、url、score、raw_content、重複的網頁...) 整包放進 context，
+# 之後每一輪 (tool call 之後的每次 model 呼叫、同一個對話的下一題) 都要再付一次這些 input tokens。
+# 給 model 之前:
+#   - 去重: 相同 url (忽略 #fragment、結尾的 /) 或內容相同的結果只留第一筆
+#   - 只留 model 用得到的欄位 (title、url、content)，其他 (score、raw_content、images...) 不送
+#   - 每筆 content 最多 TOOL_RESULT_MAX_CHARS 個字 (在空白處截斷)
+#   - 整個 tool output 不超過 TOOL_OUTPUT_TOKEN_BUDGET tokens (用 utils.py 的 tokenizer 計算)，排在後面的結果先被截短 / 丟掉
+#
+# 來源 (url、title、完整內容) 還是存在 run context 的 search_source (見 source_store.py)，前端顯示來源或之後要引用都用那份。
+# 每次呼叫省下的 tokens 記在 log 和 /metrics (tool_output_tokens_total)，GET /api/tool_compaction/stats 是加總。
+
+import os
+import re
+from dataclasses import dataclass
+
+from stream_metrics import metrics
+from structured_logging import get_logger
+
+logger = get_logger("tool_compaction")
+
+TOOL_RESULT_MAX_CHARS = int(os.environ.get("TOOL_RESULT_MAX_CHARS", "1200"))
+TOOL_OUTPUT_TOKEN_BUDGET = int(os.environ.get("TOOL_OUTPUT_TOKEN_BUDGET", "1500"))
+MIN_RESULT_CHARS = 200  # 剩下的 budget 放不下這麼多字就不再加結果
+
+_WHITESPACE = re.compile(r"\s+")
+
+tool_output_tokens = metrics.counter("tool_output_tokens_total", "Tool output tokens before (raw) and after (compact) compaction.",
+                                     ("tool", "stage"))
+tool_calls_compacted = metrics.counter("tool_calls_compacted_total", "Tool calls whose output went through compaction.", ("tool",))
+
+_tokenizer_failed = False
+
+
+def count_tokens(text: str) -> int:
+    """Tokens of text with the tokenizer in utils.py; ~4 characters per token when the encoding can't be loaded (offline)."""
+    global _tokenizer_failed
+    if not _tokenizer_failed:
+        try:
+            from utils import count_tokens as tiktoken_count
+
+            return tiktoken_count(text)
+        except Exception as e:  # tiktoken 第一次要下載 BPE 檔，離線時會失敗
+            _tokenizer_failed = True
+            logger.warning("tokenizer unavailable, estimating tokens from length: %s", e)
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class CompactedOutput:
+    text: str
+    raw_tokens: int
+    tokens: int
+    results: int
+    dropped: int  # 重複或超出 budget 而沒有送給 model 的結果數
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.raw_tokens - self.tokens)
+
+
+def _url_key(url: str) -> str:
+    return url.split("#", 1)[0].rstrip("/").lower()
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    text = _WHITESPACE.sub(" ", text or "").strip()
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    if cut < max_chars // 2:  # 中文沒有空白，直接在 max_chars 截斷
+        cut = max_chars
+    return text[:cut].rstrip() + "…"
+
+
+def _format(index: int, result: dict, fields: tuple[str, ...]) -> str:
+    return "\n".join([f"[{index}] {result.get(fields[0], '')}".rstrip(), *(str(result.get(f, "")) for f in fields[1:])])
+
+
+def compact_results(results: list[dict], fields: tuple[str, ...] = ("title", "url", "content"),
+                    max_chars: int = TOOL_RESULT_MAX_CHARS, token_budget: int = TOOL_OUTPUT_TOKEN_BUDGET) -> tuple[str, int, int]:
+    """(text, kept, dropped): deduped results with only `fields`, content capped to max_chars, whole text within token_budget."""
+    seen_urls, seen_contents = set(), set()
+    blocks = []
+    used = dropped = 0
+    for result in results:
+        content = _truncate(result.get("content", ""), max_chars)
+        url = _url_key(result.get("url") or "")
+        content_key = content[:200].lower()
+        if (url and url in seen_urls) or (content_key and content_key in seen_contents):
+            dropped += 1
+            continue
+        seen_urls.add(url)
+        seen_contents.add(content_key)
+
+        item = {**result, "content": content}
+        block = _format(len(blocks) + 1, item, fields)
+        tokens = count_tokens(block) + 1  # 加上分隔的空行
+        remaining = token_budget - used
+        if tokens > remaining:
+            # 放不下: 依比例截短 content，太短就不要了 (後面的結果相關性也比較低)
+            allowed = len(content) * remaining // tokens - 20
+            if allowed < MIN_RESULT_CHARS:
+                dropped += 1
+                continue
+            item["content"] = _truncate(content, allowed)
+            block = _format(len(blocks) + 1, item, fields)
+            tokens = count_tokens(block) + 1
+            if tokens > remaining:
+                dropped += 1
+                continue
+        blocks.append(block)
+        used += tokens
+    return "\n\n".join(blocks), len(blocks), dropped
+
+
+def compact_search_output(tool: str, results: list[dict], raw_output: str, fields: tuple[str, ...] = ("title", "url", "content"),
+                          token_budget: int = TOOL_OUTPUT_TOKEN_BUDGET) -> CompactedOutput:
+    """Compact search results for the model and record the tokens saved compared with raw_output (what used to be sent)."""
+    text, kept, dropped = compact_results(results, fields, token_budget=token_budget)
+    output = CompactedOutput(text, count_tokens(raw_output), count_tokens(text), kept, dropped)
+    tool_calls_compacted.inc((tool,))
+    tool_output_tokens.inc((tool, "raw"), output.raw_tokens)
+    tool_output_tokens.inc((tool, "compact"), output.tokens)
+    logger.info("compacted tool output", extra={"tool": tool, "raw_tokens": output.raw_tokens, "tokens": output.tokens,
+                                                "saved_tokens": output.saved_tokens, "results": kept, "dropped": dropped})
+    return output
+
+
+def compaction_stats() -> dict:
+    stats = {}
+    for (tool,), calls in tool_calls_compacted.items():
+        raw = tool_output_tokens.get((tool, "raw"))
+        compact = tool_output_tokens.get((tool, "compact"))
+        stats[tool] = {
+            "calls": int(calls),
+            "raw_tokens": int(raw),
+            "compact_tokens": int(compact),
+            "saved_tokens_per_call": round((raw - compact) / calls, 1) if calls else 0,
+        }
+    return stats
@@ -1,42 +1,118 @@
 # https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+#
+# 計算 token 的成本: CustomSQLiteSession.get_items 每一輪都算一次整個 session 的 tokens，
+# 原本每次都 tiktoken.encoding_for_model() 再把每一則 message 重新 encode，對話越長越慢。
+#   - 每個 model 的 encoding 只載入一次 (get_encoding)
+#   - 每一則 message (和 tools 的定義) 的 tokens 用內容的 hash 當 key 存在 LRU (TOKEN_CACHE_SIZE 則)，
+#     同一段對話下一輪只需要 encode 新的 items
+# /metrics 的 token_cache_lookups_total{result} 是 hit / miss 的次數。見 bench_token_counting.py。
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import tiktoken
 
-def num_tokens_from_messages(messages, model="gpt-5"):
-    encoding = tiktoken.encoding_for_model(model)
+from stream_metrics import metrics
+
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "20000"))
+
+token_cache_lookups = metrics.counter("token_cache_lookups_total", "Per-item token count cache lookups.", ("result",))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-5") -> tiktoken.Encoding:
+    """tiktoken encoding of the model, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
+
+
+class TokenCache:
+    """LRU of token counts keyed by the hash of the item's content (and the encoding)."""
+
+    def __init__(self, size: int = TOKEN_CACHE_SIZE):
+        self.size = size
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(encoding: tiktoken.Encoding, item) -> bytes:
+        data = json.dumps(item, sort_keys=True, default=str)
+        return hashlib.sha1(f"{encoding.name}\0{data}".encode()).digest()
+
+    def get_or_count(self, encoding: tiktoken.Encoding, item, count) -> int:
+        key = self.key(encoding, item)
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+        if tokens is not None:
+            token_cache_lookups.inc(("hit",))
+            return tokens
+        token_cache_lookups.inc(("miss",))
+        tokens = count(encoding, item)
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > self.size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+token_cache = TokenCache()
+
 
+def _message_tokens(encoding, message) -> int:
     tokens_per_message = 3
     tokens_per_name = 1
 
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            # print(f"  key: {key}, value: {value} type: {type(value)}")
-
-            if key == "content":
-                if isinstance(value, list):
-                    for v2 in value:
-                        for k3, v3 in v2.items():
-                            if k3 == "text":
-                                num_tokens += len(encoding.encode(str(v3)))
-                            elif k3 == 'annotations': # 內建的 web search
-                                for v4 in v3:
-                                    for k5, v5 in v4.items():
-                                        if k5 == "title" or k5 == "url":
-                                            num_tokens += len(encoding.encode(str(v5)))
-                else:
-                    num_tokens += len(encoding.encode(str(value)))
-            elif key in ("output", "arguments", "role", "action", "type"):
-                num_tokens += len(encoding.encode(str(value)))
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        # print(f"  key: {key}, value: {value} type: {type(value)}")
+
+        if key == "content":
+            if isinstance(value, list):
+                for v2 in value:
+                    for k3, v3 in v2.items():
+                        if k3 == "text":
+                            num_tokens += len(encoding.encode(str(v3)))
+                        elif k3 == 'annotations': # 內建的 web search
+                            for v4 in v3:
+                                for k5, v5 in v4.items():
+                                    if k5 == "title" or k5 == "url":
+                                        num_tokens += len(encoding.encode(str(v5)))
             else:
-                pass
+                num_tokens += len(encoding.encode(str(value)))
+        elif key in ("output", "arguments", "role", "action", "type"):
+            num_tokens += len(encoding.encode(str(value)))
+        else:
+            pass
+
+        num_tokens += tokens_per_name # for each key
+
+    return num_tokens
 
-            num_tokens += tokens_per_name # for each key
+def num_tokens_from_messages(messages, model="gpt-5", cache: TokenCache | None = token_cache):
+    encoding = get_encoding(model)
+
+    num_tokens = 0
+    for message in messages:
+        if cache is None:
+            num_tokens += _message_tokens(encoding, message)
+        else:
+            num_tokens += cache.get_or_count(encoding, message, _message_tokens)
 
     num_tokens += 3
     return num_tokens
 
-def num_tokens_for_tools(functions, messages, model="gpt-5"):
+def _function_tokens(encoding, functions) -> int:
     # Set function settings
     func_init = 7
     prop_init = 3
@@ -45,8 +121,6 @@ def num_tokens_for_tools(functions, messages, model="gpt-5"):
     enum_item = 3
     func_end = 12
 
-    encoding = tiktoken.encoding_for_model(model)
-
     func_token_count = 0
     if len(functions) > 0:
         for x in functions:
@@ -85,7 +159,17 @@ def num_tokens_for_tools(functions, messages, model="gpt-5"):
                     func_token_count += len(encoding.encode(line))
         func_token_count += func_end
 
-    messages_token_count = num_tokens_from_messages(messages, model)
+    return func_token_count
+
+def num_tokens_for_tools(functions, messages, model="gpt-5", cache: TokenCache | None = token_cache):
+    encoding = get_encoding(model)
+
+    if cache is None:
+        func_token_count = _function_tokens(encoding, functions)
+    else:
+        func_token_count = cache.get_or_count(encoding, functions, _function_tokens)
+
+    messages_token_count = num_tokens_from_messages(messages, model, cache)
     total_tokens = messages_token_count + func_token_count
 
     return total_tokens
@@ -105,7 +189,7 @@ async def num_tokens_for_agent_input_items(agent, messages, model="gpt-5"):
 
 def count_tokens(text: str, model: str = "gpt-5") -> int:
     """Count tokens in a text string using tiktoken encoding for the specified model."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     tokens = encoding.encode(text)
     return len(tokens)
 
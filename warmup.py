@@ -0,0 +1,96 @@
+# 啟動 warm-up: 重的模組 (agents、openai、tavily、ag_ui) 不在 import main 時載入，而是在 server 開始接連線之後由背景 task 載入
+#
+# uvicorn worker 原本要等 `import main` 跑完 (幾秒) 才能開始接連線，autoscaling 擴容時新機器要很久才能用。
+# 現在 import main 只載入 FastAPI 和輕量的模組，lifespan 啟動背景 warm-up:
+#   warmup.start([("import qa_agents", load_agents), ("tiktoken", load_encodings, False), ...])
+# 需要這些模組的 endpoint 先 `await warmup.wait()`，/readyz 在 warm-up 完成前回 503，load balancer 不會把流量導過來。
+#
+# 每個步驟可標記為非必要 (required=False): 在必要步驟完成之後才跑 (這時 endpoint 已經可以用)，失敗只記錄在 /readyz，
+# 不會讓 server 一直 not ready；但 /readyz 還是要等它們跑完 (成功或失敗) 才回 200，流量進來時 encoding 和連線池都已經準備好。
+
+import asyncio
+import inspect
+import os
+import time
+
+from structured_logging import get_logger
+
+logger = get_logger("warmup")
+
+# 非必要步驟最多等幾秒 (例如下載 encoding 卡住)，超過就記成失敗，不讓 readiness 一直等
+WARMUP_OPTIONAL_TIMEOUT = float(os.environ.get("WARMUP_OPTIONAL_TIMEOUT", "30"))
+
+
+class WarmupFailed(RuntimeError):
+    pass
+
+
+class Warmup:
+    """Runs startup steps in the background and tracks readiness."""
+
+    def __init__(self):
+        self.started_at = None
+        self.ready_at = None
+        self.finished_at = None
+        self.steps: dict[str, dict] = {}
+        self.failed: str | None = None
+        self._task: asyncio.Task | None = None
+        self._required_done: asyncio.Event | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None and self.failed is None
+
+    def start(self, steps: list[tuple]):
+        """steps: (name, fn) or (name, fn, required); sync functions run in a thread so the loop keeps serving."""
+        self.started_at = time.perf_counter()
+        self._required_done = asyncio.Event()
+        self._task = asyncio.create_task(self._run(steps))
+
+    async def _run(self, steps):
+        # 必要的步驟依序執行，完成後 wait() 就放行；非必要的 (預先連線、載入 encoding) 接著一起跑，
+        # 全部跑完才算 ready (非必要的失敗只記錄，不擋 readiness)
+        steps = [(name, fn, rest[0] if rest else True) for name, fn, *rest in steps]
+        try:
+            for name, fn, required in steps:
+                if required and not await self._step(name, fn, required):
+                    self.failed = name
+                    return
+        finally:
+            self._required_done.set()
+        await asyncio.gather(*(self._step(name, fn, required) for name, fn, required in steps if not required))
+        self.ready_at = self.finished_at = time.perf_counter()
+        logger.info("warm-up ready", extra={"seconds": round(self.ready_at - self.started_at, 3)})
+
+    async def _step(self, name: str, fn, required: bool) -> bool:
+        start = time.perf_counter()
+        try:
+            run = fn() if inspect.iscoroutinefunction(fn) else asyncio.to_thread(fn)
+            await (run if required else asyncio.wait_for(run, WARMUP_OPTIONAL_TIMEOUT))
+            self.steps[name] = {"ok": True, "seconds": round(time.perf_counter() - start, 3)}
+            return True
+        except Exception as e:
+            self.steps[name] = {"ok": False, "seconds": round(time.perf_counter() - start, 3), "error": repr(e)}
+            logger.warning("warm-up step failed", extra={"step": name, "error": repr(e), "required": required})
+            return False
+
+    async def wait(self):
+        """Wait until the required steps have finished; raises WarmupFailed if one of them failed."""
+        if self._required_done is None:
+            raise WarmupFailed("warm-up was not started")
+        await self._required_done.wait()
+        if self.failed:
+            raise WarmupFailed(f"warm-up step failed: {self.failed}")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "seconds": round((self.ready_at or time.perf_counter()) - self.started_at, 3) if self.started_at else None,
+            "background_done": self.finished_at is not None,
+            "steps": self.steps,
+            "failed": self.failed,
+        }
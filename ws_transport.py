@@ -0,0 +1,168 @@
+# WebSocket transport: 同一個對話的很多輪問答走同一條連線 (SSE 之外的另一個選擇)
+#
+# SSE 每問一題就是一個新的 GET (EventSource)，經過某些 proxy 每次都要重新建立連線。
+# /api/v1/agent_ws、/api/v2/agent_ws 開一條 WebSocket，同一個 thread 的每一輪都在這條連線上:
+#
+#   client -> server  {"type": "ask", "id": "t1", "query": "..."}   開始一輪 (同一條連線一次一輪，同一個 session 不能同時寫)
+#                     {"type": "cancel", "id": "t1"}                取消進行中的那一輪 (agent run 和 upstream 串流都會停掉)
+#                     {"type": "ping"}                              server 回 {"type": "pong"}
+#   server -> client  {"type": "ready", "thread_id": "..."}         連線建立
+#                     和 SSE 一樣的 frame 內容 (見 stream_pipeline.py)，多一個 "id" 表示是哪一輪，例如
+#                     {"id":"t1","patch":[...]}  {"id":"t1","message":"DONE","last_response_id":"..."}
+#                     {"id":"t1","message":"CANCELLED"}  {"id":"t1","message":"ERROR","error":"..."}
+#                     {"type":"ping"}                               每 WS_HEARTBEAT_SECONDS 秒，讓 proxy / client 知道連線還活著
+#
+# 每個 message 都是一個沒有空白的 JSON text frame，沒有 SSE 的 "data: " / "id: " 和換行，前端處理方式和 SSE 的 data 一樣。
+# 每一輪一樣要經過 admission (見 admission.py)，拿不到 slot 回 ERROR + retry_after，連線不會斷。
+# 沒有一輪在跑、也超過 WS_IDLE_TIMEOUT_SECONDS 沒收到 client 的訊息就關閉連線。GET /api/ws/stats 是連線和每一輪的數量。
+
+import asyncio
+import json
+import os
+import uuid
+from typing import AsyncIterator, Callable
+
+from admission import AdmissionRejected
+from stream_metrics import metrics
+from stream_pipeline import INTERNAL_FRAMES, StreamFrame
+from structured_logging import get_logger
+
+logger = get_logger("ws_transport")
+
+WS_HEARTBEAT_SECONDS = float(os.environ.get("WS_HEARTBEAT_SECONDS", "20"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get("WS_IDLE_TIMEOUT_SECONDS", "600"))
+WS_MAX_QUERY_CHARS = int(os.environ.get("WS_MAX_QUERY_CHARS", "8000"))
+
+ws_connections = metrics.counter("ws_connections_total", "WebSocket connections accepted.", ("endpoint",))
+ws_turns = metrics.counter("ws_turns_total", "Turns run over WebSocket connections, by outcome.", ("endpoint", "outcome"))
+
+# 目前開著的連線數 (endpoint -> count)
+active_connections: dict[str, int] = {}
+
+# run_turn(query, state) 回傳這一輪的 StreamFrame；state 是這條連線自己的 dict (例如記住 last_response_id)
+TurnRunner = Callable[[str, dict], AsyncIterator[StreamFrame]]
+
+
+def encode_ws(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class AgentSocket:
+    """One WebSocket connection carrying many sequential agent turns of the same thread."""
+
+    def __init__(self, websocket, endpoint: str, run_turn: TurnRunner, thread_id: str | None = None,
+                 heartbeat: float = WS_HEARTBEAT_SECONDS, idle_timeout: float = WS_IDLE_TIMEOUT_SECONDS):
+        self.websocket = websocket
+        self.endpoint = endpoint
+        self.run_turn = run_turn
+        self.state = {"thread_id": thread_id or f"ws_{uuid.uuid4().hex}"}
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self._send_lock = asyncio.Lock()  # heartbeat 和進行中的那一輪會同時送
+        self._turn: asyncio.Task | None = None
+        self._turn_id: str | None = None
+
+    async def send(self, data: dict):
+        async with self._send_lock:
+            await self.websocket.send_text(encode_ws(data))
+
+    async def serve(self):
+        from starlette.websockets import WebSocketDisconnect
+
+        await self.websocket.accept()
+        ws_connections.inc((self.endpoint,))
+        active_connections[self.endpoint] = active_connections.get(self.endpoint, 0) + 1
+        logger.info("websocket connected", extra={"endpoint": self.endpoint, "thread_id": self.state["thread_id"]})
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self.send({"type": "ready", "thread_id": self.state["thread_id"]})
+            while True:
+                try:
+                    text = await asyncio.wait_for(self.websocket.receive_text(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if self._turn and not self._turn.done():
+                        continue
+                    await self.websocket.close(code=1000, reason="idle")
+                    return
+                await self._handle(text)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            heartbeat.cancel()
+            if self._turn and not self._turn.done():
+                # client 斷線: 取消進行中的那一輪 (cancel_when_closed 會停掉 agent run)
+                self._turn.cancel()
+                await asyncio.gather(self._turn, return_exceptions=True)
+            active_connections[self.endpoint] -= 1
+            logger.info("websocket closed", extra={"endpoint": self.endpoint, "thread_id": self.state["thread_id"]})
+
+    async def _handle(self, text: str):
+        try:
+            message = json.loads(text)
+            kind = message["type"]
+        except (ValueError, TypeError, KeyError):
+            await self.send({"type": "error", "error": "expected a JSON object with a type"})
+            return
+
+        if kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind == "cancel":
+            if self._turn and not self._turn.done() and message.get("id") in (None, self._turn_id):
+                self._turn.cancel()
+        elif kind == "ask":
+            turn_id = str(message.get("id") or uuid.uuid4().hex[:8])
+            query = message.get("query")
+            if not isinstance(query, str) or not query.strip() or len(query) > WS_MAX_QUERY_CHARS:
+                await self.send({"id": turn_id, "message": "ERROR", "error": "query must be a non-empty string"})
+            elif self._turn and not self._turn.done():
+                await self.send({"id": turn_id, "message": "ERROR", "error": f"turn {self._turn_id} is still running"})
+            else:
+                self._turn_id = turn_id
+                self._turn = asyncio.create_task(self._run(turn_id, query))
+        else:
+            await self.send({"type": "error", "error": f"unknown message type: {kind}"})
+
+    async def _run(self, turn_id: str, query: str):
+        outcome = "error"
+        frames = self.run_turn(query, self.state)
+        try:
+            async for frame in frames:
+                if frame.kind not in INTERNAL_FRAMES:
+                    await self.send({"id": turn_id, **frame.data})
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            await self._send_quietly({"id": turn_id, "message": "CANCELLED"})
+        except AdmissionRejected as e:
+            outcome = "rejected"
+            await self._send_quietly({"id": turn_id, "message": "ERROR", "error": "server busy, please retry later",
+                                      "reason": e.reason, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.exception("websocket turn failed", extra={"endpoint": self.endpoint, "turn_id": turn_id})
+            await self._send_quietly({"id": turn_id, "message": "ERROR", "error": str(e)})
+        finally:
+            await frames.aclose()  # 在 send 的時候被取消，generator 還停在中間
+            ws_turns.inc((self.endpoint, outcome))
+
+    async def _send_quietly(self, data: dict):
+        try:
+            await self.send(data)
+        except Exception:
+            pass  # 連線已經斷了
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.send({"type": "ping"})
+            except Exception:
+                return
+
+
+def ws_stats() -> dict:
+    stats = {endpoint: {"active": count, "connections": 0, "turns": {}} for endpoint, count in active_connections.items()}
+    for (endpoint,), count in ws_connections.items():
+        stats.setdefault(endpoint, {"active": 0, "connections": 0, "turns": {}})["connections"] = int(count)
+    for (endpoint, outcome), count in ws_turns.items():
+        stats.setdefault(endpoint, {"active": 0, "connections": 0, "turns": {}})["turns"][outcome] = int(count)
+    return stats